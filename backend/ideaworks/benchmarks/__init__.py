@@ -0,0 +1,25 @@
+
+# (c) Crown Copyright 2014 Defence Science and Technology Laboratory UK
+# Author: Rich Brantingham
+
+"""
+Benchmarks for the REST API, over a reproducible synthetic dataset.
+
+ - dataset.py seeds N ideas and projects with M comments each, realistic
+   (long-tailed) tag and vote distributions and varied protective markings,
+   plus users and feedback. The same seed always gives the same data.
+ - runner.py times the idea, project, tag and feedback end points through the
+   Django test client at several data_level and limit settings, counting the
+   mongo and SQL round-trips of each request and picking up the per-stage
+   timings from the Server-Timing header. Results are saved as json so that
+   runs can be compared.
+
+Run them with the run_benchmarks management command, against a local mongod:
+
+    python manage.py run_benchmarks --ideas 2000 --comments 10 --output before.json
+    python manage.py run_benchmarks --ideas 2000 --comments 10 --output after.json --compare before.json
+
+The data goes into a separate mongo database (<MONGO_DATABASE_NAME>_benchmark
+by default) and a throwaway test copy of the SQLite user db, so a real
+database is never touched.
+"""
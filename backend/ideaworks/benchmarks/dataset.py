@@ -0,0 +1,303 @@
+
+# (c) Crown Copyright 2014 Defence Science and Technology Laboratory UK
+# Author: Rich Brantingham
+
+"""
+A seeded synthetic dataset for the benchmarks.
+
+Documents are built with the document classes, so they're shaped exactly as
+the API writes them, but inserted in batches through the raw collections.
+The aggregates the write paths normally keep up to date (counts, vote
+scores, max_pm, snippets, tag counts, the vote collection, watermarks and - with
+COMMENT_STORAGE = 'collection' - the comment collections) are then derived
+with the same functions that the maintenance commands use.
+"""
+
+import os
+import json
+import random
+import datetime
+
+from django.contrib.auth.models import User
+
+from ideasapp import documents
+from ideasapp.api_functions import vote_score, derive_snippet
+from ideasapp.api_functions import derive_document_max_pm as derive_idea_max_pm
+from projectsapp import documents as project_documents
+from projectsapp.api_functions import derive_document_max_pm as derive_project_max_pm
+from contentapp import documents as content_documents
+from contentapp.api_functions import derive_document_max_pm as derive_feedback_max_pm
+from ideaworks.votes import rebuild_votes
+from ideaworks.watermarks import touch_watermark
+from ideaworks.comment_store import comments_in_collection, move_embedded_comments
+
+# The protective markings the site is set up with
+PM_DATA_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'protective_marking_app', 'data')
+
+WORDS = ['sensor', 'network', 'autonomy', 'data', 'analysis', 'training', 'logistics', 'energy', 'materials',
+         'signal', 'model', 'simulation', 'cyber', 'space', 'maritime', 'medical', 'human', 'factors',
+         'robotics', 'imaging', 'radar', 'acoustic', 'chemistry', 'biology', 'physics', 'maths', 'design',
+         'software', 'hardware', 'prototype', 'trial', 'survey', 'cost', 'safety', 'power', 'storage']
+
+# Ideas and projects are mostly published
+STATUSES = [('published', 85), ('draft', 10), ('hidden', 5)]
+
+# How many documents to insert at a time
+BATCH_SIZE = 500
+
+#------------------------------------------------------------------------
+
+def load_pm_data(name):
+
+    with open(os.path.join(PM_DATA_PATH, '%s.json' % (name))) as pm_file:
+        return [entry for entry in json.load(pm_file) if entry.get('active', True)]
+
+def weighted_choice(rng, choices):
+    """ One of [(value, weight)] """
+
+    point = rng.uniform(0, sum([weight for value, weight in choices]))
+    for value, weight in choices:
+        point -= weight
+        if point <= 0:
+            return value
+    return choices[-1][0]
+
+def long_tail(rng, mean, cap):
+    """ A long-tailed (pareto) count with roughly this mean - most small, a few large """
+
+    return min(cap, int((rng.paretovariate(2.0) - 1) * mean))
+
+#------------------------------------------------------------------------
+
+class MarkingGenerator(object):
+    """ Random protective markings - mostly the lower classifications, with the
+        occasional descriptor, codeword or national caveat """
+
+    def __init__(self, rng):
+        self.rng = rng
+        self.classifications = load_pm_data('classifications')
+        self.descriptors = load_pm_data('descriptors')
+        self.codewords = load_pm_data('codewords')
+        self.caveats = load_pm_data('national_caveats')
+
+    def build(self, document_class):
+
+        rng = self.rng
+        classification = weighted_choice(rng, [(c, 2 ** -c['rank']) for c in self.classifications])
+        pm = document_class(classification       = classification['classification'],
+                            classification_short = classification['abbreviation'],
+                            classification_rank  = classification['rank'],
+                            descriptor           = '',
+                            codewords            = [],
+                            codewords_short      = [],
+                            national_caveats_primary_name = '',
+                            national_caveats_members      = [],
+                            national_caveats_rank         = 0)
+
+        if self.descriptors and rng.random() < 0.2:
+            pm.descriptor = rng.choice(self.descriptors)['descriptor']
+        if self.codewords and rng.random() < 0.1:
+            codewords = rng.sample(self.codewords, rng.randint(1, len(self.codewords)))
+            pm.codewords = [codeword['codeword'] for codeword in codewords]
+            pm.codewords_short = [codeword['abbreviation'] or codeword['codeword'] for codeword in codewords]
+        if self.caveats and rng.random() < 0.05:
+            caveat = rng.choice(self.caveats)
+            pm.national_caveats_primary_name = caveat['primary_name']
+            pm.national_caveats_members = caveat['member_countries']
+            pm.national_caveats_rank = caveat['rank']
+
+        return pm
+
+#------------------------------------------------------------------------
+
+class DatasetGenerator(object):
+    """ Builds the synthetic dataset from one seed """
+
+    def __init__(self, seed, users=50, tags=60):
+
+        self.rng = random.Random(seed)
+        self.markings = MarkingGenerator(self.rng)
+        self.now = datetime.datetime(2014, 6, 1)
+        self.user_count = users
+        self.usernames = []
+
+        # Tags follow a zipf-like distribution: a few very common, many rare
+        self.tags = [WORDS[i % len(WORDS)] + ('_%s' % (i // len(WORDS)) if i >= len(WORDS) else '') for i in range(tags)]
+        self.tag_weights = [1.0 / (rank + 1) for rank in range(tags)]
+
+    def text(self, words):
+        return ' '.join([self.rng.choice(WORDS) for i in range(words)])
+
+    def html(self, paragraphs):
+        return ''.join(['<p>%s.</p>' % (self.text(self.rng.randint(20, 80)).capitalize()) for i in range(paragraphs)])
+
+    def pick_tags(self):
+
+        picked = []
+        for i in range(self.rng.randint(0, 6)):
+            tag = weighted_choice(self.rng, zip(self.tags, self.tag_weights))
+            if tag not in picked:
+                picked.append(tag)
+        return picked
+
+    def pick_created(self, after=None):
+        """ Some time in the last year (or since after) """
+
+        start = after or self.now - datetime.timedelta(days=365)
+        span = self.now - start
+        return start + datetime.timedelta(seconds=self.rng.uniform(0, span.days * 86400 + span.seconds))
+
+    def pick_voters(self, mean):
+        return self.rng.sample(self.usernames, long_tail(self.rng, mean, len(self.usernames)))
+
+    #------------------------------------------------------------------------
+
+    def build_users(self):
+        """ Users (with their api keys, made by the post_save signal) in the user db """
+
+        for i in range(self.user_count):
+            username = 'bench_user_%03d' % (i)
+            user, created = User.objects.get_or_create(username=username,
+                                                       defaults={'email'      : '%s@example.com' % (username),
+                                                                 'first_name' : self.rng.choice(WORDS),
+                                                                 'last_name'  : self.rng.choice(WORDS)})
+            self.usernames.append(username)
+        return self.usernames
+
+    def build_comments(self, document_module, created, count):
+
+        comments = []
+        for i in range(count):
+            comment_created = self.pick_created(after=created)
+            comments.append(document_module.Comment(user               = self.rng.choice(self.usernames),
+                                                    title              = self.text(6).capitalize(),
+                                                    body               = self.html(self.rng.randint(1, 3)),
+                                                    created            = comment_created,
+                                                    modified           = comment_created,
+                                                    protective_marking = self.markings.build(document_module.ProtectiveMarking)))
+        for comment in comments:
+            comment.body_snippet = derive_snippet(comment.body)
+        return sorted(comments, key=lambda comment: comment.created)
+
+    def build_idea(self, comments):
+
+        created = self.pick_created()
+        idea = documents.Idea(user               = self.rng.choice(self.usernames),
+                              title              = self.text(5).capitalize(),
+                              description        = self.html(self.rng.randint(1, 5)),
+                              protective_marking = self.markings.build(documents.ProtectiveMarking),
+                              created            = created,
+                              tags               = self.pick_tags(),
+                              status             = weighted_choice(self.rng, STATUSES),
+                              comments           = self.build_comments(documents, created, comments))
+
+        for username in self.pick_voters(mean=8):
+            vote = documents.Vote(user=username, created=self.pick_created(after=created))
+            if self.rng.random() < 0.7:
+                idea.likes.append(vote)
+            else:
+                idea.dislikes.append(vote)
+
+        idea.like_count = len(idea.likes)
+        idea.dislike_count = len(idea.dislikes)
+        idea.vote_score = vote_score(idea.like_count, idea.dislike_count)
+        idea.comment_count = len(idea.comments)
+        idea.tag_count = len(idea.tags)
+        idea.modified = max([created] + [comment.modified for comment in idea.comments] + [vote.created for vote in idea.likes + idea.dislikes])
+        idea.max_pm = derive_idea_max_pm(idea)
+        idea.description_snippet = derive_snippet(idea.description)
+        return idea
+
+    def build_project(self, comments, idea_ids):
+
+        created = self.pick_created()
+        project = project_documents.Project(user               = self.rng.choice(self.usernames),
+                                            title              = self.text(5).capitalize(),
+                                            description        = self.html(self.rng.randint(1, 5)),
+                                            protective_marking = self.markings.build(project_documents.ProtectiveMarking),
+                                            created            = created,
+                                            tags               = self.pick_tags(),
+                                            status             = weighted_choice(self.rng, STATUSES),
+                                            comments           = self.build_comments(project_documents, created, comments),
+                                            related_ideas      = [str(idea_id) for idea_id in self.rng.sample(idea_ids, min(len(idea_ids), self.rng.randint(0, 3)))])
+
+        project.backs = [project_documents.Vote(user=username, created=self.pick_created(after=created)) for username in self.pick_voters(mean=5)]
+        project.back_count = len(project.backs)
+        project.comment_count = len(project.comments)
+        project.tag_count = len(project.tags)
+        project.modified = max([created] + [comment.modified for comment in project.comments] + [back.created for back in project.backs])
+        project.max_pm = derive_project_max_pm(project)
+        project.description_snippet = derive_snippet(project.description)
+        return project
+
+    def build_feedback(self, comments):
+
+        created = self.pick_created()
+        feedback = content_documents.Feedback(type               = 'feedback',
+                                              user               = self.rng.choice(self.usernames),
+                                              title              = self.text(5).capitalize(),
+                                              summary            = self.text(12),
+                                              body               = self.html(self.rng.randint(1, 3)),
+                                              protective_marking = self.markings.build(content_documents.ProtectiveMarking),
+                                              created            = created,
+                                              status             = 'published',
+                                              public             = self.rng.random() < 0.9)
+
+        for i in range(comments):
+            comment_created = self.pick_created(after=created)
+            feedback.comments.append(content_documents.FeedbackComment(user               = self.rng.choice(self.usernames),
+                                                                       title              = self.text(6).capitalize(),
+                                                                       body               = self.html(1),
+                                                                       created            = comment_created,
+                                                                       modified           = comment_created,
+                                                                       protective_marking = self.markings.build(content_documents.ProtectiveMarking)))
+        for comment in feedback.comments:
+            comment.body_snippet = derive_snippet(comment.body)
+        feedback.comment_count = len(feedback.comments)
+        feedback.modified = max([created] + [comment.modified for comment in feedback.comments])
+        feedback.max_pm = derive_feedback_max_pm(feedback)
+        return feedback
+
+#------------------------------------------------------------------------
+
+def insert_batched(document_class, build, count):
+    """ Builds and inserts count documents, BATCH_SIZE at a time. Returns their ids. """
+
+    collection = document_class._get_collection()
+    ids = []
+    for start in range(0, count, BATCH_SIZE):
+        batch = [build().to_mongo() for i in range(start, min(count, start + BATCH_SIZE))]
+        ids.extend(collection.insert(batch))
+    return ids
+
+def seed_dataset(seed=1, ideas=1000, projects=200, comments=5, users=50, feedback=100):
+    """ Fills the (empty) databases with the synthetic dataset. Returns a summary of what was made. """
+
+    generator = DatasetGenerator(seed, users=users)
+    generator.build_users()
+
+    idea_ids = insert_batched(documents.Idea, lambda: generator.build_idea(comments), ideas)
+    insert_batched(project_documents.Project, lambda: generator.build_project(comments, idea_ids), projects)
+    insert_batched(content_documents.Feedback, lambda: generator.build_feedback(comments), feedback)
+
+    # The aggregates that the write paths would have kept up to date
+    documents.rebuild_tag_counts({'idea' : documents.Idea, 'project' : project_documents.Project})
+    votes = rebuild_votes([(documents.Idea,            {'likes' : 'like', 'dislikes' : 'dislike'}),
+                           (project_documents.Project, {'backs' : 'back'})])
+    for name in ('idea', 'project', 'feedback'):
+        touch_watermark(name, generator.now)
+
+    if comments_in_collection():
+        move_embedded_comments(documents.Idea, documents.StoredComment)
+        move_embedded_comments(project_documents.Project, project_documents.StoredComment)
+        move_embedded_comments(content_documents.Feedback, content_documents.StoredComment)
+
+    return {'seed'      : seed,
+            'users'     : users,
+            'ideas'     : ideas,
+            'projects'  : projects,
+            'feedback'  : feedback,
+            'comments'  : comments,
+            'votes'     : votes,
+            'tags'      : documents.Tag.objects.count(),
+            'top_tag'   : generator.tags[0]}
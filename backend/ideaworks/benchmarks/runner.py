@@ -0,0 +1,256 @@
+
+# (c) Crown Copyright 2014 Defence Science and Technology Laboratory UK
+# Author: Rich Brantingham
+
+"""
+Times the API end points over the synthetic dataset, through the Django test client.
+
+Each case (end point x data_level x limit) is requested once to warm up, then
+repeatedly timed. Alongside the times, the mongo and SQL round-trips of each
+request are counted, and the per-stage times are read back from the
+Server-Timing header (see ideaworks/request_timing.py).
+
+Mongo round-trips are counted by wrapping the client's message sending, as
+pymongo 2.x has no command monitoring. SQL queries are counted as Django's
+assertNumQueries does, with the debug cursor.
+"""
+
+import json
+import time
+import datetime
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.db import connection as sql_connection
+from django.test import client
+from django.test.utils import override_settings
+from django.core.urlresolvers import reverse
+from django.contrib.auth.models import User
+
+from mongoengine import connection as mongo_connection
+from mongoengine.base.common import _document_registry
+
+from ideasapp import documents
+
+# The end points, with the data_levels the front end asks each for
+# (None being the full objects)
+ENDPOINTS = [('idea',     'list',   [None, 'min', 'less', 'more']),
+             ('idea',     'tagged', [None, 'less']),
+             ('idea',     'detail', [None, 'more']),
+             ('project',  'list',   [None, 'min', 'proj_less', 'proj_more']),
+             ('tag',      'list',   [None]),
+             ('feedback', 'list',   [None])]
+
+DEFAULT_LIMITS = [20, 100]
+
+#------------------------------------------------------------------------
+
+def use_mongo_database(name):
+    """ Points the default connection (and every document class) at another database.
+        Returns the previous connection settings, for restore_mongo_database(). """
+
+    alias = mongo_connection.DEFAULT_CONNECTION_NAME
+    previous = dict(mongo_connection._connection_settings[alias])
+
+    mongo_connection.disconnect(alias)
+    mongo_connection.register_connection(alias, name=name, host=previous.get('host'), port=previous.get('port'))
+    reset_collections()
+
+    return previous
+
+def restore_mongo_database(previous):
+
+    alias = mongo_connection.DEFAULT_CONNECTION_NAME
+    mongo_connection.disconnect(alias)
+    mongo_connection._connection_settings[alias] = previous
+    reset_collections()
+
+def reset_collections():
+    """ Documents hold on to their collection - make them fetch it again from the current connection """
+
+    for document_class in _document_registry.values():
+        if hasattr(document_class, '_get_collection'):
+            document_class._collection = None
+
+@contextmanager
+def benchmark_databases(mongo_name, keep=False):
+    """ A fresh mongo database of this name, and a throwaway test copy of the user db """
+
+    if mongo_name == getattr(settings, 'MONGO_DATABASE_NAME', None):
+        raise ValueError("The benchmark database can't be the site's database (%s)." % (mongo_name))
+
+    old_sql_name = sql_connection.settings_dict['NAME']
+    sql_connection.creation.create_test_db(verbosity=0, autoclobber=True)
+    previous = use_mongo_database(mongo_name)
+    mongo_connection.get_connection().drop_database(mongo_name)
+    try:
+        yield
+    finally:
+        if not keep:
+            mongo_connection.get_connection().drop_database(mongo_name)
+        restore_mongo_database(previous)
+        sql_connection.creation.destroy_test_db(old_sql_name, verbosity=0)
+
+#------------------------------------------------------------------------
+
+class RoundTripCounter(object):
+    """ Counts the mongo messages and SQL queries sent while counting() """
+
+    def __init__(self):
+        self.mongo = 0
+        self.sql = 0
+
+    def wrap(self, method):
+
+        def counted(*args, **kwargs):
+            self.mongo += 1
+            return method(*args, **kwargs)
+        return counted
+
+    @contextmanager
+    def counting(self):
+
+        mongo = mongo_connection.get_connection()
+        originals = {}
+        for name in ('_send_message', '_send_message_with_response'):
+            originals[name] = getattr(mongo, name)
+            setattr(mongo, name, self.wrap(originals[name]))
+
+        use_debug_cursor = sql_connection.use_debug_cursor
+        sql_connection.use_debug_cursor = True
+        queries = len(sql_connection.queries)
+        try:
+            yield self
+        finally:
+            self.sql += len(sql_connection.queries) - queries
+            sql_connection.use_debug_cursor = use_debug_cursor
+            for name, method in originals.items():
+                setattr(mongo, name, method)
+
+#------------------------------------------------------------------------
+
+def parse_server_timing(header):
+    """ {stage: ms} from a Server-Timing header """
+
+    stages = {}
+    for entry in (header or '').split(','):
+        parts = entry.strip().split(';')
+        for part in parts[1:]:
+            if part.startswith('dur='):
+                stages[parts[0]] = float(part[4:])
+    return stages
+
+def median(values):
+
+    values = sorted(values)
+    middle = len(values) // 2
+    if len(values) % 2:
+        return values[middle]
+    return (values[middle - 1] + values[middle]) / 2.0
+
+def build_cases(summary, limits):
+    """ (name, uri, params) for every end point x data_level x limit """
+
+    idea = documents.Idea.objects(status='published').only('id').first()
+
+    cases = []
+    for resource_name, kind, data_levels in ENDPOINTS:
+        if kind == 'detail':
+            uri = reverse('api_dispatch_detail', kwargs={'api_name' : 'v1', 'resource_name' : resource_name, 'pk' : idea.pk})
+            case_limits = [None]
+        else:
+            uri = reverse('api_dispatch_list', kwargs={'api_name' : 'v1', 'resource_name' : resource_name})
+            case_limits = limits
+
+        for data_level in data_levels:
+            for limit in case_limits:
+                params = {}
+                if kind == 'tagged':
+                    params['tags__in'] = summary['top_tag']
+                if data_level:
+                    params['data_level'] = data_level
+                if limit:
+                    params['limit'] = limit
+                name = '%s %s data_level=%s limit=%s' % (resource_name, kind, data_level or '-', limit or '-')
+                cases.append((name, uri, params))
+
+    return cases
+
+def time_case(test_client, uri, params, headers, repeats):
+    """ Times repeats requests (after a warm up) - and counts the round-trips of one """
+
+    test_client.get(uri, params, **headers)
+
+    counter = RoundTripCounter()
+    with counter.counting():
+        response = test_client.get(uri, params, **headers)
+
+    times = []
+    stages = []
+    for i in range(repeats):
+        start = time.time()
+        response = test_client.get(uri, params, **headers)
+        times.append((time.time() - start) * 1000.0)
+        stages.append(parse_server_timing(response.get('Server-Timing')))
+
+    stage_names = sorted(set([name for timing in stages for name in timing]))
+    return {'status'      : response.status_code,
+            'bytes'       : len(response.content),
+            'min_ms'      : min(times),
+            'median_ms'   : median(times),
+            'max_ms'      : max(times),
+            'mongo_trips' : counter.mongo,
+            'sql_queries' : counter.sql,
+            'stages_ms'   : dict([(name, median([timing.get(name, 0.0) for timing in stages])) for name in stage_names])}
+
+def run_cases(summary, limits=DEFAULT_LIMITS, repeats=5, anonymous=False, log=None):
+    """ Runs every case against the seeded data. Returns the results, ready to save. """
+
+    headers = {}
+    if not anonymous:
+        user = User.objects.get(username='bench_user_000')
+        headers = {'HTTP_AUTHORIZATION' : 'ApiKey %s:%s' % (user.username, user.api_key.key)}
+
+    test_client = client.Client()
+    results = []
+
+    # The response cache would only time the cache, and the header carries the stages
+    with override_settings(RESPONSE_CACHE_ENABLED=False, SERVER_TIMING_HEADER='all'):
+        for name, uri, params in build_cases(summary, limits):
+            result = time_case(test_client, uri, params, headers, repeats)
+            result.update({'case' : name, 'uri' : uri, 'params' : params})
+            results.append(result)
+            if log:
+                log('%-55s %8.1f ms %6s mongo %4s sql %9s bytes' % (name, result['median_ms'], result['mongo_trips'],
+                                                                     result['sql_queries'], result['bytes']))
+
+    return {'run'      : datetime.datetime.utcnow().isoformat(),
+            'dataset'  : summary,
+            'settings' : {'comment_storage' : getattr(settings, 'COMMENT_STORAGE', 'embedded'),
+                          'anonymous'       : anonymous,
+                          'repeats'         : repeats},
+            'results'  : results}
+
+#------------------------------------------------------------------------
+
+def save_results(results, path):
+
+    with open(path, 'w') as results_file:
+        json.dump(results, results_file, indent=2, sort_keys=True)
+
+def compare_results(previous, current):
+    """ A line per case found in both runs: median time, round-trips and bytes, before -> after """
+
+    before = dict([(result['case'], result) for result in previous['results']])
+
+    lines = []
+    for result in current['results']:
+        old = before.get(result['case'])
+        if not old:
+            continue
+        change = 100.0 * (result['median_ms'] - old['median_ms']) / old['median_ms'] if old['median_ms'] else 0.0
+        lines.append('%-55s %8.1f -> %8.1f ms (%+5.0f%%)  mongo %s -> %s  sql %s -> %s  bytes %s -> %s' % (
+                     result['case'], old['median_ms'], result['median_ms'], change,
+                     old['mongo_trips'], result['mongo_trips'], old['sql_queries'], result['sql_queries'],
+                     old['bytes'], result['bytes']))
+    return lines
@@ -10,6 +10,7 @@ from django.conf import settings
 
 # Grab the serializer we're going to use to provide content to the front end.
 from config_app.serializers import CustomSerializer
+from ideaworks.json_encoding import wants_pretty_json
 
 # Basic auth + auth as it's only a readonly API
 from tastypie.authorization import Authorization
@@ -90,6 +91,15 @@ class ConfigResource(Resource):
 
     # ------------------------------------------------------------------------------------------------------------        
     
+    def serialize(self, request, data, format, options=None):
+        """ Passes ?pretty=1 through to the serializer, which otherwise produces compact json """
+        
+        options = options or {}
+        options['pretty'] = wants_pretty_json(request)
+        return super(ConfigResource, self).serialize(request, data, format, options)
+
+    # ------------------------------------------------------------------------------------------------------------        
+    
     def detail_uri_kwargs(self, bundle_or_obj):
         """ Grab the id of the specific resource """
         kwargs = {}
@@ -6,6 +6,8 @@ import json
 from django.core.serializers.json import DjangoJSONEncoder
 from tastypie.serializers import Serializer
 
+from ideaworks.json_encoding import compact_json
+
 class PrettyJSONSerializer(Serializer):
     """ Prettifies json output. Only really used before I moved onto custom serializer. Left in because
         it can be useful for debugging """
@@ -52,8 +54,11 @@ class CustomSerializer(Serializer):
     def to_json(self, data, options=None):
         """
         Dumps out the config content as json. Overriding existing function.
+        Compact by default - ?pretty=1 (options['pretty']) gives the indented, sorted version.
         """
         options = options or {}
+        if not options.get('pretty'):
+            return compact_json(self, data)
         data = self.to_simple(data, options)
         return json.dumps(data, cls=DjangoJSONEncoder,
                 sort_keys=True, ensure_ascii=False, indent=self.json_indent)
\ No newline at end of file
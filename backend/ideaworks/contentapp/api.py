@@ -23,11 +23,19 @@ from contentapp.authorization import PrivilegedAndSubmitterOnlyComments
 
 # Called from the project-level
 from ideaworks.generic_resources import BaseCorsResource
+from ideaworks.request_timing import timed
+from ideaworks.watermarks import touch_watermark, get_watermark
+from ideaworks.conditional_get import conditional_response, get_document_modified
+from ideaworks.response_cache import cached_response, invalidate_after_writes
+from ideaworks.feeds import cached_feed
+from ideaworks.pagination import KeysetPaginator
+from ideaworks.comment_store import StoredComments, comments_in_collection, dispatch_stored_comments
+from ideaworks.text_search import TextSearchQuerySet, get_search_terms
 
 # Functions worth storing in a different file.
 from api_functions import calculate_informal_time, get_contributors_info,get_top_level_pm_elements
-from api_functions import get_all_pms, get_max_pm
-from api_functions import count_builder, derive_snippet
+from api_functions import get_all_pms, get_max_pm, get_precomputed_pms
+from api_functions import count_builder, derive_snippet, derive_search_snippet, derive_last_modified, derive_document_max_pm, merge_pms
 
 # -----------------------------------------------------------------------------
 
@@ -153,8 +161,17 @@ class SiteContentResource(BaseCorsResource, resources.MongoEngineResource):
             an embedded resource"""
         
         if bundle.request.method != 'GET':
-            bundle.data['modified'] = datetime.datetime.utcnow()
+            bundle.data['modified'] = touch_watermark('site_content')
         return bundle
+
+# ------------------------------------------------------------------------------------------------------------        
+
+    def obj_delete(self, bundle, **kwargs):
+        """ Removing content changes the collection too """
+        
+        response = super(SiteContentResource, self).obj_delete(bundle, **kwargs)
+        touch_watermark('site_content')
+        return response
     
     # ------------------------------------------------------------------------------------------------------------        
 
@@ -200,12 +217,11 @@ class SiteContentResource(BaseCorsResource, resources.MongoEngineResource):
     def alter_list_data_to_serialize(self, request, data):
         """ Modify content just before serialized to output """             
 
-        # Try to get the modified timestamp. Except catches instance where no data
-        try:
-            idea_mod = documents.Content.objects.order_by('-modified')[0]['modified']
-            data['meta']['modified'] = idea_mod
-        except:
+        # The most recent change, kept up to date by the write paths. None means there's no data.
+        modified = get_watermark('site_content', rebuild=lambda: derive_last_modified(documents.Content))
+        if not modified:
             return data
+        data['meta']['modified'] = modified
             
         # Find the highest protective marking in the dataset
         if request.method == 'GET':
@@ -213,6 +229,26 @@ class SiteContentResource(BaseCorsResource, resources.MongoEngineResource):
             data['meta']['max_pm'] = get_max_pm(pms)    
         
         return data
+
+# ------------------------------------------------------------------------------------------------------------        
+
+    def get_list(self, request, **kwargs):
+        """ Serves anonymous requests from the shared response cache """
+        
+        return cached_response(request, 'site_content', self.determine_format(request),
+                               lambda: super(SiteContentResource, self).get_list(request, **kwargs))
+
+    def get_detail(self, request, **kwargs):
+        """ Serves anonymous requests from the shared response cache """
+        
+        return cached_response(request, 'site_content', self.determine_format(request),
+                               lambda: super(SiteContentResource, self).get_detail(request, **kwargs))
+
+    def wrap_view(self, view):
+        """ Writes invalidate the cached responses once handled """
+        
+        return invalidate_after_writes(super(SiteContentResource, self).wrap_view(view), 'site_content')
+
 #-----------------------------------------------------------------------------
 
 class FeedbackResource(BaseCorsResource, resources.MongoEngineResource):
@@ -223,12 +259,17 @@ class FeedbackResource(BaseCorsResource, resources.MongoEngineResource):
     class Meta:
         resource_name = 'feedback'
         queryset = documents.Feedback.objects.all()
+        # Only used to build meta.max_pm
+        excludes = ['max_pm']
         serializer = CustomSerializer()
         allowed_methods = ('get', 'post', 'put', 'delete')
         
         authentication = CustomApiKeyAuthentication()
         authorization = PrivilegedAndSubmitterOnly()
         
+        # Offset paging, or keyset paging with ?cursor=
+        paginator_class = KeysetPaginator
+        
         filtering = {'created'  : ['gt', 'gte', 'lt', 'lte'],
                      'modified' : ['gt', 'gte', 'lt', 'lte'],
                      'status'   : ['exact'],
@@ -292,8 +333,29 @@ class FeedbackResource(BaseCorsResource, resources.MongoEngineResource):
             an embedded resource"""
         
         if bundle.request.method != 'GET':
-            bundle.data['modified'] = datetime.datetime.utcnow()
+            bundle.data['modified'] = touch_watermark('feedback')
         return bundle
+
+    # ------------------------------------------------------------------------------------------------------------        
+
+    def obj_delete(self, bundle, **kwargs):
+        """ Removing feedback changes the collection too """
+        
+        response = super(FeedbackResource, self).obj_delete(bundle, **kwargs)
+        touch_watermark('feedback')
+        return response
+    
+    # ------------------------------------------------------------------------------------------------------------        
+
+    def apply_sorting(self, obj_list, options=None):
+        """ Orders ?q= searches by relevance, in the db - so that the ordering holds across pages """
+        
+        obj_list = super(FeedbackResource, self).apply_sorting(obj_list, options)
+        
+        if options and options.get('q'):
+            obj_list = TextSearchQuerySet(obj_list, options.get('q'))
+        
+        return obj_list
     
     # ------------------------------------------------------------------------------------------------------------        
 
@@ -310,6 +372,11 @@ class FeedbackResource(BaseCorsResource, resources.MongoEngineResource):
         # Lookup the user's info
         bundle = get_contributors_info(bundle)
         
+        # For ?q= searches, how well it matched and where
+        if bundle.request.GET.get('q') and hasattr(bundle.obj, 'search_score'):
+            bundle.data['search_score'] = bundle.obj.search_score
+            bundle.data['search_snippet'] = derive_search_snippet(bundle.data.get('body'), get_search_terms(bundle.request.GET['q']))
+        
         return bundle
 
 # ------------------------------------------------------------------------------------------------------------        
@@ -323,7 +390,7 @@ class FeedbackResource(BaseCorsResource, resources.MongoEngineResource):
             response_data = {'meta':{},'objects':[data]}
     
             # Add max PM into a newly created meta object
-            pms = get_all_pms(response_data['objects'], subdocs_to_check=['comments'], pm_name='protective_marking')
+            pms = get_precomputed_pms(response_data['objects'], subdocs_to_check=['comments'])
             response_data['meta']['max_pm'] = get_max_pm(pms)    
     
             # Get the modified time for this 1 object
@@ -339,22 +406,68 @@ class FeedbackResource(BaseCorsResource, resources.MongoEngineResource):
     def alter_list_data_to_serialize(self, request, data):
         """ Modify content just before serialized to output """             
 
-        # Try to get the modified timestamp. Except catches instance where no data
-        try:
-            idea_mod = documents.Feedback.objects.order_by('-modified')[0]['modified']
-            data['meta']['modified'] = idea_mod
-        except:
+        # The most recent change, kept up to date by the write paths. None means there's no data.
+        modified = get_watermark('feedback', rebuild=lambda: derive_last_modified(documents.Feedback))
+        if not modified:
             return data
+        data['meta']['modified'] = modified
             
         # Find the highest protective marking in the dataset
         if request.method == 'GET':
-            pms = get_all_pms(data['objects'], subdocs_to_check=['comments'], pm_name='protective_marking')
-            data['meta']['max_pm'] = get_max_pm(pms)    
+            with timed(request, 'max_pm'):
+                pms = get_precomputed_pms(data['objects'], subdocs_to_check=['comments'])
+                data['meta']['max_pm'] = get_max_pm(pms)    
         
         return data
     
     #-----------------------------------------------------------------------------
     
+    def get_list(self, request, **kwargs):
+        """ Answers conditional GETs from the collection watermark (meta.modified) before anything is loaded,
+            then serves anonymous requests from the shared response cache """
+        
+        modified = get_watermark('feedback', rebuild=lambda: derive_last_modified(documents.Feedback))
+        
+        def build_response():
+            return cached_response(request, 'feedback', self.determine_format(request),
+                                   lambda: self.get_list_by_format(request, modified, **kwargs))
+        
+        return conditional_response(request, modified, build_response)
+
+    def get_list_by_format(self, request, modified, **kwargs):
+        """ Feeds are cached until the collection changes (its watermark, modified, moves on) """
+        
+        if self.determine_format(request) == 'application/rss+xml':
+            return cached_feed(request, 'feedback', modified, lambda: super(FeedbackResource, self).get_list(request, **kwargs))
+        return super(FeedbackResource, self).get_list(request, **kwargs)
+
+    def get_detail(self, request, **kwargs):
+        """ Answers conditional GETs (for feedback the requester can read) from the feedback's own modified before it is loaded,
+            then serves anonymous requests from the shared response cache """
+        
+        def build_response():
+            return cached_response(request, 'feedback', self.determine_format(request),
+                                   lambda: super(FeedbackResource, self).get_detail(request, **kwargs))
+        
+        modified = get_document_modified(self, request, kwargs.get('pk'))
+        return conditional_response(request, modified, build_response)
+
+    def wrap_view(self, view):
+        """ Writes (including to sub-resources) invalidate the cached responses once handled """
+        
+        return invalidate_after_writes(super(FeedbackResource, self).wrap_view(view), 'feedback')
+    
+    #-----------------------------------------------------------------------------
+    
+    def dispatch_subresource(self, request, subresource_name, **kwargs):
+        """ Comments kept in their own collection are served (and paged) from there """
+        
+        if subresource_name == 'comments' and comments_in_collection():
+            return dispatch_stored_comments(documents.Feedback, StoredFeedbackCommentResource, self._meta.api_name, request, **kwargs)
+        return super(FeedbackResource, self).dispatch_subresource(request, subresource_name, **kwargs)
+    
+    #-----------------------------------------------------------------------------
+    
     def serialize(self, request, data, format, options=None):
         """
         Override of resource.serialize so that custom options
@@ -419,7 +532,13 @@ class FeedbackCommentResource(BaseCorsResource, resources.MongoEngineResource):
             is edited."""
         
         if bundle.request.method != 'GET':
-            bundle.data['modified'] = datetime.datetime.utcnow()
+            now = touch_watermark('feedback')
+            bundle.data['modified'] = now
+            
+            # Also change the parent, so its modified covers its comments
+            m = re.match(re.compile('.*/(?P<doc_id>[a-zA-Z0-9]{24})/.*'), bundle.request.path)
+            if m:
+                documents.Feedback.objects(id=m.groupdict()['doc_id']).update(**{'set__modified': now})
         return bundle
 
 # ------------------------------------------------------------------------------------------------------------        
@@ -453,7 +572,9 @@ class FeedbackCommentResource(BaseCorsResource, resources.MongoEngineResource):
         m = re.match(regExp, bundle.request.path).groupdict()
         
         # Decrement the comment count of the host document
-        documents.Feedback.objects.get(id=m['doc_id']).update(**{'inc__comment_count': -1})
+        now = datetime.datetime.utcnow()
+        documents.Feedback.objects.get(id=m['doc_id']).update(**{'inc__comment_count': -1, 'set__modified': now})
+        touch_watermark('feedback', now)
         
         return super(FeedbackCommentResource, self).obj_delete(bundle, **{'pk':m['comment_id']})
         
@@ -517,6 +638,14 @@ class FeedbackCommentResource(BaseCorsResource, resources.MongoEngineResource):
         else:
             return content_types[format]
         
+# ------------------------------------------------------------------------------------------------------------        
+     
+    def hydrate_body_snippet(self, bundle):
+        """ The snippet is derived as the comment is written, rather than on every read """
+
+        bundle.data['body_snippet'] = derive_snippet(bundle.data.get('body'))
+        return bundle
+
 # ------------------------------------------------------------------------------------------------------------        
      
     def dehydrate(self, bundle):
@@ -526,10 +655,26 @@ class FeedbackCommentResource(BaseCorsResource, resources.MongoEngineResource):
         bundle.data['informal_created'] = calculate_informal_time(bundle.data['created'])
         bundle.data['informal_modified'] = calculate_informal_time(bundle.data['modified'])
 
-        if bundle.data.has_key('body'):
-            bundle.data['body_snippet'] = derive_snippet(bundle.data['body'])
-
         # Lookup the user's info
         bundle = get_contributors_info(bundle)
         return bundle
-            
\ No newline at end of file
+            
+
+#-----------------------------------------------------------------------------
+
+class StoredFeedbackCommentResource(StoredComments, FeedbackCommentResource):
+    """ Feedback comments kept in their own collection (COMMENT_STORAGE = 'collection'),
+        paged through at /feedback/<id>/comments/. Otherwise as FeedbackCommentResource. """
+    
+    parent_class = documents.Feedback
+    parent_name = 'feedback'
+    derive_max_pm = staticmethod(derive_document_max_pm)
+    merge_pms = staticmethod(merge_pms)
+    
+    class Meta(FeedbackCommentResource.Meta):
+        queryset = documents.StoredComment.objects.all()
+        object_class = documents.StoredComment
+        excludes = ['parent_id']
+        ordering = ['created', 'modified']
+        # Offset paging, or keyset paging with ?cursor=
+        paginator_class = KeysetPaginator
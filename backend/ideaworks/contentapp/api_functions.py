@@ -8,6 +8,9 @@ from HTMLParser import HTMLParser   #Used to create a non-marked up snippet
 from django.contrib.auth.models import User
 
 from ideaworks.generic_resources import BaseCorsResource
+from ideaworks.contributors import get_request_resolver
+from ideaworks.comment_store import comments_in_collection
+from ideaworks.text_search import search_window, highlight_terms
 
 # Contentapp objects, authentication class and data output serializer
 import contentapp.documents as documents
@@ -52,23 +55,16 @@ def get_top_level_pm_elements(bundle):
 #--------------------------------------------------------------------------------
 
 def get_contributors_info(bundle, contributor=None):
-    """ Get the user info for a specific contributor"""
-    
+    """ Get the user info for a specific contributor.
+        The name is resolved lazily, together with every other contributor
+        on the page, by the request's ContributorNameResolver. """
     
     # Get the id of the user
     if not contributor:
         contributor = bundle.data['user']
     
-    # Get the user object
-    user_obj = None
-    
-    try:
-        user_obj = User.objects.get(username=contributor)
-    except:
-        user_obj = User.objects.get(email=contributor)
-    
-    if user_obj:
-        bundle.data['contributor_name'] = user_obj.first_name.title() + ' ' + user_obj.last_name.title()
+    resolver = get_request_resolver(getattr(bundle, 'request', None))
+    bundle.data['contributor_name'] = resolver.name_for(contributor)
     
     return bundle
 
@@ -121,8 +117,8 @@ def get_sub_field(object, field_name):
             
 #--------------------------------------------------------------------------------
 
-def get_max_pm(pm_docs):
-    """ Get the maximum protective marking elements """
+def merge_pms(pm_docs):
+    """ Merge protective markings into a single marking covering all of them """
 
     max_class_rank = -1
     max_class_full = 'PUBLIC'
@@ -167,8 +163,10 @@ def get_max_pm(pm_docs):
         codewords_short += get_sub_field(doc, 'codewords_short')
         
         # Concatenate the descriptors - assumed not mutually exclusive
-        if get_sub_field(doc, 'descriptor') and get_sub_field(doc, 'descriptor').upper() not in descriptors:
-            descriptors.append(get_sub_field(doc, 'descriptor'))
+        # (a merged marking holds them comma separated, so split those back out)
+        for descriptor in (get_sub_field(doc, 'descriptor') or '').split(','):
+            if descriptor and descriptor.upper() not in descriptors:
+                descriptors.append(descriptor)
     
     #TODO: Just joining the descriptors together rather than handling them properly as a list
     descriptors_out = ','.join(descriptors)
@@ -183,7 +181,55 @@ def get_max_pm(pm_docs):
                                          codewords_short               = list(set(codewords_short)),
                                          descriptor                    = descriptors_out)
     
-    return json.loads(max_pm.to_json())
+    return max_pm
+
+#--------------------------------------------------------------------------------
+
+def get_max_pm(pm_docs):
+    """ Get the maximum protective marking elements """
+    
+    return json.loads(merge_pms(pm_docs).to_json())
+
+#--------------------------------------------------------------------------------
+
+def derive_document_max_pm(doc, subdocs_to_check=['comments']):
+    """ The effective protective marking of a document: its own marking plus
+        those of any listed sub-documents (i.e. comments). Stored against the
+        document at write time so reads don't need to walk the sub-documents. """
+    
+    pm_docs = []
+    if doc.protective_marking:
+        pm_docs.append(doc.protective_marking)
+    
+    for fld in subdocs_to_check:
+        for sub_object in getattr(doc, fld, None) or []:
+            if sub_object.protective_marking:
+                pm_docs.append(sub_object.protective_marking)
+    
+    # Comments kept in their own collection rather than embedded
+    if 'comments' in subdocs_to_check and doc.pk and comments_in_collection():
+        for comment in documents.StoredComment.objects(parent_id=doc.pk).only('protective_marking'):
+            if comment.protective_marking:
+                pm_docs.append(comment.protective_marking)
+    
+    return merge_pms(pm_docs)
+
+#--------------------------------------------------------------------------------
+
+def get_precomputed_pms(bundles, subdocs_to_check=[], pm_name='protective_marking'):
+    """ Gets the stored effective protective marking of each object.
+        Falls back to walking the object (and its sub-documents) for anything
+        saved before the effective marking was stored. """
+    
+    pm_docs = []
+    for bundle in bundles:
+        max_pm = getattr(getattr(bundle, 'obj', None), 'max_pm', None)
+        if max_pm:
+            pm_docs.append(max_pm)
+        else:
+            pm_docs += get_all_pms([bundle], subdocs_to_check=subdocs_to_check, pm_name=pm_name)
+    
+    return pm_docs
 
 #--------------------------------------------------------------------------------
 
@@ -226,6 +272,17 @@ def calculate_informal_time(time_stamp):
         informal_format = time_stamp.strftime("%d %b '%y")
      
     return informal_format
+
+#--------------------------------------------------------------------------------
+
+def derive_last_modified(document_class):
+    """ Derives the most recent modified timestamp the slow way.
+        Only used to seed the collection watermark when there isn't one yet. """
+    
+    try:
+        return document_class.objects.order_by('-modified')[0]['modified']
+    except IndexError:
+        return None
     
 # ----------------------------------------------------------------------------------
 
@@ -271,4 +328,14 @@ def derive_snippet(text_html, chrs=240):
         
     return text
 
+def derive_search_snippet(text_html, terms, chrs=240):
+    """ A snippet as derive_snippet, but from around the first search term matched
+        and with the terms highlighted (so escaped, as it holds markup) """
+    
+    if not text_html or text_html == '':
+        return text_html
+    
+    stripped_text = strip_tags(text_html.replace('\n', ''))
+    return highlight_terms(derive_snippet(search_window(stripped_text, terms, chrs), chrs), terms)
+
     
@@ -3,6 +3,7 @@
 # Author: Rich Brantingham
 
 import re
+from mongoengine.queryset import Q
 from tastypie.authorization import Authorization
 from tastypie.exceptions import Unauthorized
 import contentapp.documents as documents
@@ -99,20 +100,15 @@ class PrivilegedAndSubmitterOnly(Authorization):
     """
     
     def read_list(self, object_list, bundle):
-        """ Public - all read, otherwise just creator and staff """
+        """ Public - all read, otherwise just creator and staff.
+            Applied as a query predicate so that sorting and pagination
+            of the remaining objects happens in the database. """
 
-        allowed = []
+        if bundle.request.user.is_staff == True or bundle.request.user.is_superuser == True:
+            return object_list
 
-        for obj in object_list:
-            
-            if obj['public'] == True:
-                allowed.append(obj)
-            else:
-                if str(obj.user) == str(bundle.request.user):
-                    allowed.append(obj)
-                elif bundle.request.user.is_staff == True or bundle.request.user.is_superuser == True:
-                    allowed.append(obj)
-        return allowed
+        # Feedback saved before 'public' existed is public (the field's default)
+        return object_list.filter(Q(public__ne=False) | Q(user=str(bundle.request.user)))
 
     def read_detail(self, object_list, bundle):
 
@@ -3,7 +3,7 @@
 # Author: Rich Brantingham
 
 import datetime
-from mongoengine import Document, BooleanField, IntField, EmbeddedDocument, DateTimeField, ListField, StringField, EmbeddedDocumentField
+from mongoengine import Document, BooleanField, IntField, EmbeddedDocument, DateTimeField, ListField, StringField, EmbeddedDocumentField, ObjectIdField
 #TODO: How to implement a sort by protective marking?
 
 class InheritableDocument(Document):
@@ -50,10 +50,32 @@ class FeedbackComment(InheritableEmbeddedDocument):
     created                    = DateTimeField(help_text="The date and time of when the object was created.", default=datetime.datetime.utcnow)
     modified                   = DateTimeField(help_text="When the comment or dependent data was last modified.", default=datetime.datetime.utcnow)
     body                       = StringField(max_length=5000, help_text="Main body of the text, limited to 1000 chrs.")
+    body_snippet               = StringField(help_text="The body without markup, truncated by word. Set as the comment is written.")
     protective_marking         = EmbeddedDocumentField(ProtectiveMarking)
     
 #------------------------------------------------------------------------
 
+class StoredComment(Document):
+    """ A comment on feedback, kept in a collection of its own rather than embedded
+        in the feedback (COMMENT_STORAGE = 'collection' - see ideaworks.comment_store) """
+    
+    parent_id                  = ObjectIdField(required=True, help_text="The feedback this comment is on.")
+    type                       = StringField(help_text='The type of comment to allow for filtering.', required=False)
+    user                       = StringField(help_text="ID of the user submitting the comment")
+    title                      = StringField(max_length=200, help_text="The title of the comment, limited to 100 chrs.")
+    created                    = DateTimeField(help_text="The date and time of when the object was created.", default=datetime.datetime.utcnow)
+    modified                   = DateTimeField(help_text="When the comment or dependent data was last modified.", default=datetime.datetime.utcnow)
+    body                       = StringField(max_length=5000, help_text="Main body of the text, limited to 1000 chrs.")
+    body_snippet               = StringField(help_text="The body without markup, truncated by word. Set as the comment is written.")
+    protective_marking         = EmbeddedDocumentField(ProtectiveMarking)
+    
+    # A page of one feedback's comments, oldest first, with _id to break ties for keyset paging
+    meta = {'collection' : 'feedback_comments',
+            'db_alias'   : 'default',
+            'indexes'    : [{'fields' : ['parent_id', 'created', 'id']}]}
+    
+#------------------------------------------------------------------------
+
 class Content(InheritableDocument):
     """ A Content object which stores different types of staff-defined static content """
     
@@ -68,8 +90,16 @@ class Content(InheritableDocument):
     protective_marking  = EmbeddedDocumentField(ProtectiveMarking, required=True)
     index               = BooleanField(help_text='Whether this is the index page for this type of site content.')
     
+    # Site content is looked up by type (and its index page), and listed newest first
+    meta = {'indexes' : [{'fields' : ['type', 'index']},
+                         {'fields' : ['status', 'created', 'id']}]}
+    
 #------------------------------------------------------------------------
 
+# The fields that ?q= searches on feedback, and how much a match in each counts. Mongoengine can't
+# declare text indexes, so this one is created by the manage_indexes management command.
+FEEDBACK_TEXT_INDEX_WEIGHTS = {'title' : 10, 'summary' : 5, 'body' : 1}
+
 class Feedback(InheritableDocument):
     """ A Content object extended to include feedback-specific things """
     
@@ -87,5 +117,27 @@ class Feedback(InheritableDocument):
     
     comments            = ListField(EmbeddedDocumentField(FeedbackComment))
     comment_count       = IntField(help_text='number of comments associated with this item.')
+    max_pm              = EmbeddedDocumentField(ProtectiveMarking, help_text='The highest protective marking across the feedback and its comments. Maintained on save.')
+
+    # Staff see everything, everyone else the public feedback and their own - newest first,
+    # with _id to break ties for keyset paging
+    meta = {'indexes' : [{'fields' : ['created', 'id']},
+                         {'fields' : ['public', 'created', 'id']},
+                         {'fields' : ['user', 'created', 'id']}]}
+
+    def clean(self):
+        """ Keeps the effective protective marking (this feedback plus its comments)
+            up to date whenever the feedback is saved - including when comments are
+            added, edited or removed, which save the whole document. """
+        
+        # Imported here because api_functions depends on these documents
+        from api_functions import derive_document_max_pm
+        self.max_pm = derive_document_max_pm(self)
+
+    def delete(self, *args, **kwargs):
+        """ Also removes any comments stored apart from the feedback """
+        
+        super(Feedback, self).delete(*args, **kwargs)
+        StoredComment.objects(parent_id=self.pk).delete()
 
 
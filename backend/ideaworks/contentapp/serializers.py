@@ -14,6 +14,9 @@ from django.conf import settings
 
 from tastypie.serializers import Serializer
 
+from ideaworks.json_encoding import compact_json
+from ideaworks.feeds import get_feed_item
+
 class PrettyJSONSerializer(Serializer):
     json_indent = 2
 
@@ -37,6 +40,8 @@ class CustomSerializer(Serializer):
         'csv': 'text/csv',
     }
     json_indent = 2
+    # Keys this app's feed items in the shared feed item cache
+    feed_name = 'feedback'
 
     def get_front_end_url(self, resource_id):
         """ Retrieves the front-end url for a specific idea/project/comment"""
@@ -68,40 +73,47 @@ class CustomSerializer(Serializer):
         #summary += text
         #return summary
 
-    def to_rss(self, data, options=None):
+    def build_feed_item(self, item):
+        """ The feed fields for one (dehydrated) item """
         
-        if not options or options == {}:
-            options['title']       = 'default feed title'
-            options['link']        = 'default feed link'
-            options['description'] = 'default feed description'
-            
-        data = self.to_simple(data, options)
+        # Dates only get here as strings if the data has already been simplified
+        modified = item['modified']
+        if not isinstance(modified, datetime.datetime):
+            modified = self.get_iso_dtg(modified)
         
+        return {'unique_id'   : unicode(item['id']),
+                'title'       : self.format_text(item['classification_short'], item['title']),
+                'description' : self.format_text(item['classification_short'], item['body']),
+                'link'        : self.get_front_end_url(item['id']),
+                'pubdate'     : modified,
+                'author_name' : unicode(item['contributor_name'])}
+
+    def to_rss(self, data, options=None):
+        
+        options = options or {}
         #*****************************************************
         # Subclass the serialize function in your api
         # to build options which get passed into here.
         #*****************************************************
-                
+
         # Feed level info
         feed = feedgenerator.Atom1Feed(
-            title       = unicode(options['title']),
-            link        = unicode(options['link']),
-            description = unicode(options['description'])
+            title       = unicode(options.get('title', 'default feed title')),
+            link        = unicode(options.get('link', 'default feed link')),
+            description = unicode(options.get('description', 'default feed description'))
         )
         
-        #TODO: Add in classification abbreviation into the feed
+        # Each item's fields are only built once per version (id + modified) of the document
         for item in data['objects']:
-            feed.add_item(unique_id     = item['id'],
-                          title         = self.format_text(item['classification_short'], item['title']),
-                          description   = self.format_text(item['classification_short'], item['body']),
-                          link          = self.get_front_end_url(item['id']),
-                          pubdate       = self.get_iso_dtg(item['modified']),
-                          author_name   = item['contributor_name'])
+            feed.add_item(**get_feed_item(self.feed_name, item, self.build_feed_item))
                         
         return feed.writeString('utf-8')
 
     def to_json(self, data, options=None):
+        """ Compact json by default. ?pretty=1 (options['pretty']) gives the indented, sorted version """
         options = options or {}
+        if not options.get('pretty'):
+            return compact_json(self, data)
         data = self.to_simple(data, options)
         return json.dumps(data, cls=DjangoJSONEncoder,
                 sort_keys=True, ensure_ascii=False, indent=self.json_indent)
@@ -22,15 +22,29 @@ from ideasapp.authorization import StatusAuthorization
 
 # Project-level objects
 from ideaworks.generic_resources import BaseCorsResource
+from ideaworks.request_timing import timed
+from ideaworks.watermarks import touch_watermark, get_watermark
+from ideaworks.conditional_get import conditional_response, get_document_modified
+from ideaworks.response_cache import cached_response, invalidate_after_writes
+from ideaworks.csv_export import csv_response, get_csv_fields
+from ideaworks.feeds import cached_feed
+from ideaworks.tag_ranking import TagRankedQuerySet
+from ideaworks.text_search import TextSearchQuerySet, get_search_terms
+from ideaworks.pagination import KeysetPaginator
+from ideaworks.comment_store import StoredComments, comments_in_collection, dispatch_stored_comments
+from ideaworks.votes import set_user_votes, remove_targets_votes
+from ideaworks.bulk_create import BulkCreate
+from ideaworks.bulk_moderation import BulkModeration
 
 # Access the serializer for these objects
 from ideasapp.serializers import CustomSerializer
 import ideasapp.documents as documents
 
-from api_functions import get_all_pms, get_max_pm, filter_by_data_level,tag_based_filtering, filter_by_data_level, calculate_informal_time
-from api_functions import derive_snippet, get_contributors_info, count_builder, vote_score
-from api_functions import get_user_vote_status, get_top_level_pm_elements
-from api_functions import cleanup_tags
+from api_functions import get_all_pms, get_max_pm, get_precomputed_pms, filter_by_data_level,tag_based_filtering, filter_by_data_level, calculate_informal_time
+from api_functions import derive_snippet, derive_search_snippet, get_contributors_info, count_builder, vote_score
+from api_functions import get_top_level_pm_elements, get_data_level_projection, wants_field
+from api_functions import cleanup_tags, derive_last_modified, apply_vote, derive_document_max_pm, merge_pms
+from api_functions import CSV_FIELDS, CSV_DERIVED_FIELDS, USER_VOTED_VALUES, EMBEDDED_VOTE_LISTS
 
 #-----------------------------------------------------------------------------
 
@@ -54,15 +68,18 @@ class CommentResource(BaseCorsResource, resources.MongoEngineResource):
         """ Updates the comment modified timestamp field if the comment
             is edited."""
 
+        now = datetime.datetime.utcnow()
+
         # Also change the parent if there is one for this call
         regExp = re.compile('.*/(?P<doc_id>[a-zA-Z0-9]{24})/.*')
         m = re.match(regExp, bundle.request.path).groupdict()
         if m:
-            documents.Idea.objects.get(id=m['doc_id']).update(**{'set__modified': datetime.datetime.utcnow()})
+            documents.Idea.objects.get(id=m['doc_id']).update(**{'set__modified': now})
+            touch_watermark('idea', now)
         
         # Change the modified date for all calls
         if bundle.request.method != 'GET':
-            bundle.data['modified'] = datetime.datetime.utcnow()
+            bundle.data['modified'] = now
 
         return bundle
 
@@ -109,7 +126,9 @@ class CommentResource(BaseCorsResource, resources.MongoEngineResource):
         m = re.match(regExp, bundle.request.path).groupdict()
         
         # Decrement the comment count of the host document
-        documents.Idea.objects.get(id=m['doc_id']).update(**{'inc__comment_count': -1})
+        now = datetime.datetime.utcnow()
+        documents.Idea.objects.get(id=m['doc_id']).update(**{'inc__comment_count': -1, 'set__modified': now})
+        touch_watermark('idea', now)
         
         return super(CommentResource, self).obj_delete(bundle, **{'pk':m['comment_id']})
         
@@ -185,6 +204,14 @@ class CommentResource(BaseCorsResource, resources.MongoEngineResource):
         else:
             return content_types[format]
         
+# ------------------------------------------------------------------------------------------------------------        
+     
+    def hydrate_body_snippet(self, bundle):
+        """ The snippet is derived as the comment is written, rather than on every read """
+        
+        bundle.data['body_snippet'] = derive_snippet(bundle.data.get('body'))
+        return bundle
+
 # ------------------------------------------------------------------------------------------------------------        
      
     def dehydrate(self, bundle):
@@ -194,9 +221,6 @@ class CommentResource(BaseCorsResource, resources.MongoEngineResource):
         bundle.data['informal_created'] = calculate_informal_time(bundle.data['created'])
         bundle.data['informal_modified'] = calculate_informal_time(bundle.data['modified'])
         
-        if bundle.data.has_key('body'):
-            bundle.data['body_snippet'] = derive_snippet(bundle.data['body'])
-        
         # Lookup the user's info
         bundle = get_contributors_info(bundle)
         
@@ -204,7 +228,33 @@ class CommentResource(BaseCorsResource, resources.MongoEngineResource):
 
 #-----------------------------------------------------------------------------
 
-class IdeaResource(BaseCorsResource, resources.MongoEngineResource):
+class StoredCommentResource(StoredComments, CommentResource):
+    """ Idea comments kept in their own collection (COMMENT_STORAGE = 'collection'),
+        paged through at /idea/<id>/comments/. Otherwise as CommentResource. """
+    
+    parent_class = documents.Idea
+    parent_name = 'idea'
+    derive_max_pm = staticmethod(derive_document_max_pm)
+    merge_pms = staticmethod(merge_pms)
+    
+    class Meta(CommentResource.Meta):
+        queryset = documents.StoredComment.objects.all()
+        object_class = documents.StoredComment
+        excludes = ['parent_id']
+        ordering = ['created', 'modified']
+        # Offset paging, or keyset paging with ?cursor=
+        paginator_class = KeysetPaginator
+
+#-----------------------------------------------------------------------------
+
+class IdeaResource(BulkCreate, BulkModeration, BaseCorsResource, resources.MongoEngineResource):
+    
+    # A PATCH to the list creates a batch of ideas, and staff can change the status of many
+    # at /idea/moderate/ - see ideaworks/bulk_create.py and ideaworks/bulk_moderation.py
+    source_name = 'idea'
+    add_batch_tag_counts = staticmethod(documents.add_batch_tag_counts)
+    derive_status_change = staticmethod(documents.derive_status_change)
+    apply_tag_count_changes = staticmethod(documents.apply_tag_count_changes)
     
     protective_marking  = mongo_fields.EmbeddedDocumentField(embedded='ideasapp.api.ProtectiveMarkingResource', attribute='protective_marking', help_text='protective marking of this idea, comprising classification, descriptor, codewords and national caveats.', null=True)
     comments            = mongo_fields.EmbeddedListField(of='ideasapp.api.CommentResource', attribute='comments', full=True, null=True)
@@ -214,8 +264,10 @@ class IdeaResource(BaseCorsResource, resources.MongoEngineResource):
     class Meta:
         queryset = documents.Idea.objects.all()
         resource_name = 'idea'
+        # Only used to build meta.max_pm
+        excludes = ['max_pm']
         # What is permitted at the list level and at the single instance level
-        list_allowed_methods = ['get', 'post', 'delete', 'put']
+        list_allowed_methods = ['get', 'post', 'delete', 'put', 'patch']
         detailed_allowed_methods = ['get', 'post', 'put', 'delete', 'patch']
         
         # Setup to default print pretty - mainly for debuggin
@@ -225,6 +277,8 @@ class IdeaResource(BaseCorsResource, resources.MongoEngineResource):
         authorization = StatusAuthorization()
         
         max_limit = None
+        # Offset paging, or keyset paging with ?cursor=
+        paginator_class = KeysetPaginator
 
         filtering = {'created'        : ['gt', 'gte', 'lt', 'lte'],
                      'modified'       : ['gt', 'gte', 'lt', 'lte'],
@@ -286,8 +340,8 @@ class IdeaResource(BaseCorsResource, resources.MongoEngineResource):
 
 # ------------------------------------------------------------------------------------------------------------        
 
-    def obj_create(self, bundle, **kwargs):
-        """ Modifies the content before submission """
+    def prepare_create(self, bundle):
+        """ Modifies the content of a new idea before submission (singly or in a batch) """
         
         # Add in the user
         bundle.data['user'] = bundle.request.user.username
@@ -303,7 +357,13 @@ class IdeaResource(BaseCorsResource, resources.MongoEngineResource):
                 
         # Finally build the score
         bundle.data['vote_score'] = vote_score(bundle.data['like_count'], bundle.data['dislike_count'])
-         
+        
+        return bundle
+
+    def obj_create(self, bundle, **kwargs):
+        """ Modifies the content before submission """
+        
+        bundle = self.prepare_create(bundle)
         return super(IdeaResource, self).obj_create(bundle)
 
     # No obj_update here because updates to lists of embedded docs don't trigger that function.
@@ -329,11 +389,13 @@ class IdeaResource(BaseCorsResource, resources.MongoEngineResource):
         
         # Don't apply the meta object if it's anything but GET
         if request.method == 'GET':
+            set_user_votes(request, [data], 'user_voted', USER_VOTED_VALUES, EMBEDDED_VOTE_LISTS)
+            
             # Add a meta element for the single item response
             response_data = {'meta':{},'objects':[data]}
     
             # Add max PM into a newly created meta object
-            pms = get_all_pms(response_data['objects'],subdocs_to_check=['comments'],pm_name='protective_marking')
+            pms = get_precomputed_pms(response_data['objects'], subdocs_to_check=['comments'])
             response_data['meta']['max_pm'] = get_max_pm(pms)    
     
             # Get the modified time for this 1 object
@@ -353,37 +415,21 @@ class IdeaResource(BaseCorsResource, resources.MongoEngineResource):
         
         """ Modify content just before serialized to output """             
 
-        # Try to get the modified timestamp. Except catches instance where no data
-        try:
-            idea_mod = documents.Idea.objects.order_by('-modified')[0]['modified']
-        except:
+        # The requesting user's votes on this page, in one query
+        with timed(request, 'user_votes'):
+            set_user_votes(request, data['objects'], 'user_voted', USER_VOTED_VALUES, EMBEDDED_VOTE_LISTS)
+
+        # The most recent change to any idea/comment/vote, kept up to date by the write paths.
+        # No watermark (and nothing to rebuild one from) means there's no data.
+        modified = get_watermark('idea', rebuild=lambda: derive_last_modified(documents.Idea))
+        if not modified:
             return data
+        data['meta']['modified'] = modified
         
-        # Retrieve all comment modified timestamps (idea, comments)
-        res = documents.Idea._get_collection().aggregate([
-            { "$project" : {"_id" : 0, "comments" : 1}},
-            { "$unwind" : "$comments" },
-            { "$project" : {"modified" : "$comments.modified"}},
-            { "$sort" : {"modified" : -1}},
-            { "$limit" : 1}
-        ])['result']
-        
-        # In the event that there are no comments, chuck in an old date to guarantee the idea mod date wins
-        if res:
-            comments_mod = res[0]['modified']
-        else:
-            comments_mod = datetime.datetime(1970,1,1)
-            
-        # Assign the meta-level modified datetime to the most recent comment/idea modified datetime
-        data['meta']['modified'] = max([idea_mod, comments_mod])
-        
-        # Tag-based filtering
-        if request.method == 'GET' and request.GET.get('tags__in'):
-            data = tag_based_filtering(request, data)
-        
-        # Find the highest protective marking in the dataset
-        pms = get_all_pms(data['objects'], subdocs_to_check=['comments'], pm_name='protective_marking')
-        data['meta']['max_pm'] = get_max_pm(pms)    
+        # Find the highest protective marking in the dataset (one precomputed marking per idea)
+        with timed(request, 'max_pm'):
+            pms = get_precomputed_pms(data['objects'], subdocs_to_check=['comments'])
+            data['meta']['max_pm'] = get_max_pm(pms)    
 
         # Filter out the meta and objects content based on the data_level
         if request.method == 'GET':
@@ -393,6 +439,99 @@ class IdeaResource(BaseCorsResource, resources.MongoEngineResource):
 
     # ------------------------------------------------------------------------------------------------------------        
 
+    def get_list(self, request, **kwargs):
+        """ Answers conditional GETs from the collection watermark (meta.modified) before anything is loaded,
+            then serves anonymous requests from the shared response cache """
+        
+        modified = get_watermark('idea', rebuild=lambda: derive_last_modified(documents.Idea))
+        
+        def build_response():
+            return cached_response(request, 'idea', self.determine_format(request),
+                                   lambda: self.get_list_by_format(request, modified, **kwargs))
+        
+        return conditional_response(request, modified, build_response)
+
+    def get_detail(self, request, **kwargs):
+        """ Answers conditional GETs (for ideas the requester can read) from the idea's own modified before it is loaded,
+            then serves anonymous requests from the shared response cache """
+        
+        def build_response():
+            return cached_response(request, 'idea', self.determine_format(request),
+                                   lambda: super(IdeaResource, self).get_detail(request, **kwargs))
+        
+        modified = get_document_modified(self, request, kwargs.get('pk'))
+        return conditional_response(request, modified, build_response)
+
+    def get_list_by_format(self, request, modified, **kwargs):
+        """ Feeds are cached until the collection changes (its watermark, modified, moves on) and
+            csv exports are streamed from the db, rather than going through the usual list pipeline """
+        
+        format = self.determine_format(request)
+        if format == 'application/rss+xml':
+            return cached_feed(request, 'idea', modified, lambda: super(IdeaResource, self).get_list(request, **kwargs))
+        if format != 'text/csv':
+            return super(IdeaResource, self).get_list(request, **kwargs)
+        
+        # The same filtering, authorization and sorting as a list GET
+        base_bundle = self.build_bundle(request=request)
+        objects = self.obj_get_list(bundle=base_bundle, **self.remove_api_resource_names(kwargs))
+        objects = self.apply_sorting(objects, options=request.GET)
+        
+        fields = get_csv_fields(request, documents.Idea, CSV_FIELDS, CSV_DERIVED_FIELDS)
+        return csv_response(request, documents.Idea, objects, fields, CSV_DERIVED_FIELDS)
+
+    def wrap_view(self, view):
+        """ Writes (including to sub-resources) invalidate the cached responses once handled """
+        
+        return invalidate_after_writes(super(IdeaResource, self).wrap_view(view), 'idea')
+
+    # ------------------------------------------------------------------------------------------------------------        
+
+    def dispatch_subresource(self, request, subresource_name, **kwargs):
+        """ Comments kept in their own collection are served (and paged) from there """
+        
+        if subresource_name == 'comments' and comments_in_collection():
+            return dispatch_stored_comments(documents.Idea, StoredCommentResource, self._meta.api_name, request, **kwargs)
+        return super(IdeaResource, self).dispatch_subresource(request, subresource_name, **kwargs)
+
+    # ------------------------------------------------------------------------------------------------------------        
+
+    def get_object_list(self, request):
+        """ Only loads the fields needed for the requested data_level,
+            so that e.g. data_level=min never reads the comments or votes """
+        
+        object_list = super(IdeaResource, self).get_object_list(request)
+        
+        projection = get_data_level_projection(request, documents.Idea)
+        if projection:
+            object_list = object_list.only(*projection)
+        
+        return object_list
+
+    # ------------------------------------------------------------------------------------------------------------        
+
+    def apply_sorting(self, obj_list, options=None):
+        """ Orders ?q= searches by relevance, and ranks ?tags__in= queries by the number
+            of matching tags, in the db - so that the ordering holds across pages """
+        
+        obj_list = super(IdeaResource, self).apply_sorting(obj_list, options)
+        
+        if options and options.get('q'):
+            obj_list = TextSearchQuerySet(obj_list, options.get('q'))
+        
+        elif options and options.get('tags__in'):
+            if hasattr(options, 'getlist'):
+                order_by = options.getlist('order_by')
+            else:
+                order_by = options.get('order_by')
+                if not isinstance(order_by, (list, tuple)):
+                    order_by = [order_by]
+            obj_list = TagRankedQuerySet(obj_list, options.get('tags__in').split(','), order_by)
+        
+        return obj_list
+
+    # ------------------------------------------------------------------------------------------------------------        
+
     def determine_format(self, request):
         """ Override the default format, so that format=json is not required """
     
@@ -431,30 +570,71 @@ class IdeaResource(BaseCorsResource, resources.MongoEngineResource):
             an embedded resource"""
         
         if bundle.request.method != 'GET':
-            bundle.data['modified'] = datetime.datetime.utcnow()
+            # A batch moves the watermark once, after it has been written
+            bundle.data['modified'] = getattr(bundle, 'batch_modified', None) or touch_watermark('idea')
         return bundle
 
     # ------------------------------------------------------------------------------------------------------------        
 
+    def obj_delete(self, bundle, **kwargs):
+        """ Removing an idea changes the collection too """
+        
+        response = super(IdeaResource, self).obj_delete(bundle, **kwargs)
+        touch_watermark('idea')
+        return response
+
+    def obj_delete_list(self, bundle, **kwargs):
+        """ Removing ideas changes the collection too. A queryset delete doesn't go through
+            Idea.delete(), so the ideas' tag counts, stored comments and votes are updated here in bulk. """
+        
+        objects_to_delete = self.obj_get_list(bundle=bundle, **kwargs)
+        deletable_objects = self.authorized_delete_list(objects_to_delete, bundle)
+        
+        if hasattr(deletable_objects, 'delete'):
+            ids = list(deletable_objects.scalar('id'))
+            # Count the tags being removed before they go
+            changes = documents.derive_tag_removal(documents.Idea, {'_id' : {'$in' : ids}})
+            documents.Idea.objects(pk__in=ids).delete()
+            documents.apply_tag_count_changes('idea', changes)
+            documents.StoredComment.objects(parent_id__in=ids).delete()
+            remove_targets_votes(ids)
+        else:
+            for authed_obj in deletable_objects:
+                authed_obj.delete()
+        
+        touch_watermark('idea')
+
+    # ------------------------------------------------------------------------------------------------------------        
+
     def dehydrate(self, bundle):
-        """ Dehydrate - data on its way back to requester """
+        """ Dehydrate - data on its way back to requester.
+            Only derives the fields that the data_level will let through. """
         
-        # User gets passed through because CustomAuth now passes it even for GET requests
-        bundle.data['user_voted'] = get_user_vote_status(bundle)
+        # User gets passed through because CustomAuth now passes it even for GET requests.
+        # Filled in for the whole page at once from the vote collection (see alter_*_data_to_serialize)
+        if wants_field(bundle, 'user_voted'):
+            bundle.data['user_voted'] = 0
         
         # Class will always have a time_stamp due to default.
-        bundle.data['informal_created'] = calculate_informal_time(bundle.data['created'])
-        bundle.data['informal_modified'] = calculate_informal_time(bundle.data['modified'])
+        if wants_field(bundle, 'informal_created'):
+            bundle.data['informal_created'] = calculate_informal_time(bundle.data['created'])
+        if wants_field(bundle, 'informal_modified'):
+            bundle.data['informal_modified'] = calculate_informal_time(bundle.data['modified'])
         
         # Get the useful protective marking elements
-        bundle = get_top_level_pm_elements(bundle)
+        if wants_field(bundle, 'pretty_pm', 'classification_short'):
+            bundle = get_top_level_pm_elements(bundle)
                
         # Lookup the user's info
-        bundle = get_contributors_info(bundle)
+        if wants_field(bundle, 'contributor_name'):
+            bundle = get_contributors_info(bundle)
 
-        # Produce a truncated (by word), html-tag cleaned version
-        if bundle.data.has_key('description'):
-            bundle.data['description_snippet'] = derive_snippet(bundle.data['description'])
+        # For ?q= searches, how well it matched and where
+        if bundle.request.GET.get('q') and hasattr(bundle.obj, 'search_score'):
+            if wants_field(bundle, 'search_score'):
+                bundle.data['search_score'] = bundle.obj.search_score
+            if bundle.data.has_key('description') and wants_field(bundle, 'search_snippet'):
+                bundle.data['search_snippet'] = derive_search_snippet(bundle.data['description'], get_search_terms(bundle.request.GET['q']))
         
         return bundle
     
@@ -500,6 +680,7 @@ class IdeaTagResource(resources.MongoEngineResource):
         # Update the current tag count + count of new tags
         doc_id = request.path.replace('/tags/', '').split('/')[-1]
         documents.Idea.objects(id=doc_id).update(**{'inc__tag_count': 1})
+        touch_watermark('idea')
         return super(IdeaTagResource, self).post_list(request)        
 
 
@@ -522,126 +703,42 @@ class LikeResource(resources.MongoEngineResource):
         authorization = Authorization()
 
     def post_list(self, request, **kwargs):
-        """ Upon creation of a new idea tag, change the total count too"""
+        """ Applies the like (switching over any dislike by this user) to the idea in a
+            single conditional, atomic update and returns the idea's new vote counts and score. """
         
         # Get the document
         regExp = re.compile('.*/(?P<doc_id>[a-zA-Z0-9]{24})/.*')
-        m = re.match(regExp, request.path).groupdict()
-        if m:
-            doc_id = m['doc_id']
-        else:
+        m = re.match(regExp, request.path)
+        if not m:
             return super(LikeResource, self).post_list(request)
-
-        doc = documents.Idea.objects.get(id=doc_id)
-        
-        # Likes are only allowed on published content
-        if doc.status != 'published':
-            bundle = {"error": "User can only like published ideas."}
-            return self.create_response(request, bundle, response_class = http.HttpBadRequest)
         
-        else:
-            # Get a list of who has liked or disliked
-            users_already_liked     = [vote['user'] for vote in doc['likes']]
-            users_already_disliked  = [vote['user'] for vote in doc['dislikes']]
-            
-            # Check this user actually exists in the db
-            check_user = User.objects.get_by_natural_key(request.user.username)
-            if not check_user:
-                return
-                #TODO: Return an error - like not incremented
-            
-            # Check whether the user has voted
-            user_id = request.user.username
-    
-            # User has already disliked the idea - flip the vote
-            if user_id in users_already_disliked:
-                # Single transaction - decrement dislike, increment like, pull the previous vote
-                documents.Idea.objects(id=doc_id).update(**{'inc__dislike_count': -1,
-                                                            'pull__dislikes__user':user_id,
-                                                            'inc__like_count': 1})
-                        
-            # User has already liked the idea - block the duplicate attempt
-            elif user_id not in users_already_liked:
-                documents.Idea.objects(id=doc_id).update(**{'inc__like_count': 1})
-    
-            # Having made any mods, now re-compute the score value
-            current_idea = documents.Idea.objects.get(id=doc_id)
-            score = vote_score(current_idea['like_count'], current_idea['dislike_count'])
-            documents.Idea.objects(id=doc_id).update(**{'set__vote_score':score})
-
-            # User hasn't done anything up to now, so let him/her vote        
-            return super(LikeResource, self).post_list(request)        
-            
-
-    def obj_create(self, bundle, **kwargs):
-        """ Determines how new objects will get created  """
+        deserialized = self.deserialize(request, request.body, format=request.META.get('CONTENT_TYPE', 'application/json'))
         
-        # Get the current document ID and those who have already liked it
-        doc_id = bundle.request.path.replace('/likes/', '').split('/')[-1]
-        doc = documents.Idea.objects.get(id=doc_id)
+        # Vote comments are merged in with the standard comments
+        vote_comment = None
+        if deserialized and deserialized.has_key('comment') == True:
+            vote_comment = deserialized['comment']
         
-        # Get a list of who has liked or disliked
-        users_already_voted = [like['user'] for like in doc['likes']]
-        users_already_voted += [like['user'] for like in doc['dislikes']]
+        outcome, votes = apply_vote(m.groupdict()['doc_id'], request.user.username, 'like', vote_comment)
         
-        # Get the current user
-        user_id = bundle.request.user.username
+        # Likes are only allowed on published content
+        if outcome == 'not_published':
+            bundle = {"error": "User can only like published ideas."}
+            return self.create_response(request, bundle, response_class = http.HttpBadRequest)
         
-        # Assumes we already have a user otherwise they wouldn't have authenticated
-        if user_id not in users_already_voted:
-            bundle.data['user'] = user_id
-
-            # Decided to merge vote comments with standard comments,
-            # so this takes care of that in the backend.
-            if bundle.data.has_key('comment') == True:
-                
-                vote_comment = bundle.data['comment']
-                
-                new_comment = {'type'               : 'like',
-                               'title'              : vote_comment['title'],
-                               'user'               : user_id,
-                               'modified'           : datetime.datetime.utcnow(),
-                               'created'            : datetime.datetime.utcnow(),
-                               }
-                
-                # Effectively optional fields
-                try:
-                    new_comment['body'] = vote_comment['body']
-                except:
-                    new_comment['body'] = None
-
-                try:
-                    new_comment['protective_marking'] = vote_comment['protective_marking']
-                except:
-                    new_comment['protective_marking'] = None
-
-                # Add in the new comment
-                try:
-                    documents.Idea.objects(id=doc_id).update(**{'push__comments' : new_comment})
-                    
-                except:
-                    print 'Failed to push comment'
-                    #TODO: Add in proper logging.
-
-                # Increment the comment count at the same time
-                documents.Idea.objects(id=doc_id).update(**{'inc__comment_count': 1})
-            
-            return super(LikeResource, self).obj_create(bundle)
-
+        elif outcome == 'not_found':
+            return http.HttpNotFound()
         
-# ------------------------------------------------------------------------------------------------------------        
-
-    def hydrate(self, bundle):
-        """ Changes the modified date of the parent object """
+        elif outcome == 'conflict':
+            bundle = {"error": "The idea is being voted on too heavily, please try again."}
+            return self.create_response(request, bundle, response_class = http.HttpConflict)
         
-        # Also change the parent if there is one for this call
-        regExp = re.compile('.*/(?P<doc_id>[a-zA-Z0-9]{24})/.*')
-        m = re.match(regExp, bundle.request.path).groupdict()
-        if m:
-            documents.Idea.objects.get(id=m['doc_id']).update(**{'set__modified': datetime.datetime.utcnow()})
+        # The user had already liked it - nothing changes
+        elif outcome == 'duplicate':
+            return self.create_response(request, votes)
         
-        bundle = super(LikeResource, self).hydrate(bundle) 
-        return bundle
+        touch_watermark('idea', votes.pop('modified'))
+        return self.create_response(request, votes, response_class = http.HttpCreated)
 
 # ------------------------------------------------------------------------------------------------------------        
 
@@ -760,106 +857,42 @@ class DislikeResource(resources.MongoEngineResource):
         authorization = Authorization()
 
     def post_list(self, request, **kwargs):
-        """ Upon creation of a new idea tag, change the total count too"""
+        """ Applies the dislike (switching over any like by this user) to the idea in a
+            single conditional, atomic update and returns the idea's new vote counts and score. """
         
         # Get the document
         regExp = re.compile('.*/(?P<doc_id>[a-zA-Z0-9]{24})/.*')
-        m = re.match(regExp, request.path).groupdict()
-        if m:
-            doc_id = m['doc_id']
-        else:
+        m = re.match(regExp, request.path)
+        if not m:
             return super(DislikeResource, self).post_list(request)
-
-        doc = documents.Idea.objects.get(id=doc_id)
         
-        # Likes are only allowed on published content
-        if doc.status != 'published':
-            bundle = {"error": "User can only dislike published ideas."}
-            return self.create_response(request, bundle, response_class = http.HttpBadRequest)
+        deserialized = self.deserialize(request, request.body, format=request.META.get('CONTENT_TYPE', 'application/json'))
         
-        else:
+        # Vote comments are merged in with the standard comments
+        vote_comment = None
+        if deserialized and deserialized.has_key('comment') == True:
+            vote_comment = deserialized['comment']
         
-            # Get a list of who has liked or disliked
-            users_already_liked     = [vote['user'] for vote in doc['likes']]
-            users_already_disliked  = [vote['user'] for vote in doc['dislikes']]
-            
-            # Check whether the user has voted
-            user_id = request.user.username
-    
-            # FOR A DISLIKE ACTION...
-            
-            # User has already liked, so just let them switch their like to dislike
-            # and keep track of the counters.
-            if user_id in users_already_liked:
-                # Single transaction - decrement like, increment dislike, pull the previous vote
-                documents.Idea.objects(id=doc_id).update(**{'inc__like_count': -1,
-                                                            'pull__likes__user':user_id,
-                                                            'inc__dislike_count': 1})
-            
-            # User has already disliked, so block this attempted to dislike again
-            elif user_id not in users_already_disliked:
-                documents.Idea.objects(id=doc_id).update(**{'inc__dislike_count': 1})
-            
-            # Having made any mods, now re-compute the score value
-            current_idea = documents.Idea.objects.get(id=doc_id)
-            score = vote_score(current_idea['like_count'], current_idea['dislike_count'])
-            documents.Idea.objects(id=doc_id).update(**{'set__vote_score':score})
-            
-            # User hasn't done anything up to now, so let them dislike.
-            return super(DislikeResource, self).post_list(request)        
+        outcome, votes = apply_vote(m.groupdict()['doc_id'], request.user.username, 'dislike', vote_comment)
         
-
-    def obj_create(self, bundle, **kwargs):
-        """ Determines how new objects will get created  """
+        # Dislikes are only allowed on published content
+        if outcome == 'not_published':
+            bundle = {"error": "User can only dislike published ideas."}
+            return self.create_response(request, bundle, response_class = http.HttpBadRequest)
         
-        # Get the current document ID and those who have already liked it
-        doc_id = bundle.request.path.replace('/dislikes/', '').split('/')[-1]
-        doc = documents.Idea.objects.get(id=doc_id)
+        elif outcome == 'not_found':
+            return http.HttpNotFound()
         
-        # Get a list of who has liked or disliked
-        users_already_voted = [vote['user'] for vote in doc['likes']]
-        users_already_voted += [vote['user'] for vote in doc['dislikes']]
+        elif outcome == 'conflict':
+            bundle = {"error": "The idea is being voted on too heavily, please try again."}
+            return self.create_response(request, bundle, response_class = http.HttpConflict)
         
-        # Get the current user
-        user_id = bundle.request.user.username
+        # The user had already disliked it - nothing changes
+        elif outcome == 'duplicate':
+            return self.create_response(request, votes)
         
-        # Assumes we already have a user otherwise they wouldn't have authenticated
-        #TODO: If it is a dupe, then send back something specific that says it's a duplicate.
-        if user_id not in users_already_voted:
-            bundle.data['user'] = user_id
-            
-            # Decided to merge vote comments with standard comments,
-            # so this takes care of that in the backend.
-            if bundle.data.has_key('comment') == True:
-                vote_comment = bundle.data['comment']
-                new_comment = {'type'               : 'dislike',
-                               'title'              : vote_comment['title'],
-                               'user'               : user_id,
-                               'modified'           : datetime.datetime.utcnow(),
-                               'created'            : datetime.datetime.utcnow(),
-}
-                
-                # Effectively optional fields
-                try:
-                    new_comment['body'] = vote_comment['body']
-                except:
-                    new_comment['body'] = None
-                try:
-                    new_comment['protective_marking'] = vote_comment['protective_marking']
-                except:
-                    new_comment['protective_marking'] = None
-                     
-                # Add in the new comment
-                try:
-                    documents.Idea.objects(id=doc_id).update(**{'push__comments' : new_comment})
-                except:
-                    print 'Failed to push comment'
-                    #TODO: Add in proper logging.
-                    
-                # Increment the comment count at the same time
-                documents.Idea.objects(id=doc_id).update(**{'inc__comment_count': 1})
-                
-            return super(DislikeResource, self).obj_create(bundle)
+        touch_watermark('idea', votes.pop('modified'))
+        return self.create_response(request, votes, response_class = http.HttpCreated)
 
 # ------------------------------------------------------------------------------------------------------------        
 
@@ -965,20 +998,6 @@ class DislikeResource(resources.MongoEngineResource):
         bundle = get_contributors_info(bundle)
         return bundle
 
-# ------------------------------------------------------------------------------------------------------------        
-
-    def hydrate(self, bundle):
-        """ Changes the modified date of the parent object """
-        
-        # Also change the parent if there is one for this call
-        regExp = re.compile('.*/(?P<doc_id>[a-zA-Z0-9]{24})/.*')
-        m = re.match(regExp, bundle.request.path).groupdict()
-        if m:
-            documents.Idea.objects.get(id=m['doc_id']).update(**{'set__modified': datetime.datetime.utcnow()})
-        
-        
-        return bundle
-
 
 #-----------------------------------------------------------------------------
         
@@ -1021,25 +1040,14 @@ class TagResource(BaseCorsResource, resources.MongoEngineResource):
         
     def get_object_list(self, request):
         
-        # Build a basic aggregation
-        aggregation = [
-                        { "$unwind" : "$tags" },
-                        { "$group" : { 
-                            "_id" : "$tags",
-                            "count" : { "$sum" : 1 }
-                            }
-                         },
-                         { "$sort" : {"count" : -1}
-                        }
-                       ]
-        
+        # Tag counts are maintained as ideas are written (see documents.update_tag_counts)
+        statuses = None
         status = request.GET.get('status', None)  
         # So that status can be a list of comma separated statuses: ?status=hidden,published,draft
         if status:
             statuses = [s.strip() for s in status.split(',')]
-            aggregation.insert(0, {"$match" : {"status" : { "$in" : statuses }}})
-        res = documents.Idea._get_collection().aggregate(aggregation)['result']
-        return [documents.Tag(text=tag['_id'],count=tag['count']) for tag in res]
+        res = documents.read_tag_counts(['idea'], statuses)
+        return [documents.Tag(text=text, count=count) for text, count in res]
 
     def obj_get_list(self, bundle, **kwargs):
         # Filtering disabled for brevity...
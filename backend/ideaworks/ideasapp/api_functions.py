@@ -2,9 +2,11 @@
 # (c) Crown Copyright 2014 Defence Science and Technology Laboratory UK 
 # Author: Rich Brantingham
 
+import re
 import json
 import datetime
 import math
+from bson.objectid import ObjectId
 from HTMLParser import HTMLParser
 
 # Django objects/libs
@@ -14,6 +16,10 @@ from django.utils.html import strip_tags, escape
 
 # Project level object
 from ideaworks.generic_resources import BaseCorsResource
+from ideaworks.contributors import get_request_resolver
+from ideaworks.comment_store import comments_in_collection, store_comment
+from ideaworks.votes import claim_vote, release_vote
+from ideaworks.text_search import search_window, highlight_terms
 
 # This django app
 import ideasapp.documents as documents
@@ -67,23 +73,16 @@ def get_top_level_pm_elements(bundle):
 #--------------------------------------------------------------------------------
 
 def get_contributors_info(bundle, contributor=None):
-    """ Get the user info for a specific contributor"""
-    
+    """ Get the user info for a specific contributor.
+        The name is resolved lazily, together with every other contributor
+        on the page, by the request's ContributorNameResolver. """
     
     # Get the id of the user
     if not contributor:
         contributor = bundle.data['user']
     
-    # Get the user object
-    user_obj = None
-    
-    try:
-        user_obj = User.objects.get(username=contributor)
-    except:
-        user_obj = User.objects.get(email=contributor)
-    
-    if user_obj:
-        bundle.data['contributor_name'] = user_obj.first_name.title() + ' ' + user_obj.last_name.title()
+    resolver = get_request_resolver(getattr(bundle, 'request', None))
+    bundle.data['contributor_name'] = resolver.name_for(contributor)
     
     return bundle
 
@@ -137,8 +136,8 @@ def get_sub_field(object, field_name):
             
 #--------------------------------------------------------------------------------
 
-def get_max_pm(pm_docs):
-    """ Get the maximum protective marking elements """
+def merge_pms(pm_docs):
+    """ Merge protective markings into a single marking covering all of them """
 
     max_class_rank = -1
     max_class_full = 'PUBLIC'
@@ -183,8 +182,10 @@ def get_max_pm(pm_docs):
         codewords_short += get_sub_field(doc, 'codewords_short')
         
         # Concatenate the descriptors - assumed not mutually exclusive
-        if get_sub_field(doc, 'descriptor') and get_sub_field(doc, 'descriptor').upper() not in descriptors:
-            descriptors.append(get_sub_field(doc, 'descriptor'))
+        # (a merged marking holds them comma separated, so split those back out)
+        for descriptor in (get_sub_field(doc, 'descriptor') or '').split(','):
+            if descriptor and descriptor.upper() not in descriptors:
+                descriptors.append(descriptor)
     
     #TODO: Just joining the descriptors together rather than handling them properly as a list
     descriptors_out = ','.join(descriptors)
@@ -199,7 +200,76 @@ def get_max_pm(pm_docs):
                                          codewords_short               = list(set(codewords_short)),
                                          descriptor                    = descriptors_out)
     
-    return json.loads(max_pm.to_json())
+    return max_pm
+
+#--------------------------------------------------------------------------------
+
+def get_max_pm(pm_docs):
+    """ Get the maximum protective marking elements """
+    
+    return json.loads(merge_pms(pm_docs).to_json())
+
+#--------------------------------------------------------------------------------
+
+def derive_document_max_pm(doc, subdocs_to_check=['comments']):
+    """ The effective protective marking of a document: its own marking plus
+        those of any listed sub-documents (i.e. comments). Stored against the
+        document at write time so reads don't need to walk the sub-documents. """
+    
+    pm_docs = []
+    if doc.protective_marking:
+        pm_docs.append(doc.protective_marking)
+    
+    for fld in subdocs_to_check:
+        for sub_object in getattr(doc, fld, None) or []:
+            if sub_object.protective_marking:
+                pm_docs.append(sub_object.protective_marking)
+    
+    # Comments kept in their own collection rather than embedded
+    if 'comments' in subdocs_to_check and doc.pk and comments_in_collection():
+        for comment in documents.StoredComment.objects(parent_id=doc.pk).only('protective_marking'):
+            if comment.protective_marking:
+                pm_docs.append(comment.protective_marking)
+    
+    return merge_pms(pm_docs)
+
+#--------------------------------------------------------------------------------
+
+def get_precomputed_pms(bundles, subdocs_to_check=[], pm_name='protective_marking'):
+    """ Gets the stored effective protective marking of each object.
+        Falls back to walking the object (and its sub-documents) for anything
+        saved before the effective marking was stored (until backfill_max_pm has been run). """
+    
+    pm_docs = []
+    missing = {}
+    for bundle in bundles:
+        obj = getattr(bundle, 'obj', None)
+        max_pm = getattr(obj, 'max_pm', None)
+        if max_pm:
+            pm_docs.append(max_pm)
+        elif getattr(obj, 'pk', None):
+            missing.setdefault(type(obj), []).append(obj.pk)
+        else:
+            pm_docs += get_all_pms([bundle], subdocs_to_check=subdocs_to_check, pm_name=pm_name)
+    
+    # The objects may have been loaded without their comments (see get_data_level_projection),
+    # so re-read the markings of all those without a stored max_pm in one query
+    for document_class, pks in missing.items():
+        for doc in document_class.objects(pk__in=pks).only(pm_name, *subdocs_to_check):
+            if getattr(doc, pm_name, None):
+                pm_docs.append(getattr(doc, pm_name))
+            for fld in subdocs_to_check:
+                for sub_object in getattr(doc, fld, None) or []:
+                    if sub_object.protective_marking:
+                        pm_docs.append(sub_object.protective_marking)
+        
+        # Comments kept in their own collection rather than embedded
+        if 'comments' in subdocs_to_check and comments_in_collection():
+            for comment in documents.StoredComment.objects(parent_id__in=pks).only('protective_marking'):
+                if comment.protective_marking:
+                    pm_docs.append(comment.protective_marking)
+    
+    return pm_docs
 
 #--------------------------------------------------------------------------------
 
@@ -245,6 +315,33 @@ def calculate_informal_time(time_stamp):
 
 #-----------------------------------------------------------------------------
 
+def derive_last_modified(document_class):
+    """ Derives the most recent idea/comment modified timestamp the slow way.
+        Only used to seed the collection watermark when there isn't one yet. """
+    
+    # Except catches instance where no data
+    try:
+        doc_mod = document_class.objects.order_by('-modified')[0]['modified']
+    except IndexError:
+        return None
+    
+    # Retrieve the most recent comment modified timestamp
+    res = document_class._get_collection().aggregate([
+        { "$project" : {"_id" : 0, "comments" : 1}},
+        { "$unwind" : "$comments" },
+        { "$project" : {"modified" : "$comments.modified"}},
+        { "$sort" : {"modified" : -1}},
+        { "$limit" : 1}
+    ])['result']
+    
+    # In the event that there are no comments, the idea mod date wins
+    if res:
+        return max([doc_mod, res[0]['modified']])
+    else:
+        return doc_mod
+
+#-----------------------------------------------------------------------------
+
 def tag_based_filtering(request, data):
     """ Filters the results by multiple tags """
     
@@ -271,20 +368,104 @@ def tag_based_filtering(request, data):
 
 #-----------------------------------------------------------------------------
 
-def get_user_vote_status(bundle):
-    """ Reports back whether and how the user has previously voted """
+# How the user has previously voted, as reported in user_voted (0 if they haven't)
+USER_VOTED_VALUES = {'like' : 1, 'dislike' : -1}
+
+# The embedded vote lists, for user_voted before the vote collection has been loaded
+EMBEDDED_VOTE_LISTS = {'likes' : 'like', 'dislikes' : 'dislike'}
+
+#-----------------------------------------------------------------------------
+
+# The stored fields that each derived response field is built from
+DERIVED_FIELD_SOURCES = {'informal_created'     : ['created'],
+                         'informal_modified'    : ['modified'],
+                         'contributor_name'     : ['user'],
+                         'pretty_pm'            : ['protective_marking'],
+                         'classification_short' : ['protective_marking'],
+                         'search_snippet'       : ['description'],
+                         'user_voted'           : []}
+
+# Always loaded: needed for the meta, authorization and resource uris
+REQUIRED_FIELDS = ['id', 'user', 'status', 'modified', 'max_pm']
+
+def get_data_level_fields(request):
+    """ The response fields asked for through data_level on a GET,
+        or None if everything is wanted. Cached on the request. """
+    
+    if request is None or request.method != 'GET':
+        return None
+    
+    if not hasattr(request, '_data_level_fields'):
+        data_level = request.GET.get('data_level', None)
+        if data_level == 'meta':
+            request._data_level_fields = set()
+        elif data_level in settings.RESPONSE_FIELDS:
+            request._data_level_fields = set(settings.RESPONSE_FIELDS[data_level])
+        else:
+            request._data_level_fields = None
+    
+    return request._data_level_fields
+
+def get_data_level_projection(request, document_class):
+    """ The document fields needed to build the requested data_level (for .only()),
+        or None if the whole document is needed. """
+    
+    fields = get_data_level_fields(request)
+    if fields is None:
+        return None
+    
+    # Sub-resources (e.g. /<id>/comments/) need their parent document in full
+    if re.match('.*/[a-zA-Z0-9]{24}/.+', request.path):
+        return None
+    
+    projection = set(REQUIRED_FIELDS)
+    for field in fields:
+        if field in document_class._fields:
+            projection.add(field)
+        projection.update(DERIVED_FIELD_SOURCES.get(field, []))
+    
+    # The sort fields too, for the cursor to the next page
+    for field in request.GET.getlist('order_by'):
+        if field.lstrip('-') in document_class._fields:
+            projection.add(field.lstrip('-'))
+    
+    return list(projection)
+
+def wants_field(bundle, *field_names):
+    """ Whether any of these fields will make it into the response - i.e. whether they're worth deriving """
+    
+    fields = get_data_level_fields(getattr(bundle, 'request', None))
+    if fields is None:
+        return True
+    
+    for field_name in field_names:
+        if field_name in fields:
+            return True
+    return False
+
+#-----------------------------------------------------------------------------
+
+# The columns of a ?format=csv export when no data_level is given
+CSV_FIELDS = ['id', 'title', 'description', 'status', 'user', 'contributor_name', 'created', 'modified',
+              'tags', 'tag_count', 'comment_count', 'like_count', 'dislike_count', 'vote_score', 'classification_short']
+
+def get_pm_element(doc, element):
+    """ An element of a raw idea document's protective marking """
     
-    # Has the current user voted on this idea?
-    pos_votes = [vote.data['user'] for vote in bundle.data['likes']]
-    neg_votes = [vote.data['user'] for vote in bundle.data['dislikes']]
+    pm = doc.get('protective_marking') or {}
+    return pm.get(element) or 'NO PROTECTIVE MARKING FOUND'
+
+def get_informal_time(doc, field):
     
-    if unicode(bundle.request.user) in neg_votes:
-        user_vote = -1
-    elif unicode(bundle.request.user) in pos_votes:
-        user_vote = 1
-    else:
-        user_vote = 0
-    return user_vote
+    if not doc.get(field):
+        return ''
+    return calculate_informal_time(doc[field])
+
+# The csv columns that aren't stored: (db fields needed, function(raw document, contributor name resolver))
+CSV_DERIVED_FIELDS = {'contributor_name'     : (['user'],               lambda doc, resolver: resolver.name_for(doc['user']) if doc.get('user') else ''),
+                      'informal_created'     : (['created'],            lambda doc, resolver: get_informal_time(doc, 'created')),
+                      'informal_modified'    : (['modified'],           lambda doc, resolver: get_informal_time(doc, 'modified')),
+                      'classification_short' : (['protective_marking'], lambda doc, resolver: get_pm_element(doc, 'classification_short'))}
 
 #-----------------------------------------------------------------------------
 
@@ -348,6 +529,16 @@ def derive_snippet(text_html, chrs=240):
         
     return text
 
+def derive_search_snippet(text_html, terms, chrs=240):
+    """ A snippet as derive_snippet, but from around the first search term matched
+        and with the terms highlighted (so escaped, as it holds markup) """
+    
+    if not text_html or text_html == '':
+        return text_html
+    
+    stripped_text = strip_tags(text_html.replace('\n', ''))
+    return highlight_terms(derive_snippet(search_window(stripped_text, terms, chrs), chrs), terms)
+
 # ----------------------------------------------------------------------------------
 
 def vote_score(pos_count, neg_count):
@@ -383,4 +574,122 @@ def vote_score(pos_count, neg_count):
     return score
     
     
-    
\ No newline at end of file
+    
+# ----------------------------------------------------------------------------------
+
+# For each vote type: (votes list, its counter, the opposite votes list, its counter)
+VOTE_FIELDS = {'like'    : ('likes', 'like_count', 'dislikes', 'dislike_count'),
+               'dislike' : ('dislikes', 'dislike_count', 'likes', 'like_count')}
+
+def build_vote_comment(vote_type, user_id, vote_comment, now):
+    """ Builds the comment that accompanies a vote - stored with the standard comments """
+    
+    pm = vote_comment.get('protective_marking', None)
+    if pm:
+        pm = documents.ProtectiveMarking(**dict([(key, value) for key, value in pm.items() if key in documents.ProtectiveMarking._fields]))
+    
+    return documents.Comment(type               = vote_type,
+                             title              = vote_comment.get('title', None),
+                             body               = vote_comment.get('body', None),
+                             body_snippet       = derive_snippet(vote_comment.get('body', None)),
+                             user               = user_id,
+                             created            = now,
+                             modified           = now,
+                             protective_marking = pm or None)
+
+def apply_vote(doc_id, user_id, vote_type, vote_comment=None, attempts=5):
+    """ Applies a like or dislike to an idea as one conditional, atomic update:
+        the vote push (and pull of any opposite vote), the counters, the score,
+        the modified timestamp and any vote comment all go in together (a comment
+        kept in the comment collection goes in straight after).
+        
+        The vote is first claimed in the vote collection, whose unique (idea, user)
+        index turns away a second vote by the same user without reading the idea's
+        vote lists. The update then only applies if the user still hasn't voted this
+        way (in the lists, for votes from before the collection) and the counters
+        haven't moved since they were read, so the score always matches the counts.
+        If another vote gets in first, it is retried. A vote that can't be applied
+        gives its claim back.
+        
+        Returns (outcome, votes) - outcome is one of voted, duplicate, not_published,
+        not_found or conflict; votes holds the idea's counts and score. """
+    
+    votes_field, count_field, opposite_field, opposite_count_field = VOTE_FIELDS[vote_type]
+    opposite_type = 'dislike' if vote_type == 'like' else 'like'
+    collection = documents.Idea._get_collection()
+    doc_id = ObjectId(doc_id)
+    claimed = None
+    
+    for attempt in range(attempts):
+        
+        # Just the counts and this user's votes, if any
+        doc = collection.find_one({'_id' : doc_id},
+                                  {'status'         : 1,
+                                   'like_count'     : 1,
+                                   'dislike_count'  : 1,
+                                   'vote_score'     : 1,
+                                   'max_pm'         : 1,
+                                   votes_field      : {'$elemMatch' : {'user' : user_id}},
+                                   opposite_field   : {'$elemMatch' : {'user' : user_id}}})
+        if not doc or doc.get('status') != 'published':
+            if claimed:
+                release_vote(doc_id, user_id, vote_type, claimed, opposite_type=opposite_type)
+            return 'not_published' if doc else 'not_found', None
+        
+        counts = {'like_count'    : doc.get('like_count') or 0,
+                  'dislike_count' : doc.get('dislike_count') or 0}
+        
+        # Block the duplicate attempt - by the unique index, then the lists
+        if claimed is None:
+            claimed = claim_vote(doc_id, user_id, vote_type, opposite_type=opposite_type)
+        if claimed == 'duplicate' or doc.get(votes_field):
+            counts['vote_score'] = doc.get('vote_score') or vote_score(counts['like_count'], counts['dislike_count'])
+            return 'duplicate', counts
+        
+        # User has already voted the other way - flip the vote
+        flip = bool(doc.get(opposite_field))
+        
+        now = datetime.datetime.utcnow()
+        counts[count_field] += 1
+        if flip:
+            counts[opposite_count_field] -= 1
+        counts['vote_score'] = vote_score(counts['like_count'], counts['dislike_count'])
+        
+        query = {'_id'                  : doc_id,
+                 'status'               : 'published',
+                 'like_count'           : doc.get('like_count'),
+                 'dislike_count'        : doc.get('dislike_count'),
+                 votes_field + '.user'  : {'$ne' : user_id}}
+        
+        update = {'$push' : {votes_field : documents.Vote(user=user_id, created=now).to_mongo()},
+                  '$set'  : {count_field  : counts[count_field],
+                             'vote_score' : counts['vote_score'],
+                             'modified'   : now}}
+        
+        if flip:
+            query[opposite_field + '.user'] = user_id
+            update['$pull'] = {opposite_field : {'user' : user_id}}
+            update['$set'][opposite_count_field] = counts[opposite_count_field]
+        else:
+            query[opposite_field + '.user'] = {'$ne' : user_id}
+        
+        if vote_comment:
+            comment = build_vote_comment(vote_type, user_id, vote_comment, now)
+            if not comments_in_collection():
+                update['$push']['comments'] = comment.to_mongo()
+            update['$inc'] = {'comment_count' : 1}
+            
+            # Keep the idea's effective protective marking in step with its comments
+            if comment.protective_marking and doc.get('max_pm'):
+                max_pm = merge_pms([documents.ProtectiveMarking._from_son(doc['max_pm']), comment.protective_marking])
+                update['$set']['max_pm'] = max_pm.to_mongo()
+        
+        if collection.find_and_modify(query, update, fields={'_id' : 1}):
+            # Comments kept in their own collection go in once the vote (and count) has
+            if vote_comment and comments_in_collection():
+                store_comment(documents.StoredComment, doc_id, comment)
+            counts['modified'] = now
+            return 'voted', counts
+    
+    release_vote(doc_id, user_id, vote_type, claimed, opposite_type=opposite_type)
+    return 'conflict', None
@@ -3,10 +3,10 @@
 # Author: Rich Brantingham
 
 from tastypie.authentication import ApiKeyAuthentication
-from tastypie.compat import User
 
 from tastypie.http import HttpUnauthorized
-from tastypie.compat import username_field
+
+from ideaworks.api_key_cache import get_api_key_user
 
 #------------------------------------------------------------------------
 
@@ -54,10 +54,9 @@ class CustomApiKeyAuthentication(ApiKeyAuthentication):
             else:
                 return self._unauthorized()
 
-        try:
-            lookup_kwargs = {username_field: username}
-            user = User.objects.get(**lookup_kwargs)
-        except (User.DoesNotExist, User.MultipleObjectsReturned):
+        # Usually from the cache - see ideaworks/api_key_cache.py
+        user, key_valid = get_api_key_user(username, api_key)
+        if user is None:
             
             # This handles the case where the client is using the correct header, but the header content is 'undefined'
             # If this happens for simple GETs the we let it pass, otherwise we return unauthorized.
@@ -69,24 +68,10 @@ class CustomApiKeyAuthentication(ApiKeyAuthentication):
         if not self.check_active(user):
             return False
         
-        key_auth_check = self.get_key(user, api_key)
-        if key_auth_check and not isinstance(key_auth_check, HttpUnauthorized):
-            request.user = user
-
-        return key_auth_check
-
-    def get_key(self, user, api_key):
-        """
-        Attempts to find the API key for the user. Uses ``ApiKey`` by default
-        but can be overridden.
-        """
-        from tastypie.models import ApiKey
-
-        try:
-            ApiKey.objects.get(user=user, key=api_key)
-        except ApiKey.DoesNotExist:
+        if not key_valid:
             return self._unauthorized()
-
+        
+        request.user = user
         return True
 
     def get_identifier(self, request):
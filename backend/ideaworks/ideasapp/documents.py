@@ -3,7 +3,10 @@
 # Author: Rich Brantingham
 
 import datetime
-from mongoengine import Document, BooleanField, IntField, EmbeddedDocument, DateTimeField, ListField, StringField, EmbeddedDocumentField, FloatField
+from collections import defaultdict
+from mongoengine import Document, BooleanField, IntField, EmbeddedDocument, DateTimeField, ListField, StringField, EmbeddedDocumentField, FloatField, DictField, ObjectIdField
+
+from ideaworks.votes import remove_target_votes
 
 
 class InheritableDocument(Document):
@@ -50,13 +53,236 @@ class Comment(InheritableEmbeddedDocument):
     created                    = DateTimeField(help_text="The date and time of when the object was created.", default=datetime.datetime.utcnow)
     modified                   = DateTimeField(help_text="When the comment or dependent data was last modified.", default=datetime.datetime.utcnow)
     body                       = StringField(max_length=5000, help_text="Main body of the text, limited to 1000 chrs.")
+    body_snippet               = StringField(help_text="The body without markup, truncated by word. Set as the comment is written.")
+    protective_marking         = EmbeddedDocumentField(ProtectiveMarking)
+    
+#------------------------------------------------------------------------
+
+class StoredComment(Document):
+    """ A comment on an idea, kept in a collection of its own rather than embedded
+        in the idea (COMMENT_STORAGE = 'collection' - see ideaworks.comment_store) """
+    
+    parent_id                  = ObjectIdField(required=True, help_text="The idea this comment is on.")
+    type                       = StringField(help_text='The type of comment to allow for filtering.', required=False)
+    user                       = StringField(help_text="ID of the user submitting the comment")
+    title                      = StringField(max_length=200, help_text="The title of the comment, limited to 100 chrs.")
+    created                    = DateTimeField(help_text="The date and time of when the object was created.", default=datetime.datetime.utcnow)
+    modified                   = DateTimeField(help_text="When the comment or dependent data was last modified.", default=datetime.datetime.utcnow)
+    body                       = StringField(max_length=5000, help_text="Main body of the text, limited to 1000 chrs.")
+    body_snippet               = StringField(help_text="The body without markup, truncated by word. Set as the comment is written.")
     protective_marking         = EmbeddedDocumentField(ProtectiveMarking)
     
+    # A page of one idea's comments, oldest first, with _id to break ties for keyset paging
+    meta = {'collection' : 'idea_comments',
+            'db_alias'   : 'default',
+            'indexes'    : [{'fields' : ['parent_id', 'created', 'id']}]}
+    
 #------------------------------------------------------------------------
 
+# The collections that feed the tag counts
+TAG_SOURCES = ('idea', 'project')
+
 class Tag(InheritableDocument):
+    """ Materialized tag counts - one document per tag, shared by every source
+        collection (see TAG_SOURCES) so that the combined tag cloud is one read.
+        Kept up to date with $inc by update_tag_counts() as tagged documents are
+        saved and deleted, and rebuilt by the rebuild_tag_counts management command.
+        Only ever written through the raw collection, so there's no _cls. """
+    
     text = StringField(max_length=30)
-    count = IntField(default=0)
+    count = IntField(default=0, help_text="Number of instances of the tag across all sources and statuses.")
+    totals = DictField(help_text="Number of instances per source, e.g. {'idea': 4}.")
+    counts = DictField(help_text="Number of instances per source and status, e.g. {'idea': {'published': 3, 'draft': 1}}.")
+
+    meta = {'collection' : 'tag_counts',
+            'index_cls'  : False,
+            'indexes'    : [{'fields' : ['text'], 'unique' : True},
+                            '-count',
+                            '-totals.idea',
+                            '-totals.project']}
+
+#------------------------------------------------------------------------
+
+def status_key(status):
+    """ The key a status is counted under (statuses are free text, keys can't hold dots) """
+    
+    if not status:
+        return 'none'
+    return status.replace('.', '_').replace('$', '_')
+
+def get_path(doc, path):
+    """ Gets a dotted field (e.g. 'counts.idea.published') out of a raw document """
+    
+    for key in path.split('.'):
+        doc = doc.get(key, {})
+    return doc or 0
+
+#------------------------------------------------------------------------
+
+def update_tag_counts(source, old_tags, old_status, new_tags, new_status):
+    """ Applies the difference between a document's old and new tags/status to the tag counts.
+        Pass old_tags=None for a new document and new_tags=None for a deleted one. """
+    
+    changes = defaultdict(int)
+    for tag in old_tags or []:
+        changes[(tag, status_key(old_status))] -= 1
+    for tag in new_tags or []:
+        changes[(tag, status_key(new_status))] += 1
+    
+    apply_tag_count_changes(source, changes)
+
+def add_batch_tag_counts(source, docs):
+    """ Adds the tags of a batch of new documents to the tag counts - one update per
+        distinct tag and status, rather than one per tag per document """
+    
+    changes = defaultdict(int)
+    for doc in docs:
+        for tag in doc.tags or []:
+            changes[(tag, status_key(doc.status))] += 1
+    
+    apply_tag_count_changes(source, changes)
+
+def derive_status_change(document_class, query, new_status):
+    """ The tag count changes for moving the documents matching a raw query to new_status,
+        from one aggregation - to apply once they have been updated with one multi update """
+    
+    aggregation = [{ "$match"  : query },
+                   { "$unwind" : "$tags" },
+                   { "$group"  : {"_id"   : {"text" : "$tags", "status" : "$status"},
+                                  "count" : {"$sum" : 1}}}]
+    
+    changes = defaultdict(int)
+    for res in document_class._get_collection().aggregate(aggregation)['result']:
+        changes[(res['_id']['text'], status_key(res['_id'].get('status')))] -= res['count']
+        changes[(res['_id']['text'], status_key(new_status))] += res['count']
+    
+    return changes
+
+def derive_tag_removal(document_class, query):
+    """ The tag count changes for removing the documents matching a raw query,
+        from one aggregation - to apply once they have been removed with one delete """
+    
+    aggregation = [{ "$match"  : query },
+                   { "$unwind" : "$tags" },
+                   { "$group"  : {"_id"   : {"text" : "$tags", "status" : "$status"},
+                                  "count" : {"$sum" : 1}}}]
+    
+    changes = defaultdict(int)
+    for res in document_class._get_collection().aggregate(aggregation)['result']:
+        changes[(res['_id']['text'], status_key(res['_id'].get('status')))] -= res['count']
+    
+    return changes
+
+def apply_tag_count_changes(source, changes):
+    """ $inc's the tag counts by a dict of {(text, status key) : change} """
+    
+    collection = Tag._get_collection()
+    for (text, status), change in changes.items():
+        if change == 0:
+            continue
+        collection.update({'text' : text},
+                          {'$inc' : {'count'                              : change,
+                                     'totals.%s' % (source)               : change,
+                                     'counts.%s.%s' % (source, status)    : change}},
+                          upsert=True)
+
+#------------------------------------------------------------------------
+
+def read_tag_counts(sources, statuses=None):
+    """ Tag counts for the given sources (and optionally statuses), highest first.
+        Returns a list of (text, count) tuples. """
+    
+    if statuses:
+        fields = ['counts.%s.%s' % (source, status_key(status)) for source in sources for status in statuses]
+    elif set(sources) == set(TAG_SOURCES):
+        fields = ['count']
+    else:
+        fields = ['totals.%s' % (source) for source in sources]
+    
+    if not fields:
+        return []
+    
+    collection = Tag._get_collection()
+    
+    # A single count is a straight sorted read
+    if len(fields) == 1:
+        cursor = collection.find({fields[0] : {'$gt' : 0}}, {'text' : 1, fields[0] : 1}).sort(fields[0], -1)
+        return [(doc['text'], get_path(doc, fields[0])) for doc in cursor]
+    
+    # Several need adding up first, but over the (small) tag collection rather than the documents
+    aggregation = [{'$match'   : {'$or' : [{field : {'$gt' : 0}} for field in fields]}},
+                   {'$project' : {'text'  : 1,
+                                  'count' : {'$add' : [{'$ifNull' : ['$' + field, 0]} for field in fields]}}},
+                   {'$sort'    : {'count' : -1}}]
+    
+    return [(doc['text'], doc['count']) for doc in collection.aggregate(aggregation)['result']]
+
+#------------------------------------------------------------------------
+
+def derive_tag_counts(document_class):
+    """ Counts the tags in a collection the slow way: {(text, status key) : count} """
+    
+    aggregation = [{ "$unwind" : "$tags" },
+                   { "$group"  : {"_id"   : {"text" : "$tags", "status" : "$status"},
+                                  "count" : {"$sum" : 1}}}]
+    
+    counts = defaultdict(int)
+    for res in document_class._get_collection().aggregate(aggregation)['result']:
+        counts[(res['_id']['text'], status_key(res['_id'].get('status')))] += res['count']
+    
+    return counts
+
+#------------------------------------------------------------------------
+
+def rebuild_tag_counts(sources, dry_run=False):
+    """ Rebuilds the tag counts of the given sources ({source name : document class})
+        from their collections, leaving any other sources' counts as they are.
+        Returns the drift found as a list of (text, source, status, stored, actual). """
+    
+    collection = Tag._get_collection()
+    stored = dict((doc['text'], doc) for doc in collection.find())
+    
+    # Start from what's stored, with the sources being rebuilt removed
+    rebuilt = {}
+    for text, doc in stored.items():
+        rebuilt[text] = {'totals' : dict((k, v) for k, v in (doc.get('totals') or {}).items() if k not in sources),
+                         'counts' : dict((k, v) for k, v in (doc.get('counts') or {}).items() if k not in sources)}
+    
+    drift = []
+    for source, document_class in sources.items():
+        actual = derive_tag_counts(document_class)
+        
+        for (text, status), count in actual.items():
+            entry = rebuilt.setdefault(text, {'totals' : {}, 'counts' : {}})
+            entry['totals'][source] = entry['totals'].get(source, 0) + count
+            entry['counts'].setdefault(source, {})[status] = count
+        
+        # Compare against what was stored
+        stored_counts = {}
+        for text, doc in stored.items():
+            for status, count in ((doc.get('counts') or {}).get(source) or {}).items():
+                if count:
+                    stored_counts[(text, status)] = count
+        
+        for key in set(stored_counts.keys() + actual.keys()):
+            if stored_counts.get(key, 0) != actual.get(key, 0):
+                drift.append((key[0], source, key[1], stored_counts.get(key, 0), actual.get(key, 0)))
+    
+    if dry_run:
+        return sorted(drift)
+    
+    for text, entry in rebuilt.items():
+        count = sum(entry['totals'].values())
+        if count:
+            collection.update({'text' : text},
+                              {'$set' : {'count'  : count,
+                                         'totals' : entry['totals'],
+                                         'counts' : entry['counts']}},
+                              upsert=True)
+        else:
+            collection.remove({'text' : text})
+    
+    return sorted(drift)
 
 #------------------------------------------------------------------------
 
@@ -77,12 +303,17 @@ class Vote(InheritableEmbeddedDocument):
 
 #------------------------------------------------------------------------
 
+# The fields that ?q= searches, and how much a match in each counts. Mongoengine can't
+# declare text indexes, so this one is created by the manage_indexes management command.
+TEXT_INDEX_WEIGHTS = {'title' : 10, 'tags' : 5, 'description' : 1}
+
 class Idea(InheritableDocument):
     """ The idea object """
     
     user                = StringField(max_length=200, help_text="The idea creator. User id as a string.")
     title               = StringField(max_length=200,  help_text="The title for this concept, idea or issue. <br/>E.g. 'Quantum processing'")
     description         = StringField(max_length=5000, help_text="A description of the concept, idea or issue.")
+    description_snippet = StringField(help_text="The description without markup, truncated by word. Maintained on save.")
     protective_marking  = EmbeddedDocumentField(ProtectiveMarking, help_text='Protective marking of this idea.<br/>Comprising classification, descriptor, codewords and national caveats.<br/>See protective marking end point for fields.')
     created             = DateTimeField(help_text="The date and time of when the object was created.", default=datetime.datetime.utcnow)
     modified            = DateTimeField(help_text="When any component of the idea or dependent data was last modified.", default=datetime.datetime.utcnow)
@@ -93,6 +324,7 @@ class Idea(InheritableDocument):
     dislikes            = ListField(EmbeddedDocumentField(Vote), help_text="Users who have disliked this idea.")
     vote_score          = FloatField(required=False)
     comments            = ListField(EmbeddedDocumentField(Comment))
+    max_pm              = EmbeddedDocumentField(ProtectiveMarking, help_text="The highest protective marking across the idea and its comments. Maintained on save.")
     
     # These included so that they get populated to the docs
     like_count          = IntField(required=False)
@@ -105,5 +337,52 @@ class Idea(InheritableDocument):
 
     status              = StringField(help_text="The current status of the object: published | draft | deleted | hidden ")
 
+    # Multikey index to serve tag filtering/ranking, then the published (and own) lists
+    # in the orders the API serves them. _id breaks ties for keyset paging and each
+    # index serves its order in either direction. Kept in step with the database by
+    # the manage_indexes management command.
+    meta = {'indexes' : ['tags',
+                         {'fields' : ['status', 'created', 'id']},
+                         {'fields' : ['status', 'modified', 'id']},
+                         {'fields' : ['status', 'vote_score', 'id']},
+                         {'fields' : ['status', 'like_count', 'id']},
+                         {'fields' : ['status', 'comment_count', 'id']},
+                         {'fields' : ['user', 'created', 'id']}]}
+
+    def clean(self):
+        """ Keeps the effective protective marking (this idea plus its comments)
+            up to date whenever the idea is saved - including when comments are
+            added, edited or removed, which save the whole document. And the
+            description snippet, so that reads don't have to strip the html. """
+        
+        # Imported here because api_functions depends on these documents
+        from api_functions import derive_document_max_pm, derive_snippet
+        self.max_pm = derive_document_max_pm(self)
+        self.description_snippet = derive_snippet(self.description)
+
+    def save(self, *args, **kwargs):
+        """ Keeps the tag counts in step with any change to the tags or status """
+        
+        old = None
+        if self.pk:
+            old = Idea.objects(pk=self.pk).only('tags', 'status').first()
+        
+        response = super(Idea, self).save(*args, **kwargs)
+        
+        if old:
+            update_tag_counts('idea', old.tags, old.status, self.tags, self.status)
+        else:
+            update_tag_counts('idea', None, None, self.tags, self.status)
+        
+        return response
+
+    def delete(self, *args, **kwargs):
+        """ Removes the idea's tags from the tag counts, and any comments and votes stored apart from it """
+        
+        super(Idea, self).delete(*args, **kwargs)
+        update_tag_counts('idea', self.tags, self.status, None, None)
+        StoredComment.objects(parent_id=self.pk).delete()
+        remove_target_votes(self.pk)
+
 #------------------------------------------------------------------------
     
\ No newline at end of file
@@ -0,0 +1,61 @@
+# (c) Crown Copyright 2014 Defence Science and Technology Laboratory UK
+# Author: Rich Brantingham
+
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+
+from ideasapp import documents
+from ideasapp.api_functions import derive_document_max_pm as derive_idea_max_pm
+from projectsapp import documents as project_documents
+from projectsapp.api_functions import derive_document_max_pm as derive_project_max_pm
+from contentapp import documents as content_documents
+from contentapp.api_functions import derive_document_max_pm as derive_feedback_max_pm
+
+def backfill_document_max_pm(document_class, derive_max_pm, refresh=False):
+    """ Sets the stored effective protective marking (max_pm) of documents written before
+        it was stored. A document commented on since it was read is left for the next run.
+        Returns (documents updated, documents skipped). """
+
+    collection = document_class._get_collection()
+
+    query = {} if refresh else {'max_pm' : {'$exists' : False}}
+
+    updated, skipped = 0, 0
+    for doc in document_class.objects(__raw__=query):
+
+        # Only while the comments are as they were read - every new comment bumps the count
+        spec = {'_id' : doc.pk, 'comment_count' : doc.comment_count}
+        if not refresh:
+            spec['max_pm'] = {'$exists' : False}
+
+        result = collection.update(spec, {'$set' : {'max_pm' : derive_max_pm(doc).to_mongo()}})
+        if result and result.get('n'):
+            updated += 1
+        else:
+            skipped += 1
+
+    return updated, skipped
+
+class Command(BaseCommand):
+    """ Stores the effective protective marking of ideas, projects and feedback written before
+        it was stored on save. Until this has run, their markings are re-read on every list and
+        detail request. Safe to re-run: only documents without a max_pm are touched. """
+
+    help = 'Stores the missing idea/project/feedback max_pm (highest protective marking including comments).'
+
+    option_list = BaseCommand.option_list + (
+        make_option('--refresh', action='store_true', dest='refresh', default=False,
+                    help='Recompute every max_pm, not just the missing ones.'),
+        )
+
+    def handle(self, *args, **options):
+
+        sources = [('idea',     documents.Idea,             derive_idea_max_pm),
+                   ('project',  project_documents.Project,  derive_project_max_pm),
+                   ('feedback', content_documents.Feedback, derive_feedback_max_pm)]
+
+        for name, document_class, derive_max_pm in sources:
+            updated, skipped = backfill_document_max_pm(document_class, derive_max_pm, refresh=options['refresh'])
+            self.stdout.write('%s: updated %s documents. %s skipped (commented on part way - re-run to update them).' % (
+                              name, updated, skipped))
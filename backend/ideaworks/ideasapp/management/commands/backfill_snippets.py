@@ -0,0 +1,97 @@
+# (c) Crown Copyright 2014 Defence Science and Technology Laboratory UK
+# Author: Rich Brantingham
+
+from optparse import make_option
+
+from bson.son import SON
+
+from django.core.management.base import BaseCommand
+
+from ideasapp import documents
+from ideasapp.api_functions import derive_snippet as derive_idea_snippet
+from projectsapp import documents as project_documents
+from projectsapp.api_functions import derive_snippet as derive_project_snippet
+from contentapp import documents as content_documents
+from contentapp.api_functions import derive_snippet as derive_feedback_snippet
+
+def backfill_document_snippets(document_class, derive_snippet, text_field=None, refresh=False):
+    """ Sets the stored snippets of documents (and their embedded comments) written
+        before they were stored. A document whose comments have changed since they
+        were read is left for the next run. Returns (documents updated, documents skipped). """
+
+    collection = document_class._get_collection()
+
+    query = {}
+    if not refresh:
+        missing = [{'comments' : {'$elemMatch' : {'body_snippet' : {'$exists' : False}}}}]
+        if text_field:
+            missing.append({'%s_snippet' % (text_field) : {'$exists' : False}})
+        query = {'$or' : missing}
+
+    fields = {'comments' : 1}
+    if text_field:
+        fields[text_field] = 1
+
+    updated, skipped = 0, 0
+    # Read in stored key order, so that the comments can be matched on exactly
+    for doc in collection.find(query, fields, as_class=SON):
+
+        new_values = {}
+        if text_field:
+            new_values['%s_snippet' % (text_field)] = derive_snippet(doc.get(text_field))
+
+        comments = doc.get('comments') or []
+        for i, comment in enumerate(comments):
+            if refresh or 'body_snippet' not in comment:
+                new_values['comments.%s.body_snippet' % (i)] = derive_snippet(comment.get('body'))
+
+        if not new_values:
+            continue
+
+        # Comment snippets are set by position, so only while the comments are as they were read
+        spec = {'_id' : doc['_id']}
+        if 'comments' in doc:
+            spec['comments'] = doc['comments']
+        result = collection.update(spec, {'$set' : new_values})
+        if result and result.get('n'):
+            updated += 1
+        else:
+            skipped += 1
+
+    return updated, skipped
+
+def backfill_stored_comment_snippets(stored_class, derive_snippet, refresh=False):
+    """ Sets the stored snippets of the comments in a comment collection. Returns the number updated. """
+
+    collection = stored_class._get_collection()
+
+    updated = 0
+    for comment in collection.find({} if refresh else {'body_snippet' : {'$exists' : False}}, {'body' : 1}):
+        collection.update({'_id' : comment['_id']}, {'$set' : {'body_snippet' : derive_snippet(comment.get('body'))}})
+        updated += 1
+
+    return updated
+
+class Command(BaseCommand):
+    """ Stores the description snippets of ideas and projects and the body snippets of their
+        comments (and feedback comments), for documents written before snippets were stored
+        on save. Safe to re-run: only documents without their snippets are touched. """
+
+    help = 'Stores the missing idea/project description snippets and comment body snippets.'
+
+    option_list = BaseCommand.option_list + (
+        make_option('--refresh', action='store_true', dest='refresh', default=False,
+                    help='Recompute every snippet, not just the missing ones.'),
+        )
+
+    def handle(self, *args, **options):
+
+        sources = [('idea',     documents.Idea,             documents.StoredComment,         derive_idea_snippet,     'description'),
+                   ('project',  project_documents.Project,  project_documents.StoredComment, derive_project_snippet,  'description'),
+                   ('feedback', content_documents.Feedback, content_documents.StoredComment, derive_feedback_snippet, None)]
+
+        for name, document_class, stored_class, derive_snippet, text_field in sources:
+            updated, skipped = backfill_document_snippets(document_class, derive_snippet, text_field, refresh=options['refresh'])
+            stored = backfill_stored_comment_snippets(stored_class, derive_snippet, refresh=options['refresh'])
+            self.stdout.write('%s: updated %s documents and %s stored comments. %s skipped (commented on part way - re-run to update them).' % (
+                              name, updated, stored, skipped))
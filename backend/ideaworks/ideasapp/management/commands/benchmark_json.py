@@ -0,0 +1,109 @@
+# (c) Crown Copyright 2014 Defence Science and Technology Laboratory UK
+# Author: Rich Brantingham
+
+import json
+import time
+import datetime
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+from django.core.serializers.json import DjangoJSONEncoder
+
+from tastypie.bundle import Bundle
+
+from ideasapp.serializers import CustomSerializer
+from ideaworks.json_encoding import compact_json
+
+class Command(BaseCommand):
+    """ Compares the time taken and bytes produced by the old (to_simple, indented and sorted)
+        json encoding against the compact one, over a synthetic page of dehydrated ideas.
+        Doesn't touch the database. """
+
+    help = 'Benchmarks the pretty vs compact json encoding of a list of ideas.'
+
+    option_list = BaseCommand.option_list + (
+        make_option('--objects', type='int', dest='objects', default=500,
+                    help='Number of ideas in the list.'),
+        make_option('--comments', type='int', dest='comments', default=5,
+                    help='Number of comments (and likes) per idea.'),
+        make_option('--repeats', type='int', dest='repeats', default=5,
+                    help='Number of times to encode the list - the best time is reported.'),
+        )
+
+    def build_data(self, object_count, comment_count):
+        """ Something shaped like a dehydrated idea list response """
+
+        now = datetime.datetime.utcnow()
+        pm = {'classification' : 'PUBLIC', 'classification_short' : 'PU', 'classification_rank' : 0,
+              'descriptor' : '', 'codewords' : [], 'national_caveats_members' : []}
+
+        objects = []
+        for i in range(object_count):
+            comments = [Bundle(data={'title'      : 'Comment %s on idea %s' % (j, i),
+                                     'body'       : 'Some thoughts on this idea. ' * 10,
+                                     'user'       : 'user_%s' % (j),
+                                     'created'    : now,
+                                     'modified'   : now,
+                                     'protective_marking' : Bundle(data=dict(pm))}) for j in range(comment_count)]
+            likes = [Bundle(data={'user' : 'user_%s' % (j), 'created' : now}) for j in range(comment_count)]
+
+            objects.append(Bundle(data={'id'                  : '%024x' % (i),
+                                        'title'               : 'Idea number %s' % (i),
+                                        'description'         : '<p>A description of the idea.</p>' * 20,
+                                        'description_snippet' : 'A description of the idea.',
+                                        'tags'                : ['physics', 'maths', 'design'],
+                                        'status'              : 'published',
+                                        'user'                : 'user_0',
+                                        'contributor_name'    : u'Bob Roberts',
+                                        'created'             : now,
+                                        'modified'            : now,
+                                        'informal_created'    : '2 hours ago',
+                                        'like_count'          : comment_count,
+                                        'dislike_count'       : 0,
+                                        'comment_count'       : comment_count,
+                                        'vote_score'          : 0.5,
+                                        'protective_marking'  : Bundle(data=dict(pm)),
+                                        'comments'            : comments,
+                                        'likes'               : likes,
+                                        'resource_uri'        : '/api/v1/idea/%024x/' % (i)}))
+
+        return {'meta'    : {'limit' : object_count, 'offset' : 0, 'total_count' : object_count, 'modified' : now},
+                'objects' : objects}
+
+    def time_encoding(self, encode, data, repeats):
+        """ Best time (ms) and size (bytes) of encode(data) """
+
+        best = None
+        for i in range(repeats):
+            start = time.time()
+            output = encode(data)
+            taken = time.time() - start
+            if best is None or taken < best:
+                best = taken
+
+        if isinstance(output, unicode):
+            output = output.encode('utf-8')
+        return best * 1000.0, len(output)
+
+    def handle(self, *args, **options):
+
+        serializer = CustomSerializer()
+        data = self.build_data(options['objects'], options['comments'])
+
+        def before(data):
+            simple = serializer.to_simple(data, {})
+            return json.dumps(simple, cls=DjangoJSONEncoder, sort_keys=True, ensure_ascii=False, indent=serializer.json_indent)
+
+        def after(data):
+            return compact_json(serializer, data)
+
+        results = [('pretty (before)', self.time_encoding(before, data, options['repeats'])),
+                   ('compact (after)', self.time_encoding(after, data, options['repeats']))]
+
+        self.stdout.write('%s ideas, %s comments and likes each, best of %s' % (options['objects'], options['comments'], options['repeats']))
+        for name, (ms, size) in results:
+            self.stdout.write('%-16s %8.1f ms %10s bytes' % (name, ms, size))
+
+        (before_ms, before_size), (after_ms, after_size) = results[0][1], results[1][1]
+        self.stdout.write('compact is %.0f%% of the time and %.0f%% of the bytes' % (100.0 * after_ms / before_ms,
+                                                                                   100.0 * after_size / before_size))
@@ -0,0 +1,190 @@
+# (c) Crown Copyright 2014 Defence Science and Technology Laboratory UK
+# Author: Rich Brantingham
+
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+
+from bson.objectid import ObjectId
+from pymongo.errors import OperationFailure
+
+from ideasapp import documents
+from projectsapp import documents as project_documents
+from contentapp import documents as content_documents
+from ideaworks.votes import UserVote
+from ideaworks.text_search import TEXT_INDEX_NAME, ensure_text_index
+
+# The documents whose indexes are declared in meta, and the list queries each one serves:
+# (filter, order_by) as the list end points build them
+INDEXED_DOCUMENTS = [('idea',         documents.Idea,
+                      [({'status' : 'published'}, '-created'),
+                       ({'status' : 'published'}, '-modified'),
+                       ({'status' : 'published'}, '-vote_score'),
+                       ({'status' : 'published'}, '-like_count'),
+                       ({'status' : 'published'}, '-comment_count'),
+                       ({'tags__in' : ['a']},     '-created'),
+                       ({'user' : 'a'},           '-created')]),
+                     ('project',      project_documents.Project,
+                      [({'status' : 'published'}, '-created'),
+                       ({'status' : 'published'}, '-modified'),
+                       ({'status' : 'published'}, '-back_count'),
+                       ({'status' : 'published'}, '-comment_count'),
+                       ({'tags__in' : ['a']},     '-created'),
+                       ({'user' : 'a'},           '-created')]),
+                     ('site_content', content_documents.Content,
+                      [({'type' : 'faq', 'index' : True}, None),
+                       ({'status' : 'published'},         '-created')]),
+                     ('feedback',     content_documents.Feedback,
+                      [({},                '-created'),
+                       ({'public' : True}, '-created'),
+                       ({'user' : 'a'},    '-created')]),
+                     ('idea_comments',     documents.StoredComment,
+                      [({'parent_id' : ObjectId()}, 'created')]),
+                     ('project_comments',  project_documents.StoredComment,
+                      [({'parent_id' : ObjectId()}, 'created')]),
+                     ('feedback_comments', content_documents.StoredComment,
+                      [({'parent_id' : ObjectId()}, 'created')]),
+                     ('votes',             UserVote,
+                      [({'target' : ObjectId(), 'user' : 'a'}, None),
+                       ({'target__in' : [ObjectId()], 'user' : 'a'}, None)])]
+
+# The text indexes searched by ?q= (which mongoengine can't declare in meta): {name: weights}
+TEXT_INDEXES = {'idea'     : documents.TEXT_INDEX_WEIGHTS,
+                'project'  : project_documents.TEXT_INDEX_WEIGHTS,
+                'feedback' : content_documents.FEEDBACK_TEXT_INDEX_WEIGHTS}
+
+#------------------------------------------------------------------------
+
+def get_declared_keys(document_class):
+    """ The key lists of the indexes declared on a document (plus _id and any _cls index) """
+
+    return [[(field, direction) for field, direction in keys] for keys in document_class.list_indexes()]
+
+def get_existing_indexes(document_class):
+    """ {index name: key list} of the indexes actually on the collection """
+
+    info = document_class._get_collection().index_information()
+    return dict([(name, [(field, direction) for field, direction in spec['key']]) for name, spec in info.items()])
+
+def get_index_usage(document_class):
+    """ {index name: operations} since the server started, or None if $indexStats isn't supported (before mongo 3.2) """
+
+    try:
+        result = document_class._get_collection().aggregate([{'$indexStats' : {}}])
+    except OperationFailure:
+        return None
+
+    if isinstance(result, dict):
+        result = result.get('result', [])
+    return dict([(stats['name'], stats['accesses']['ops']) for stats in result])
+
+def get_plan_indexes(plan):
+    """ The indexes (or full scans) used by an explain plan, old style or new """
+
+    found = []
+    if isinstance(plan, dict):
+        # Mongo 2.x: 'cursor' : 'BtreeCursor status_1_created_1__id_1' or 'BasicCursor'
+        cursor = plan.get('cursor')
+        if isinstance(cursor, basestring):
+            found.append(cursor.replace('BtreeCursor ', '').split(' ')[0] if cursor.startswith('BtreeCursor') else 'COLLSCAN')
+        # Mongo 3.x: nested stages with an 'indexName', or a 'COLLSCAN' stage
+        if plan.get('indexName'):
+            found.append(plan['indexName'])
+        elif plan.get('stage') == 'COLLSCAN':
+            found.append('COLLSCAN')
+        for key, value in plan.items():
+            if key in ('rejectedPlans', 'allPlans'):
+                continue
+            found.extend(get_plan_indexes(value))
+    elif isinstance(plan, list):
+        for value in plan:
+            found.extend(get_plan_indexes(value))
+
+    # Each only once, in the order found
+    return [name for i, name in enumerate(found) if name not in found[:i]]
+
+#------------------------------------------------------------------------
+
+class Command(BaseCommand):
+    """ Creates the indexes declared in each document's meta (and the text indexes) that are missing
+        from the idea, project, site content, feedback, comment and vote collections, then reports how
+        much each index is used ($indexStats, where the server has it) and which index the list queries use.
+        Indexes that aren't declared (which may have been added by hand) are only dropped when asked,
+        and then not if $indexStats shows them in use. """
+
+    help = 'Creates the declared mongo indexes, optionally drops unused undeclared ones and reports index usage.'
+
+    option_list = BaseCommand.option_list + (
+        make_option('--dry-run', action='store_true', dest='dry_run', default=False,
+                    help='Only report what would be created and dropped.'),
+        make_option('--drop-undeclared', action='store_true', dest='drop_undeclared', default=False,
+                    help='Also drop the indexes that aren\'t declared, unless $indexStats shows them in use.'),
+        make_option('--report-only', action='store_true', dest='report_only', default=False,
+                    help='Don\'t create or drop anything, just report index usage.'),
+        )
+
+    def sync_indexes(self, name, document_class, dry_run, drop_undeclared):
+        """ Create the declared indexes that are missing and (if asked) drop the unused ones that aren't declared """
+
+        declared = get_declared_keys(document_class)
+        existing = get_existing_indexes(document_class)
+
+        missing = [keys for keys in declared if keys not in existing.values()]
+        text_index = TEXT_INDEX_NAME if name in TEXT_INDEXES else None
+        undeclared = [index_name for index_name, keys in existing.items() if keys not in declared and index_name not in ('_id_', text_index)]
+
+        for keys in missing:
+            self.stdout.write('%s: %s index %s' % (name, 'would create' if dry_run else 'creating', keys))
+        if missing and not dry_run:
+            document_class.ensure_indexes()
+
+        if text_index and text_index not in existing:
+            self.stdout.write('%s: %s text index on %s' % (name, 'would create' if dry_run else 'creating', sorted(TEXT_INDEXES[name].keys())))
+            if not dry_run:
+                ensure_text_index(document_class, TEXT_INDEXES[name])
+
+        if undeclared and not drop_undeclared:
+            self.stdout.write('%s: not dropping undeclared %s (see --drop-undeclared)' % (name, ', '.join(sorted(undeclared))))
+            return
+
+        # Before mongo 3.2 there are no usage counts, so asking to drop drops them all
+        usage = get_index_usage(document_class) if undeclared else None
+        for index_name in sorted(undeclared):
+            if usage and usage.get(index_name):
+                self.stdout.write('%s: keeping undeclared index %s - used %s times' % (name, index_name, usage[index_name]))
+                continue
+            self.stdout.write('%s: %s index %s' % (name, 'would drop' if dry_run else 'dropping', index_name))
+            if not dry_run:
+                document_class._get_collection().drop_index(index_name)
+
+    def report(self, name, document_class, queries):
+        """ Per index: declared or not, and operations since the server started. Per list query: the indexes used. """
+
+        declared = get_declared_keys(document_class)
+        usage = get_index_usage(document_class)
+
+        self.stdout.write('')
+        self.stdout.write('%s (%s documents)' % (name, document_class.objects.count()))
+        for index_name, keys in sorted(get_existing_indexes(document_class).items()):
+            ops = '-' if usage is None else usage.get(index_name, 0)
+            is_declared = keys in declared or (index_name == TEXT_INDEX_NAME and name in TEXT_INDEXES)
+            self.stdout.write('  %-45s %-10s %8s ops' % (index_name, 'declared' if is_declared else 'UNDECLARED', ops))
+
+        for filters, order_by in queries:
+            queryset = document_class.objects(**filters)
+            if order_by:
+                queryset = queryset.order_by(order_by, '-id' if order_by.startswith('-') else 'id')
+            used = get_plan_indexes(queryset.limit(20).explain())
+            self.stdout.write('  %-45s -> %s' % ('%s by %s' % (filters, order_by), ', '.join(used) or '?'))
+
+    def handle(self, *args, **options):
+
+        for name, document_class, queries in INDEXED_DOCUMENTS:
+            if not options['report_only']:
+                self.sync_indexes(name, document_class, options['dry_run'], options['drop_undeclared'])
+
+        for name, document_class, queries in INDEXED_DOCUMENTS:
+            self.report(name, document_class, queries)
+
+        self.stdout.write('')
+        self.stdout.write('Index usage counts are since the server last started - an unused index may just be new.')
@@ -0,0 +1,37 @@
+# (c) Crown Copyright 2014 Defence Science and Technology Laboratory UK
+# Author: Rich Brantingham
+
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+
+from ideasapp import documents
+from projectsapp import documents as project_documents
+from contentapp import documents as content_documents
+from ideaworks.comment_store import comments_in_collection, move_embedded_comments
+
+class Command(BaseCommand):
+    """ Moves the comments embedded in ideas, projects and feedback into each app's
+        comment collection, for COMMENT_STORAGE = 'collection'. Safe to re-run: only
+        documents that still have embedded comments are touched. """
+    
+    help = 'Moves embedded idea, project and feedback comments into their comment collections.'
+    
+    option_list = BaseCommand.option_list + (
+        make_option('--dry-run', action='store_true', dest='dry_run', default=False,
+                    help='Only report how many comments would be moved.'),
+        )
+
+    def handle(self, *args, **options):
+        
+        sources = [('idea',     documents.Idea,             documents.StoredComment),
+                   ('project',  project_documents.Project,  project_documents.StoredComment),
+                   ('feedback', content_documents.Feedback, content_documents.StoredComment)]
+        
+        for name, document_class, stored_class in sources:
+            moved_docs, moved_comments, skipped = move_embedded_comments(document_class, stored_class, dry_run=options['dry_run'])
+            self.stdout.write('%s: %s %s comments from %s documents. %s skipped (commented on part way - re-run to move them).' % (
+                              name, 'would move' if options['dry_run'] else 'moved', moved_comments, moved_docs, skipped))
+        
+        if not comments_in_collection():
+            self.stdout.write('COMMENT_STORAGE is not \'collection\' - new comments will still be embedded.')
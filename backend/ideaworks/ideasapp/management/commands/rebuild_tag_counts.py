@@ -0,0 +1,34 @@
+# (c) Crown Copyright 2014 Defence Science and Technology Laboratory UK 
+# Author: Rich Brantingham
+
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+
+from ideasapp import documents
+from projectsapp import documents as project_documents
+
+class Command(BaseCommand):
+    """ Rebuilds the materialized tag counts from the idea and project collections
+        and reports any drift between the stored and actual counts. """
+    
+    help = 'Rebuilds the idea and project tag counts from scratch and reports any drift.'
+    
+    option_list = BaseCommand.option_list + (
+        make_option('--dry-run', action='store_true', dest='dry_run', default=False,
+                    help='Only report the drift, don\'t rewrite the counts.'),
+        )
+
+    def handle(self, *args, **options):
+        
+        sources = {'idea'    : documents.Idea,
+                   'project' : project_documents.Project}
+        drift = documents.rebuild_tag_counts(sources, dry_run=options['dry_run'])
+        
+        for text, source, status, stored, actual in drift:
+            self.stdout.write('%s [%s/%s]: stored %s, actual %s' % (text, source, status, stored, actual))
+        
+        if options['dry_run']:
+            self.stdout.write('%s tag counts have drifted.' % (len(drift)))
+        else:
+            self.stdout.write('Rebuilt tag counts. %s had drifted.' % (len(drift)))
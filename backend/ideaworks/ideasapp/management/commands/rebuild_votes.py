@@ -0,0 +1,23 @@
+# (c) Crown Copyright 2014 Defence Science and Technology Laboratory UK
+# Author: Rich Brantingham
+
+from django.core.management.base import BaseCommand
+
+from ideasapp import documents
+from projectsapp import documents as project_documents
+from ideaworks.votes import rebuild_votes
+
+class Command(BaseCommand):
+    """ Loads the likes and dislikes embedded in ideas and the backs embedded in projects
+        into the vote collection, so that duplicates of votes made before it existed are
+        turned away by its unique index. Safe to re-run: each vote is upserted. """
+    
+    help = 'Loads the embedded idea likes/dislikes and project backs into the vote collection.'
+
+    def handle(self, *args, **options):
+        
+        sources = [(documents.Idea,            {'likes' : 'like', 'dislikes' : 'dislike'}),
+                   (project_documents.Project, {'backs' : 'back'})]
+        
+        loaded = rebuild_votes(sources)
+        self.stdout.write('Loaded %s votes.' % (loaded))
@@ -0,0 +1,79 @@
+# (c) Crown Copyright 2014 Defence Science and Technology Laboratory UK
+# Author: Rich Brantingham
+
+import json
+from optparse import make_option
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from benchmarks.dataset import seed_dataset
+from benchmarks.runner import benchmark_databases, run_cases, save_results, compare_results
+
+class Command(BaseCommand):
+    """ Seeds a synthetic dataset into a separate mongo database (and a throwaway copy of
+        the user db), times the idea, project, tag and feedback end points over it and
+        saves the results as json - optionally comparing them with an earlier run.
+        Needs a local mongod. See benchmarks/__init__.py. """
+
+    help = 'Benchmarks the API end points over a seeded synthetic dataset.'
+
+    option_list = BaseCommand.option_list + (
+        make_option('--seed', type='int', dest='seed', default=1,
+                    help='Seed for the synthetic data - the same seed gives the same data.'),
+        make_option('--ideas', type='int', dest='ideas', default=1000,
+                    help='Number of ideas.'),
+        make_option('--projects', type='int', dest='projects', default=200,
+                    help='Number of projects.'),
+        make_option('--comments', type='int', dest='comments', default=5,
+                    help='Number of comments on each idea, project and feedback.'),
+        make_option('--users', type='int', dest='users', default=50,
+                    help='Number of users (who comment and vote).'),
+        make_option('--feedback', type='int', dest='feedback', default=100,
+                    help='Number of feedback items.'),
+        make_option('--limits', dest='limits', default='20,100',
+                    help='Comma separated page sizes to request.'),
+        make_option('--repeats', type='int', dest='repeats', default=5,
+                    help='Number of timed requests per case - the median is reported.'),
+        make_option('--anonymous', action='store_true', dest='anonymous', default=False,
+                    help='Make the requests without credentials.'),
+        make_option('--database', dest='database', default=None,
+                    help='The mongo database to seed (dropped first). Defaults to <MONGO_DATABASE_NAME>_benchmark.'),
+        make_option('--keep', action='store_true', dest='keep', default=False,
+                    help='Leave the seeded mongo database in place afterwards.'),
+        make_option('--output', dest='output', default='benchmark_results.json',
+                    help='Where to save the results.'),
+        make_option('--compare', dest='compare', default=None,
+                    help='The results of an earlier run to compare against.'),
+        )
+
+    def handle(self, *args, **options):
+
+        database = options['database'] or '%s_benchmark' % (getattr(settings, 'MONGO_DATABASE_NAME', 'ideaworks'))
+        limits = [int(limit) for limit in options['limits'].split(',') if limit.strip()]
+
+        with benchmark_databases(database, keep=options['keep']):
+
+            self.stdout.write('Seeding %s...' % (database))
+            summary = seed_dataset(seed     = options['seed'],
+                                   ideas    = options['ideas'],
+                                   projects = options['projects'],
+                                   comments = options['comments'],
+                                   users    = options['users'],
+                                   feedback = options['feedback'])
+            self.stdout.write('%(ideas)s ideas, %(projects)s projects, %(feedback)s feedback, %(comments)s comments each, '
+                              '%(votes)s votes, %(tags)s tags' % summary)
+
+            results = run_cases(summary, limits=limits, repeats=options['repeats'],
+                                anonymous=options['anonymous'], log=self.stdout.write)
+
+        save_results(results, options['output'])
+        self.stdout.write('Saved to %s' % (options['output']))
+
+        if options['compare']:
+            with open(options['compare']) as previous_file:
+                previous = json.load(previous_file)
+            self.stdout.write('')
+            self.stdout.write('Compared with %s (%s):' % (options['compare'], previous.get('run')))
+            for line in compare_results(previous, results):
+                self.stdout.write(line)
@@ -7,9 +7,16 @@ from idea_tests import Test_Filtered_GET_Idea_API
 from idea_tests import Test_Filtered_GET_Idea_API_modified_status
 from idea_tests import Test_POST_Idea_API
 from idea_tests import Test_Idea_Sorting
+from idea_tests import Test_Index_Management
 from idea_tests import Test_GET_tags
 from idea_tests import Test_Like_and_Dislike_actions
+from idea_tests import Test_Text_Search
+from idea_tests import Test_Bulk_Moderation
+from idea_tests import Test_Request_Timing
+from idea_tests import Test_Benchmarks
 from idea_tests import Test_Check_Modified
+from idea_tests import Test_Response_Cache
+from idea_tests import Test_Stored_Comments
 from idea_tests import Test_Data_Level_Responses
 from idea_tests import Test_Basic_Authentication_Functions
 from idea_tests import Test_Simple_GET_Idea_specifics
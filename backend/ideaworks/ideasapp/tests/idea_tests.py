@@ -2,27 +2,44 @@
 # (c) Crown Copyright 2014 Defence Science and Technology Laboratory UK 
 # Author: Rich Brantingham
 
+import csv
 import copy
+import logging
 import time
 import json
 import urlparse
 import datetime
+from StringIO import StringIO
 from xml.dom.minidom import parseString
 from xml.parsers.expat import ExpatError
 
+from bson.objectid import ObjectId
+
 from django.test import TestCase
 from django.core import urlresolvers
 from django.test import client
+from django.test.utils import override_settings
 from django.conf import settings
 from django.core.urlresolvers import reverse
+from django.core.management import call_command
 from django.contrib.auth.models import User
 
 from registration.models import RegistrationProfile
+from tastypie.models import ApiKey
 from tastypie_mongoengine import test_runner
 
 import ideasapp.documents as documents
 from ideasapp import api
 from ideasapp import api_functions
+from ideaworks import contributors
+from ideaworks import response_cache
+from ideaworks import api_key_cache
+from ideaworks.votes import UserVote
+from ideaworks.watermarks import get_watermark
+from ideaworks.text_search import ensure_text_index
+from ideasapp.management.commands import manage_indexes
+from benchmarks.dataset import seed_dataset
+from benchmarks.runner import run_cases
 
 class Test_Authentication_Base(test_runner.MongoEngineTestCase):
     """
@@ -117,7 +134,65 @@ class Test_Basic_Authentication_Functions(Test_Authentication_Base):
         # Add a user and build API key header
         self.user_id, self.api_key = self.add_user()
         self.headers = self.build_headers(self.user_id, self.api_key)
+        api_key_cache.api_key_cache.clear()
+        
+    def post_idea(self):
+        doc = {"title": "An idea", "description": "An idea description in here.", "status": "published"}
+        return self.c.post(self.resourceListURI('idea'), json.dumps(doc), content_type='application/json', **self.headers)
+        
+    def test_api_key_check_cached(self):
+        """ Once a key has been checked, the user comes from the cache without any SQL """
+        
+        user, key_valid = api_key_cache.get_api_key_user(self.user_id.username, self.api_key)
+        self.assertTrue(key_valid)
+        
+        hits = api_key_cache.api_key_cache.stats()['hits']
+        with self.assertNumQueries(0):
+            user, key_valid = api_key_cache.get_api_key_user(self.user_id.username, self.api_key)
+        self.assertTrue(key_valid)
+        self.assertEquals((user.pk, user.username, user.email), (self.user_id.pk, self.user_id.username, self.user_id.email))
+        self.assertEquals(api_key_cache.api_key_cache.stats()['hits'], hits + 1)
+        
+        # A wrong key is never cached
+        user, key_valid = api_key_cache.get_api_key_user(self.user_id.username, 'not-the-key')
+        self.assertFalse(key_valid)
+    
+    def test_api_key_cache_dropped_on_new_key(self):
+        """ Once the api key is changed, the old one no longer works """
+        
+        self.assertEquals(self.post_idea().status_code, 201)
+        
+        api_key = self.user_id.api_key
+        api_key.key = api_key.generate_key()
+        api_key.save()
+        
+        self.assertEquals(self.post_idea().status_code, 401)
+    
+    def test_api_key_cache_dropped_on_deactivation(self):
+        """ Once the user is deactivated, their cached key no longer works """
+        
+        self.assertEquals(self.post_idea().status_code, 201)
+        
+        self.user_id.is_active = False
+        self.user_id.save()
+        
+        self.assertEquals(self.post_idea().status_code, 401)
         
+    def test_api_key_cache_dropped_by_other_process(self):
+        """ A key revoked by another process (so no signal in this one) stops working here too """
+        
+        user, key_valid = api_key_cache.get_api_key_user(self.user_id.username, self.api_key)
+        self.assertTrue(key_valid)
+        
+        # The key changes without a signal here - this process's entry is still there...
+        ApiKey.objects.filter(user=self.user_id).update(key='revoked')
+        user, key_valid = api_key_cache.get_api_key_user(self.user_id.username, self.api_key)
+        self.assertTrue(key_valid)
+        
+        # ...until the other process moves the shared generation on
+        response_cache.get_response_cache().set('api_key_generation:%s' % (self.user_id.pk), 'a-new-generation')
+        user, key_valid = api_key_cache.get_api_key_user(self.user_id.username, self.api_key)
+        self.assertFalse(key_valid)
         
     def test_no_auth_required_on_GET(self):
         """ Authentication block on a post request """
@@ -185,6 +260,19 @@ class Test_Simple_GET_Idea_API(Test_Authentication_Base):
             self.doc_locations.append(response['location'])
             self.assertEqual(response.status_code, 201)
 
+    def test_compact_and_pretty_json(self):
+        """ Json is compact unless ?pretty=1 is asked for - and both hold the same data """
+        
+        compact = self.c.get('/api/v1/idea/?data_level=more', **self.headers)
+        pretty = self.c.get('/api/v1/idea/?data_level=more&pretty=1', **self.headers)
+        self.assertEquals(compact.status_code, 200)
+        self.assertEquals(pretty.status_code, 200)
+        
+        self.assertNotIn('\n', compact.content)
+        self.assertIn('\n  ', pretty.content)
+        self.assertLess(len(compact.content), len(pretty.content))
+        self.assertEquals(json.loads(compact.content), json.loads(pretty.content))
+
     def test_get_to_check_failure_anon(self):
         """ Test to check that new status code isn't backwards breaking"""
         
@@ -241,7 +329,8 @@ class Test_Simple_GET_Idea_API(Test_Authentication_Base):
         
         response = self.c.get('/api/%s/idea/?format=csv'%(self.api_name), **self.headers)
         self.assertEquals(response.status_code, 200)
-        lines = response.content.split('\n')
+        # Streamed from the db
+        lines = ''.join(response.streaming_content).split('\n')
         self.assertEquals(len(lines), 4)
         
         # Split up each line
@@ -254,7 +343,33 @@ class Test_Simple_GET_Idea_API(Test_Authentication_Base):
         for i in range(len(line_items)-2):
             self.assertEquals(len(line_items[i]), len(line_items[i+1]))   
 
-    def test_get_wrong_resource(self):
+    def test_get_csv_list_columns_fixed_by_data_level(self):
+        """ The csv columns come from the data_level - less any that can't go in a cell """
+        
+        response = self.c.get('/api/%s/idea/?format=csv&data_level=less&order_by=title'%(self.api_name), **self.headers)
+        self.assertEquals(response.status_code, 200)
+        rows = list(csv.reader(''.join(response.streaming_content).splitlines()))
+        
+        self.assertEquals(rows[0], ['contributor_name', 'id', 'title', 'created', 'informal_created', 'comment_count',
+                                    'like_count', 'dislike_count', 'tag_count', 'tags', 'classification_short',
+                                    'status', 'vote_score'])
+        self.assertEquals(len(rows), 3)
+        self.assertEquals(rows[1][0], 'Bob Roberts')
+        self.assertEquals(rows[1][2], 'The first idea.')
+        self.assertEquals(rows[1][10], 'PU')
+
+    def test_get_csv_list_paged(self):
+        """ ?limit= and ?offset= page the csv as they do the list """
+        
+        response = self.c.get('/api/%s/idea/?format=csv&data_level=less&order_by=title&limit=1&offset=1'%(self.api_name), **self.headers)
+        self.assertEquals(response.status_code, 200)
+        rows = list(csv.reader(''.join(response.streaming_content).splitlines()))
+        self.assertEquals(len(rows), 2)
+        self.assertEquals(rows[1][2], 'The second idea.')
+        
+        response = self.c.get('/api/%s/idea/?format=csv&limit=x'%(self.api_name), **self.headers)
+        self.assertEquals(response.status_code, 400)
+
         """ Fail to retrieve resource because of incorrect name """
         
         response = self.c.get('/api/%s/ideax'%(self.api_name), **self.headers)
@@ -522,6 +637,26 @@ class Test_Filtered_GET_Idea_API(Test_Authentication_Base):
         self.assertEquals(objects[0]['tags'], ["physics","history"])
         self.assertEquals(objects[1]['tags'], ["history","design"])
 
+    def test_filter_by_multiple_tags_ranked_across_pages(self):
+        """ The ranking on matching tags is applied before the results are paged """
+        
+        response = self.c.get(self.resourceListURI('idea')+'?data_level=less&tags__in=history,maths,geography&limit=2&offset=3', **self.headers)
+        meta, objects = self.get_meta_and_objects(response)
+        self.assertEqual(meta['total_count'], 6)
+        self.assertEquals(len(objects), 2)
+        
+        # The 2 ideas tagged only with history come last
+        self.assertEquals(objects[0]['tags'], ["physics","history"])
+        self.assertEquals(objects[1]['tags'], ["history","design"])
+
+    def test_filter_by_multiple_tags_ranked_then_ordered(self):
+        """ Ideas matching the same number of tags fall back to the order_by """
+        
+        response = self.c.get(self.resourceListURI('idea')+'?data_level=less&tags__in=physics,history&order_by=-created&limit=2', **self.headers)
+        meta, objects = self.get_meta_and_objects(response)
+        self.assertEquals(objects[0]['tags'], ["physics","history"])
+        self.assertEquals(objects[1]['tags'], ["history","design"])
+
 #@utils.override_settings(DEBUG=True)
 class Test_Filtered_GET_Idea_API_modified_status(Test_Authentication_Base):
 
@@ -716,6 +851,34 @@ class Test_Filtered_GET_Idea_API_modified_status(Test_Authentication_Base):
         self.assertEquals(len(objects), 3)
         self.assertEqual(meta['total_count'], 3)
 
+    def test_staff_filter_by_status_multiple_not_own(self):
+        """ Staff users see all objects of the requested statuses, not just their own """
+        
+        staff_user, staff_api_key = self.add_user(email='sue@sue.com', first_name='sue', last_name='susan')
+        staff_user = self.give_privileges(staff_user, priv='staff')
+        staff_headers = self.build_headers(staff_user, staff_api_key)
+        
+        response = self.c.get(self.resourceListURI('idea')+'?status__in=draft,hidden,deleted', **staff_headers)
+        meta, objects = self.get_meta_and_objects(response)
+        self.assertEquals(len(objects), 4)
+        self.assertEqual(meta['total_count'], 4)
+
+    def test_anonymous_status_provided(self):
+        """ Anonymous users only see published objects, even when asking for other statuses """
+        
+        response = self.c.get(self.resourceListURI('idea')+'?status__in=published,draft')
+        meta, objects = self.get_meta_and_objects(response)
+        self.assertEquals(len(objects), 2)
+        self.assertEqual(meta['total_count'], 2)
+
+    def test_status_provided_paginated_count(self):
+        """ Counting and pagination happen after the visibility rules have been applied """
+        
+        response = self.c.get(self.resourceListURI('idea')+'?status__in=published,draft&limit=1', **self.headers)
+        meta, objects = self.get_meta_and_objects(response)
+        self.assertEquals(len(objects), 1)
+        self.assertEqual(meta['total_count'], 4)
+
 
 #@utils.override_settings(DEBUG=True)
 class Test_POST_Idea_API(Test_Authentication_Base):
@@ -757,6 +920,24 @@ class Test_POST_Idea_API(Test_Authentication_Base):
         self.assertEquals(meta['total_count'], 1)
         self.assertEquals(len(objects), 1)
         
+    def test_POST_stores_description_snippet(self):
+        """ The tag-cleaned snippet is stored with the idea, not derived on each read """
+        
+        doc = {"title": "The idea.",
+               "description": "<p>Idea <b>description</b> in here.</p>",
+               "status":"published",
+               "protective_marking" : self.pm}
+        
+        response = self.c.post(self.resourceListURI('idea'), json.dumps(doc), content_type='application/json', **self.headers)
+        self.assertEqual(response.status_code, 201)
+        
+        raw = documents.Idea._get_collection().find_one({'title' : 'The idea.'})
+        self.assertEquals(raw['description_snippet'], 'Idea description in here.')
+        
+        response = self.c.get(self.resourceListURI('idea'), **self.headers)
+        objects = json.loads(response.content)['objects']
+        self.assertEquals(objects[0]['description_snippet'], 'Idea description in here.')
+        
     def test_POST_simple_usercheck(self):
         """ Test that created and user get automatically added"""
         
@@ -866,6 +1047,58 @@ class Test_POST_Idea_API(Test_Authentication_Base):
         resp = self.c.post(comments_uri, json.dumps(new_comment), content_type='application/json', **self.headers) 
         self.assertEquals(resp.status_code, 400)
         self.assertEquals(json.loads(resp.content)['error'], 'User can only comment on ideas with status=published.')
+
+    def test_PATCH_bulk_create(self):
+        """ A PATCH to the list creates a batch of ideas, reporting the ones that failed """
+        
+        docs = {"objects" : [{"title": "Idea #%s"%(i),
+                              "description": "An idea description in here.",
+                              "tags" : ["workshop", "idea %s"%(i)],
+                              "protective_marking" : self.pm,
+                              "status": "published"} for i in range(3)]}
+        # Too long a title
+        docs['objects'][1]['title'] = 'x' * 300
+        
+        before = datetime.datetime.utcnow()
+        response = self.c.patch(self.resourceListURI('idea'), json.dumps(docs), content_type='application/json', **self.headers)
+        self.assertEquals(response.status_code, 202)
+        meta, objects = self.get_meta_and_objects(response)
+        self.assertEquals(meta['created'], 2)
+        self.assertEquals(meta['failed'], 1)
+        self.assertEquals([obj['index'] for obj in objects], [0, 1, 2])
+        self.assertIn('title', objects[1]['errors'])
+        
+        # The ideas are there, prepared as a POST would be
+        response = self.c.get(self.fullURItoAbsoluteURI(objects[2]['resource_uri']), **self.headers)
+        idea = json.loads(response.content)['objects'][0]
+        self.assertEquals(idea['user'], self.user.username)
+        self.assertEquals(idea['tags'], ['workshop', 'idea 2'])
+        self.assertEquals(idea['tag_count'], 2)
+        self.assertEquals(idea['vote_score'], 0)
+        
+        # The tag counts and the watermark are updated for the batch
+        counts = dict(documents.read_tag_counts(['idea']))
+        self.assertEquals(counts['workshop'], 2)
+        self.assertNotIn('idea 1', counts)
+        self.assertTrue(get_watermark('idea') >= before)
+
+    def test_PATCH_bulk_create_only_creates(self):
+        """ Updates and deletes aren't taken in bulk """
+        
+        doc = {"title": "The first idea.", "description": "First idea description in here.", "status" : "published"}
+        response = self.c.post(self.resourceListURI('idea'), json.dumps(doc), content_type='application/json', **self.headers)
+        idea_uri = self.fullURItoAbsoluteURI(response['location'])
+        
+        docs = {"objects" : [{"resource_uri" : idea_uri, "title" : "An update."}]}
+        response = self.c.patch(self.resourceListURI('idea'), json.dumps(docs), content_type='application/json', **self.headers)
+        self.assertEquals(response.status_code, 400)
+        meta, objects = self.get_meta_and_objects(response)
+        self.assertEquals(meta['created'], 0)
+        
+        docs = {"objects" : [], "deleted_objects" : [idea_uri]}
+        response = self.c.patch(self.resourceListURI('idea'), json.dumps(docs), content_type='application/json', **self.headers)
+        self.assertEquals(response.status_code, 400)
+        self.assertEquals(documents.Idea.objects.count(), 1)
         
         
     ## Add some more tags
@@ -968,6 +1201,69 @@ class Test_GET_tags(Test_Authentication_Base):
         tags = json.loads(response.content)['objects']
         self.assertEquals(len(tags), 3)
         
+    def get_tag_counts(self, params=''):
+        """ Gets the tag cloud as a dict of {text : count} """
+        
+        response = self.c.get(self.resourceListURI('tag')+params, **self.headers)
+        return dict([(tag['text'], tag['count']) for tag in json.loads(response.content)['objects']])
+
+    def test_tag_counts_follow_edits(self):
+        """ Tag counts change when tags or the status of an idea are edited, and when it is deleted."""
+        
+        docs = [{"title": "First idea.",  "status" : "published", "tags" : ["idea", "ideaworks", "physics"]},
+                {"title": "Second idea.", "status" : "published", "tags" : ["idea", "ideaworks"]}]
+        for doc in docs:
+            response = self.c.post(self.resourceListURI('idea'), json.dumps(doc), content_type='application/json', **self.headers)
+            self.assertEqual(response.status_code, 201)
+        idea_uri = self.fullURItoAbsoluteURI(response['location'])
+        
+        self.assertEquals(self.get_tag_counts(), {'idea' : 2, 'ideaworks' : 2, 'physics' : 1})
+        
+        # Edit the tags
+        response = self.c.patch(idea_uri, json.dumps({"tags" : ["idea", "maths"]}), content_type='application/json', **self.headers)
+        self.assertEquals(self.get_tag_counts(), {'idea' : 2, 'ideaworks' : 1, 'physics' : 1, 'maths' : 1})
+        
+        # Change the status
+        response = self.c.patch(idea_uri, json.dumps({"status" : "draft"}), content_type='application/json', **self.headers)
+        self.assertEquals(self.get_tag_counts('?status=published'), {'idea' : 1, 'ideaworks' : 1, 'physics' : 1})
+        self.assertEquals(self.get_tag_counts('?status=draft'), {'idea' : 1, 'maths' : 1})
+        
+        # Delete it
+        response = self.c.delete(idea_uri, **self.headers)
+        self.assertEquals(self.get_tag_counts(), {'idea' : 1, 'ideaworks' : 1, 'physics' : 1})
+
+    def test_tag_counts_follow_list_delete(self):
+        """ Deleting ideas through the list takes their tags out of the counts."""
+        
+        docs = [{"title": "First idea.",  "status" : "published", "tags" : ["idea", "ideaworks", "physics"]},
+                {"title": "Second idea.", "status" : "published", "tags" : ["idea", "ideaworks"]}]
+        for doc in docs:
+            response = self.c.post(self.resourceListURI('idea'), json.dumps(doc), content_type='application/json', **self.headers)
+            self.assertEqual(response.status_code, 201)
+        self.assertEquals(self.get_tag_counts(), {'idea' : 2, 'ideaworks' : 2, 'physics' : 1})
+        
+        response = self.c.delete(self.resourceListURI('idea'), **self.headers)
+        self.assertEquals(response.status_code, 204)
+        self.assertEquals(self.get_tag_counts(), {})
+        self.assertEquals(documents.rebuild_tag_counts({'idea' : documents.Idea}, dry_run=True), [])
+
+    def test_rebuild_tag_counts_reports_drift(self):
+        """ Rebuilding the tag counts puts right (and reports) any drift."""
+        
+        doc = {"title": "First idea.",  "status" : "published", "tags" : ["idea", "ideaworks"]}
+        response = self.c.post(self.resourceListURI('idea'), json.dumps(doc), content_type='application/json', **self.headers)
+        self.assertEqual(response.status_code, 201)
+        
+        self.assertEquals(documents.rebuild_tag_counts({'idea' : documents.Idea}, dry_run=True), [])
+        
+        # Knock a count out of step
+        documents.update_tag_counts('idea', None, None, ['idea'], 'published')
+        self.assertEquals(self.get_tag_counts(), {'idea' : 2, 'ideaworks' : 1})
+        
+        drift = documents.rebuild_tag_counts({'idea' : documents.Idea})
+        self.assertEquals(drift, [('idea', 'idea', 'published', 2, 1)])
+        self.assertEquals(self.get_tag_counts(), {'idea' : 1, 'ideaworks' : 1})
+        
 #@utils.override_settings(DEBUG=True)
 class Test_Like_and_Dislike_actions(Test_Authentication_Base):
     
@@ -1025,6 +1321,39 @@ class Test_Like_and_Dislike_actions(Test_Authentication_Base):
         response = self.c.get(self.resource_uri, **self.headers)
         self.assertEquals(json.loads(response.content)['objects'][0]['dislike_count'], 1)
 
+    def test_like_then_dislike_returns_consistent_votes(self):
+        """ A like flipped to a dislike comes back with matching counts and score,
+            and leaves the stored idea in the same state. """
+        
+        likes_uri = self.fullURItoAbsoluteURI(self.resource_uri) + 'likes/'
+        dislikes_uri = self.fullURItoAbsoluteURI(self.resource_uri) + 'dislikes/'
+        
+        response = self.c.post(likes_uri, json.dumps({}), content_type='application/json', **self.headers)
+        self.assertEquals(response.status_code, 201)
+        votes = json.loads(response.content)
+        self.assertEquals(votes['like_count'], 1)
+        self.assertEquals(votes['dislike_count'], 0)
+        
+        # Liking again changes nothing
+        response = self.c.post(likes_uri, json.dumps({}), content_type='application/json', **self.headers)
+        self.assertEquals(response.status_code, 200)
+        self.assertEquals(json.loads(response.content)['like_count'], 1)
+        
+        response = self.c.post(dislikes_uri, json.dumps({"comment" : {"title":"changed my mind"}}), content_type='application/json', **self.headers)
+        self.assertEquals(response.status_code, 201)
+        votes = json.loads(response.content)
+        self.assertEquals(votes['like_count'], 0)
+        self.assertEquals(votes['dislike_count'], 1)
+        
+        idea = documents.Idea.objects.get(id=self.resource_uri.strip('/').split('/')[-1])
+        self.assertEquals(len(idea.likes), 0)
+        self.assertEquals(len(idea.dislikes), 1)
+        self.assertEquals(idea.like_count, 0)
+        self.assertEquals(idea.dislike_count, 1)
+        self.assertEquals(idea.vote_score, votes['vote_score'])
+        self.assertEquals(idea.comment_count, 1)
+        self.assertEquals(idea.comments[0].type, 'dislike')
+
     def test_dislike_an_idea_2_users(self):
         """ userA likes an idea. UserA tries to like it again - it should fail.
             userB likes an idea and it registers. """
@@ -1448,6 +1777,95 @@ class Test_Like_and_Dislike_actions(Test_Authentication_Base):
         meta, objects = self.get_meta_and_objects(response)
         self.assertEquals(objects[0]['user_voted'], -1)
         
+    def test_votes_kept_in_vote_collection(self):
+        """ A like is recorded in the vote collection, and switching to a dislike updates it """
+        
+        idea_id = self.resource_uri.strip('/').split('/')[-1]
+        idea_uri = self.fullURItoAbsoluteURI(self.resource_uri)
+        
+        self.c.post(idea_uri + 'likes/', json.dumps({}), content_type='application/json', **self.headers)
+        votes = UserVote.objects(target=idea_id)
+        self.assertEquals([(vote.user, vote.type) for vote in votes], [(self.user.username, 'like')])
+        
+        self.c.post(idea_uri + 'dislikes/', json.dumps({}), content_type='application/json', **self.headers)
+        votes = UserVote.objects(target=idea_id)
+        self.assertEquals([(vote.user, vote.type) for vote in votes], [(self.user.username, 'dislike')])
+        
+        doc = documents.Idea.objects.get(id=idea_id)
+        self.assertEquals((doc.like_count, doc.dislike_count), (0, 1))
+
+    def test_duplicate_turned_away_by_vote_collection(self):
+        """ A vote already in the vote collection is a duplicate, without reading the likes list """
+        
+        idea_id = self.resource_uri.strip('/').split('/')[-1]
+        UserVote(target=idea_id, user=self.user.username, type='like').save()
+        
+        response = self.c.post(self.fullURItoAbsoluteURI(self.resource_uri) + 'likes/', json.dumps({}), content_type='application/json', **self.headers)
+        self.assertEquals(json.loads(response.content)['like_count'], 0)
+        self.assertEquals(documents.Idea.objects.get(id=idea_id).like_count, 0)
+
+    def test_user_voted_for_a_page(self):
+        """ user_voted is right for every idea on a page """
+        
+        uris = [self.fullURItoAbsoluteURI(self.resource_uri)]
+        for title in ['Second idea.', 'Third idea.']:
+            doc = {"title": title, "description" : "Another idea.", "status" : "published"}
+            response = self.c.post(self.resourceListURI('idea'), json.dumps(doc), content_type='application/json', **self.headers)
+            uris.append(self.fullURItoAbsoluteURI(response['location']))
+        
+        self.c.post(uris[0] + 'likes/', json.dumps({}), content_type='application/json', **self.headers)
+        self.c.post(uris[1] + 'dislikes/', json.dumps({}), content_type='application/json', **self.headers)
+        
+        response = self.c.get(self.resourceListURI('idea'), **self.headers)
+        meta, objects = self.get_meta_and_objects(response)
+        user_voted = dict([(obj['title'], obj['user_voted']) for obj in objects])
+        self.assertEquals(user_voted, {'First idea.' : 1, 'Second idea.' : -1, 'Third idea.' : 0})
+
+    def test_user_voted_before_rebuild_votes(self):
+        """ Until the vote collection is loaded, user_voted is read from the embedded lists """
+        
+        idea_id = self.resource_uri.strip('/').split('/')[-1]
+        documents.Idea.objects(id=idea_id).update(**{'push__dislikes' : documents.Vote(user=self.user.username), 'set__dislike_count' : 1})
+        self.assertEquals(UserVote.objects.count(), 0)
+        
+        response = self.c.get(self.resource_uri, **self.headers)
+        self.assertEquals(json.loads(response.content)['objects'][0]['user_voted'], -1)
+        response = self.c.get(self.resourceListURI('idea'), **self.headers)
+        meta, objects = self.get_meta_and_objects(response)
+        self.assertEquals(objects[0]['user_voted'], -1)
+
+    def test_rebuild_votes(self):
+        """ Votes from before the vote collection are loaded into it, and then block duplicates """
+        
+        idea_id = self.resource_uri.strip('/').split('/')[-1]
+        documents.Idea.objects(id=idea_id).update(**{'push__likes' : documents.Vote(user=self.user.username), 'set__like_count' : 1})
+        self.assertEquals(UserVote.objects(target=idea_id).count(), 0)
+        
+        call_command('rebuild_votes', stdout=StringIO())
+        self.assertEquals(UserVote.objects.get(target=idea_id).type, 'like')
+        
+        response = self.c.post(self.fullURItoAbsoluteURI(self.resource_uri) + 'likes/', json.dumps({}), content_type='application/json', **self.headers)
+        self.assertEquals(documents.Idea.objects.get(id=idea_id).like_count, 1)
+        
+    def test_list_delete_removes_votes_and_comments(self):
+        """ Deleting ideas through the list takes their votes and stored comments with them """
+        
+        idea_id = self.resource_uri.strip('/').split('/')[-1]
+        idea_uri = self.fullURItoAbsoluteURI(self.resource_uri)
+        self.c.post(idea_uri + 'likes/', json.dumps({}), content_type='application/json', **self.headers)
+        self.assertEquals(UserVote.objects(target=idea_id).count(), 1)
+        
+        with self.settings(COMMENT_STORAGE='collection'):
+            self.c.post(idea_uri + 'comments/', json.dumps({"title" : "A comment", "body" : "A comment body."}), content_type='application/json', **self.headers)
+            self.assertEquals(documents.StoredComment.objects(parent_id=idea_id).count(), 1)
+            
+            response = self.c.delete(self.resourceListURI('idea'), **self.headers)
+            self.assertEquals(response.status_code, 204)
+        
+        self.assertEquals(documents.Idea.objects(id=idea_id).count(), 0)
+        self.assertEquals(UserVote.objects(target=idea_id).count(), 0)
+        self.assertEquals(documents.StoredComment.objects(parent_id=idea_id).count(), 0)
+        
     #===============================================================================
     # DIFFERENT WAYS OF QUERYING THE COMMENTS API - by user? by title?
     #===============================================================================
@@ -1584,8 +2002,301 @@ class Test_Idea_Sorting(Test_Authentication_Base):
             if this_like_count and next_like_count:
                 self.assertGreater(next_like_count, this_like_count)
                 
+    def test_doc_keyset_paging_by_cursor(self):
+        """ Page through the ideas by cursor - every idea once, in order """
+        
+        response = self.c.get('/api/v1/idea/?order_by=-created&limit=3', **self.headers)
+        meta, objects = self.get_meta_and_objects(response)
+        self.assertEquals(meta['total_count'], 10)
+        ids = [obj['id'] for obj in objects]
+        created = [obj['created'] for obj in objects]
+        
+        while meta['next_cursor']:
+            response = self.c.get('/api/v1/idea/?order_by=-created&limit=3&cursor=%s'%(meta['next_cursor']), **self.headers)
+            meta, objects = self.get_meta_and_objects(response)
+            self.assertEquals(meta['total_count'], None)
+            self.assertLessEqual(len(objects), 3)
+            ids += [obj['id'] for obj in objects]
+            created += [obj['created'] for obj in objects]
+        
+        self.assertEquals(len(ids), 10)
+        self.assertEquals(len(set(ids)), 10)
+        self.assertEquals(created, sorted(created, reverse=True))
+        
+    def test_doc_keyset_paging_no_limit(self):
+        """ limit=0 (as the front end sends for some views) gives every idea, with no cursor """
+        
+        for uri in ['/api/v1/idea/?limit=0', '/api/v1/idea/?order_by=-created&limit=0']:
+            response = self.c.get(uri, **self.headers)
+            self.assertEquals(response.status_code, 200)
+            meta, objects = self.get_meta_and_objects(response)
+            self.assertEquals(len(objects), 10)
+            self.assertEquals(meta['next_cursor'], None)
+        
+    def test_doc_keyset_paging_bad_cursor(self):
+        """ A cursor that can't be read, or was made for another order, is a bad request """
+        
+        response = self.c.get('/api/v1/idea/?order_by=-created&cursor=not-a-cursor', **self.headers)
+        self.assertEquals(response.status_code, 400)
+        
+        response = self.c.get('/api/v1/idea/?order_by=-created&limit=3', **self.headers)
+        meta, objects = self.get_meta_and_objects(response)
+        response = self.c.get('/api/v1/idea/?order_by=title&cursor=%s'%(meta['next_cursor']), **self.headers)
+        self.assertEquals(response.status_code, 400)
+        
     ## MORE TESTS FOR DIFFERENT SORT FIELDS ##    
 
+#@utils.override_settings(DEBUG=True)
+class Test_Index_Management(Test_Authentication_Base):
+
+    def test_declared_indexes_created_and_undeclared_kept(self):
+        """ manage_indexes creates the declared indexes and leaves any others alone by default """
+        
+        collection = documents.Idea._get_collection()
+        collection.drop_indexes()
+        collection.ensure_index([('title', 1)], name='title_1')
+        
+        out = StringIO()
+        call_command('manage_indexes', stdout=out)
+        
+        existing = manage_indexes.get_existing_indexes(documents.Idea)
+        self.assertIn('title_1', existing)
+        for keys in manage_indexes.get_declared_keys(documents.Idea):
+            self.assertIn(keys, existing.values())
+        self.assertIn('idea: not dropping undeclared title_1', out.getvalue())
+
+    def test_unused_undeclared_indexes_dropped_when_asked(self):
+        """ --drop-undeclared drops an undeclared index that hasn't been used """
+        
+        collection = documents.Idea._get_collection()
+        collection.ensure_index([('title', 1)], name='title_1')
+        
+        call_command('manage_indexes', drop_undeclared=True, stdout=StringIO())
+        
+        self.assertNotIn('title_1', manage_indexes.get_existing_indexes(documents.Idea))
+
+    def test_dry_run_changes_nothing(self):
+        """ A dry run reports the undeclared index but leaves it alone """
+        
+        collection = documents.Idea._get_collection()
+        collection.ensure_index([('title', 1)], name='title_1')
+        
+        out = StringIO()
+        call_command('manage_indexes', dry_run=True, drop_undeclared=True, stdout=out)
+        
+        self.assertIn('would drop index title_1', out.getvalue())
+        self.assertIn('title_1', manage_indexes.get_existing_indexes(documents.Idea))
+
+    def test_list_queries_use_an_index(self):
+        """ The report shows an index (not a collection scan) for the published list """
+        
+        out = StringIO()
+        call_command('manage_indexes', stdout=out)
+        
+        report = [line for line in out.getvalue().split('\n') if "{'status': 'published'} by -created" in line]
+        self.assertTrue(len(report) > 0)
+        self.assertNotIn('COLLSCAN', report[0])
+    
+
+class Test_Text_Search(Test_Authentication_Base):
+
+    def setUp(self):
+        """ Ideas matching a search in the title, the description, or not at all """
+
+        # As manage_indexes creates it
+        ensure_text_index(documents.Idea, documents.TEXT_INDEX_WEIGHTS)
+
+        self.user, api_key = self.add_user()
+        self.headers = self.build_headers(self.user, api_key)
+        self.user2, api_key2 = self.add_user(email='dave@dave.com', first_name='dave', last_name='david')
+        self.headers2 = self.build_headers(self.user2, api_key2)
+        
+        docs = [({"title": "Quantum processing", "description": "<p>Faster <b>quantum</b> computers.</p>", "status": "published"}, self.headers),
+                ({"title": "Better batteries", "description": "Batteries built with quantum dots.", "status": "published"}, self.headers),
+                ({"title": "Quantum draft", "description": "Not ready yet.", "status": "draft"}, self.headers2),
+                ({"title": "Cheaper tea", "description": "Tea for everyone.", "status": "published"}, self.headers)]
+        for doc, headers in docs:
+            self.c.post(self.resourceListURI('idea'), json.dumps(doc), content_type='application/json', **headers)
+
+    def test_search_by_relevance(self):
+        """ Title matches come first, and only what the user can read is found """
+        
+        response = self.c.get(self.resourceListURI('idea') + '?q=quantum', **self.headers)
+        meta, objects = self.get_meta_and_objects(response)
+        self.assertEquals(meta['total_count'], 2)
+        self.assertEquals([obj['title'] for obj in objects], ['Quantum processing', 'Better batteries'])
+        self.assertGreater(objects[0]['search_score'], objects[1]['search_score'])
+        self.assertEquals(objects[0]['search_snippet'], 'Faster <em>quantum</em> computers.')
+        
+        # The owner of the draft finds it too when asking for their own
+        response = self.c.get(self.resourceListURI('idea') + '?q=quantum&status__in=published,draft', **self.headers2)
+        meta, objects = self.get_meta_and_objects(response)
+        self.assertEquals(meta['total_count'], 3)
+
+    def test_search_pages_in_the_database(self):
+        """ Each page holds the next results, in the same order """
+        
+        response = self.c.get(self.resourceListURI('idea') + '?q=quantum&limit=1', **self.headers)
+        meta, objects = self.get_meta_and_objects(response)
+        self.assertEquals(meta['total_count'], 2)
+        self.assertEquals(objects[0]['title'], 'Quantum processing')
+        
+        response = self.c.get(self.resourceListURI('idea') + '?q=quantum&limit=1&offset=1', **self.headers)
+        meta, objects = self.get_meta_and_objects(response)
+        self.assertEquals([obj['title'] for obj in objects], ['Better batteries'])
+        
+        response = self.c.get(self.resourceListURI('idea') + '?q=nothing', **self.headers)
+        meta, objects = self.get_meta_and_objects(response)
+        self.assertEquals(meta['total_count'], 0)
+
+
+class Test_Bulk_Moderation(Test_Authentication_Base):
+
+    def setUp(self):
+        """ Ideas from two users, some tagged for a campaign """
+
+        self.user, api_key = self.add_user()
+        self.headers = self.build_headers(self.user, api_key)
+        self.user2, api_key2 = self.add_user(email='dave@dave.com', first_name='dave', last_name='david')
+        self.headers2 = self.build_headers(self.user2, api_key2)
+        
+        self.ideas = []
+        for i in range(4):
+            doc = {"title": "Idea #%s"%(i), "description": "An idea description in here.", "status": "published",
+                   "tags" : ["campaign"] if i < 3 else ["other"]}
+            headers = self.headers if i % 2 == 0 else self.headers2
+            response = self.c.post(self.resourceListURI('idea'), json.dumps(doc), content_type='application/json', **headers)
+            self.ideas.append(response['location'].rstrip('/').split('/')[-1])
+        
+        self.moderate_uri = self.resourceListURI('idea') + 'moderate/'
+
+    def test_moderation_is_staff_only(self):
+        """ Other users can't change the status of ideas in bulk """
+        
+        data = {"status" : "hidden", "ids" : self.ideas}
+        response = self.c.post(self.moderate_uri, json.dumps(data), content_type='application/json', **self.headers)
+        self.assertEquals(response.status_code, 401)
+        self.assertEquals(documents.Idea.objects(status='hidden').count(), 0)
+        
+        # Nor can the status be anything other than a known one
+        self.give_privileges(self.user, 'staff')
+        data['status'] = 'spam'
+        response = self.c.post(self.moderate_uri, json.dumps(data), content_type='application/json', **self.headers)
+        self.assertEquals(response.status_code, 400)
+
+    def test_moderate_by_ids(self):
+        """ The ideas listed have their status changed, and the tag counts follow """
+        
+        self.give_privileges(self.user, 'staff')
+        data = {"status" : "hidden", "ids" : self.ideas[:2]}
+        response = self.c.post(self.moderate_uri, json.dumps(data), content_type='application/json', **self.headers)
+        self.assertEquals(response.status_code, 200)
+        self.assertEquals(json.loads(response.content)['meta']['updated'], 2)
+        
+        self.assertEquals(documents.Idea.objects(status='hidden').count(), 2)
+        self.assertEquals(dict(documents.read_tag_counts(['idea'], ['published']))['campaign'], 1)
+        self.assertEquals(dict(documents.read_tag_counts(['idea'], ['hidden']))['campaign'], 2)
+        self.assertEquals(documents.rebuild_tag_counts({'idea' : documents.Idea}, dry_run=True), [])
+
+    def test_moderate_by_filter(self):
+        """ The ideas matching the filter have their status changed; those already at it are left """
+        
+        self.give_privileges(self.user, 'staff')
+        data = {"status" : "draft", "filter" : {"tags" : ["campaign"], "user" : self.user.username}}
+        response = self.c.post(self.moderate_uri, json.dumps(data), content_type='application/json', **self.headers)
+        self.assertEquals(json.loads(response.content)['meta']['updated'], 2)
+        self.assertEquals(sorted([str(idea.id) for idea in documents.Idea.objects(status='draft')]), sorted([self.ideas[0], self.ideas[2]]))
+        
+        response = self.c.post(self.moderate_uri, json.dumps(data), content_type='application/json', **self.headers)
+        meta = json.loads(response.content)['meta']
+        self.assertEquals(meta['matched'], 2)
+        self.assertEquals(meta['updated'], 0)
+        
+        # Only known filters are taken
+        data['filter'] = {"title" : "Idea #1"}
+        response = self.c.post(self.moderate_uri, json.dumps(data), content_type='application/json', **self.headers)
+        self.assertEquals(response.status_code, 400)
+
+
+class Test_Request_Timing(Test_Authentication_Base):
+
+    def setUp(self):
+        """ A few ideas to list """
+
+        self.user, api_key = self.add_user()
+        self.headers = self.build_headers(self.user, api_key)
+        
+        for i in range(3):
+            doc = {"title": "Idea #%s"%(i), "description": "An idea description in here.", "status": "published"}
+            self.c.post(self.resourceListURI('idea'), json.dumps(doc), content_type='application/json', **self.headers)
+
+    @override_settings(SERVER_TIMING_HEADER='staff')
+    def test_server_timing_for_staff_only(self):
+        """ Only staff get the stages in a Server-Timing header """
+        
+        response = self.c.get(self.resourceListURI('idea'), **self.headers)
+        self.assertEquals(response.status_code, 200)
+        self.assertFalse(response.has_header('Server-Timing'))
+        
+        self.give_privileges(self.user, 'staff')
+        response = self.c.get(self.resourceListURI('idea'), **self.headers)
+        stages = [entry.split(';')[0] for entry in response['Server-Timing'].split(', ')]
+        for stage in ['auth', 'query', 'dehydrate', 'alter', 'max_pm', 'serialize', 'total']:
+            self.assertIn(stage, stages)
+        self.assertIn('desc="dehydrate x3"', response['Server-Timing'])
+
+    def test_timing_logged(self):
+        """ Each request's stages go to the django.request log as one line """
+        
+        log = StringIO()
+        handler = logging.StreamHandler(log)
+        logger = logging.getLogger('django.request')
+        logger.addHandler(handler)
+        try:
+            self.c.get(self.resourceListURI('idea'), **self.headers)
+        finally:
+            logger.removeHandler(handler)
+        
+        line = [line for line in log.getvalue().splitlines() if line.startswith('timing ')][-1]
+        fields = dict([part.split('=', 1) for part in line.split(' ')[1:]])
+        self.assertEquals(fields['method'], 'GET')
+        self.assertEquals(fields['status'], '200')
+        self.assertEquals(fields['user'], self.user.username)
+        self.assertEquals(fields['dehydrate_n'], '3')
+        self.assertTrue(float(fields['total_ms']) >= float(fields['query_ms']))
+
+
+class Test_Benchmarks(Test_Authentication_Base):
+
+    def test_dataset_is_reproducible(self):
+        """ The same seed gives the same ideas """
+        
+        def seeded_ideas():
+            seed_dataset(seed=3, ideas=10, projects=2, comments=2, users=5, feedback=2)
+            ideas = [(idea.title, idea.tags, idea.like_count, idea.dislike_count, idea.comment_count, idea.max_pm.classification)
+                     for idea in documents.Idea.objects.order_by('created')]
+            documents.Idea.drop_collection()
+            return ideas
+        
+        first = seeded_ideas()
+        self.assertEquals(len(first), 10)
+        self.assertEquals(first, seeded_ideas())
+
+    def test_run_cases(self):
+        """ Every case is served, timed and has its round-trips counted """
+        
+        summary = seed_dataset(seed=1, ideas=10, projects=5, comments=2, users=5, feedback=3)
+        results = run_cases(summary, limits=[5], repeats=1)
+        
+        cases = dict([(result['case'], result) for result in results['results']])
+        self.assertEquals(set([result['status'] for result in results['results']]), set([200]))
+        
+        idea_list = cases['idea list data_level=- limit=5']
+        self.assertTrue(idea_list['mongo_trips'] > 0)
+        self.assertIn('query', idea_list['stages_ms'])
+        self.assertIn('idea detail data_level=more limit=-', cases)
+
+
 #@utils.override_settings(DEBUG=True)
 class Test_Check_Modified(Test_Authentication_Base):
 
@@ -1712,6 +2423,87 @@ class Test_Check_Modified(Test_Authentication_Base):
         
         self.assertEquals(most_recent, datetime.datetime.strptime(meta['modified'], '%Y-%m-%dT%H:%M:%S.%f'))
 
+    def test_meta_modified_moves_on_new_comment(self):
+        """Checks that adding a comment moves the meta-level modified on """
+        
+        response = self.c.get('/api/v1/idea/', **self.headers)
+        meta, objects = self.get_meta_and_objects(response)
+        old_modified = meta['modified']
+        
+        comments_uri = self.fullURItoAbsoluteURI(objects[0]['resource_uri']) + 'comments/'
+        new_comment = {"body"   : "a later comment",
+                       "title"  : "a later comment",
+                       "protective_marking" : {"classification":"unclassified","descriptor":""}}
+        resp = self.c.post(comments_uri, json.dumps(new_comment), content_type='application/json', **self.headers)
+        self.assertEquals(resp.status_code, 201)
+        
+        response = self.c.get('/api/v1/idea/', **self.headers)
+        meta, objects = self.get_meta_and_objects(response)
+        self.assertTrue(meta['modified'] > old_modified)
+
+    def test_conditional_get_on_list(self):
+        """ A matching If-None-Match gets a 304 until something changes """
+        
+        response = self.c.get('/api/v1/idea/?data_level=meta', **self.headers)
+        self.assertEquals(response.status_code, 200)
+        etag = response['ETag']
+        self.assertTrue(response.has_header('Last-Modified'))
+        
+        response = self.c.get('/api/v1/idea/?data_level=meta', HTTP_IF_NONE_MATCH=etag, **self.headers)
+        self.assertEquals(response.status_code, 304)
+        self.assertEquals(response.content, '')
+        
+        # A different query is a different representation
+        response = self.c.get('/api/v1/idea/?data_level=min', HTTP_IF_NONE_MATCH=etag, **self.headers)
+        self.assertEquals(response.status_code, 200)
+        
+        doc = {"title": "A later idea", "description": "Changes the collection.", "status": "published"}
+        response = self.c.post(self.resourceListURI('idea'), json.dumps(doc), content_type='application/json', **self.headers)
+        self.assertEquals(response.status_code, 201)
+        
+        response = self.c.get('/api/v1/idea/?data_level=meta', HTTP_IF_NONE_MATCH=etag, **self.headers)
+        self.assertEquals(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], etag)
+
+    def test_conditional_get_on_detail(self):
+        """ If-Modified-Since on a single idea is answered from its modified """
+        
+        content = json.loads(self.c.get(self.resourceListURI('idea'), **self.headers).content)
+        idea_uri = self.fullURItoAbsoluteURI(content['objects'][0]['resource_uri'])
+        
+        response = self.c.get(idea_uri, **self.headers)
+        self.assertEquals(response.status_code, 200)
+        last_modified = response['Last-Modified']
+        
+        response = self.c.get(idea_uri, HTTP_IF_MODIFIED_SINCE=last_modified, **self.headers)
+        self.assertEquals(response.status_code, 304)
+        
+        # Comments move the idea on
+        time.sleep(1)
+        new_comment = {"body" : "a later comment", "title" : "a later comment"}
+        resp = self.c.post(idea_uri + 'comments/', json.dumps(new_comment), content_type='application/json', **self.headers)
+        self.assertEquals(resp.status_code, 201)
+        
+        response = self.c.get(idea_uri, HTTP_IF_MODIFIED_SINCE=last_modified, **self.headers)
+        self.assertEquals(response.status_code, 200)
+
+    def test_conditional_get_on_unreadable_detail(self):
+        """ A draft can't be probed with a conditional GET - it's never a 304 for those who can't read it """
+        
+        doc = {"title": "A draft idea", "description": "Not for everyone.", "status": "draft"}
+        response = self.c.post(self.resourceListURI('idea'), json.dumps(doc), content_type='application/json', **self.headers)
+        self.assertEquals(response.status_code, 201)
+        idea_uri = self.fullURItoAbsoluteURI(response['location'])
+        
+        for uri in [idea_uri, idea_uri + '?status=draft']:
+            response = self.c.get(uri, HTTP_IF_MODIFIED_SINCE='Fri, 01 Jan 2100 00:00:00 GMT')
+            self.assertNotEqual(response.status_code, 304)
+            self.assertFalse(response.has_header('Last-Modified'))
+        
+        # Its author asking for their drafts is still answered from its modified
+        response = self.c.get(idea_uri + '?status=draft', HTTP_IF_MODIFIED_SINCE='Fri, 01 Jan 2100 00:00:00 GMT', **self.headers)
+        self.assertEquals(response.status_code, 304)
+
     def test_update_idea_tag_count(self):
         """ Check that the tag count changes if its edited."""
         
@@ -1736,6 +2528,202 @@ class Test_Check_Modified(Test_Authentication_Base):
         self.assertNotEqual(old_tags, new_tags)
         self.assertEqual(new_tag_count, 5)
         
+@override_settings(RESPONSE_CACHE_ENABLED=True,
+                   CACHES={'default'   : {'BACKEND' : 'django.core.cache.backends.locmem.LocMemCache'},
+                           'responses' : {'BACKEND' : 'django.core.cache.backends.locmem.LocMemCache',
+                                          'LOCATION' : 'test_responses'}})
+class Test_Response_Cache(Test_Authentication_Base):
+
+    def setUp(self):
+        """ Add a couple of ideas and start with an empty cache """
+
+        user_id, api_key = self.add_user()
+        self.headers = self.build_headers(user_id, api_key)
+        
+        for i in range(2):
+            doc = {"title": "Idea #%s"%(i), "description": "An idea description in here.", "status": "published"}
+            response = self.c.post(self.resourceListURI('idea'), json.dumps(doc), content_type='application/json', **self.headers)
+            self.assertEquals(response.status_code, 201)
+        
+        response_cache.get_response_cache().clear()
+
+    def test_anonymous_gets_are_shared(self):
+        """ A second anonymous GET comes from the cache - even with the query params in another order -
+            but authenticated users always get a fresh response """
+        
+        response = self.c.get('/api/v1/idea/?data_level=min&order_by=title')
+        self.assertEquals(response.status_code, 200)
+        
+        # Change the data underneath the api, so a cached response shows
+        documents.Idea.objects.update(**{'set__title': 'changed behind the api'})
+        
+        response = self.c.get('/api/v1/idea/?order_by=title&data_level=min')
+        meta, objects = self.get_meta_and_objects(response)
+        self.assertEquals(objects[0]['title'], 'Idea #0')
+        
+        response = self.c.get('/api/v1/idea/?order_by=title&data_level=min', **self.headers)
+        meta, objects = self.get_meta_and_objects(response)
+        self.assertEquals(objects[0]['title'], 'changed behind the api')
+
+    def test_writes_invalidate_the_cache(self):
+        """ Writes through the api - including to sub-resources - drop the cached responses """
+        
+        response = self.c.get('/api/v1/idea/')
+        meta, objects = self.get_meta_and_objects(response)
+        self.assertEquals(len(objects), 2)
+        
+        doc = {"title": "Idea #2", "description": "An idea description in here.", "status": "published"}
+        response = self.c.post(self.resourceListURI('idea'), json.dumps(doc), content_type='application/json', **self.headers)
+        self.assertEquals(response.status_code, 201)
+        
+        response = self.c.get('/api/v1/idea/')
+        meta, objects = self.get_meta_and_objects(response)
+        self.assertEquals(len(objects), 3)
+        
+        comments_uri = self.fullURItoAbsoluteURI(objects[0]['resource_uri']) + 'comments/'
+        response = self.c.post(comments_uri, json.dumps({"title" : "a comment", "body" : "a comment"}), content_type='application/json', **self.headers)
+        self.assertEquals(response.status_code, 201)
+        
+        response = self.c.get('/api/v1/idea/')
+        meta, objects = self.get_meta_and_objects(response)
+        self.assertEquals(objects[0]['comment_count'], 1)
+
+#@utils.override_settings(DEBUG=True)
+@override_settings(COMMENT_STORAGE='collection')
+class Test_Stored_Comments(Test_Authentication_Base):
+
+    def setUp(self):
+        """ An idea to comment on """
+
+        user_id, api_key = self.add_user()
+        self.headers = self.build_headers(user_id, api_key)
+        
+        doc = {"title": "Commented idea", "description": "An idea description in here.", "status": "published"}
+        response = self.c.post(self.resourceListURI('idea'), json.dumps(doc), content_type='application/json', **self.headers)
+        self.idea_uri = self.fullURItoAbsoluteURI(response['location'])
+        self.idea_id = self.idea_uri.strip('/').split('/')[-1]
+        
+    def add_comments(self, count):
+        for i in range(count):
+            new_comment = {"title" : "Comment #%s"%(i), "body" : "A comment body."}
+            response = self.c.post(self.idea_uri + 'comments/', json.dumps(new_comment), content_type='application/json', **self.headers)
+            self.assertEquals(response.status_code, 201)
+
+    def test_comments_kept_out_of_the_idea(self):
+        """ Comments go in their own collection - the idea just keeps the count """
+        
+        self.add_comments(3)
+        
+        raw = documents.Idea._get_collection().find_one({'title' : 'Commented idea'})
+        self.assertEquals(raw.get('comments', []), [])
+        self.assertEquals(raw['comment_count'], 3)
+        self.assertEquals(documents.StoredComment.objects(parent_id=raw['_id']).count(), 3)
+
+    def test_comments_paged_by_cursor(self):
+        """ Page through the comments, oldest first - every comment once """
+        
+        self.add_comments(5)
+        
+        response = self.c.get(self.idea_uri + 'comments/?limit=2', **self.headers)
+        meta, objects = self.get_meta_and_objects(response)
+        self.assertEquals(meta['total_count'], 5)
+        titles = [obj['title'] for obj in objects]
+        
+        while meta['next_cursor']:
+            response = self.c.get(self.idea_uri + 'comments/?limit=2&cursor=%s'%(meta['next_cursor']), **self.headers)
+            meta, objects = self.get_meta_and_objects(response)
+            titles += [obj['title'] for obj in objects]
+        
+        self.assertEquals(titles, ['Comment #%s'%(i) for i in range(5)])
+
+    def test_comment_detail_and_delete(self):
+        """ A stored comment is addressed by its own id, and deleting it decrements the count """
+        
+        self.add_comments(2)
+        
+        response = self.c.get(self.idea_uri + 'comments/', **self.headers)
+        meta, objects = self.get_meta_and_objects(response)
+        comment_uri = self.fullURItoAbsoluteURI(objects[0]['resource_uri'])
+        self.assertTrue(comment_uri.startswith(self.idea_uri + 'comments/'))
+        
+        response = self.c.get(comment_uri, **self.headers)
+        self.assertEquals(response.status_code, 200)
+        
+        response = self.c.delete(comment_uri, **self.headers)
+        self.assertEquals(response.status_code, 204)
+        self.assertEquals(documents.Idea.objects.get(id=self.idea_id).comment_count, 1)
+        self.assertEquals(documents.StoredComment.objects(parent_id=self.idea_id).count(), 1)
+
+    def test_comment_marking_merged_into_idea_max_pm(self):
+        """ A new comment raises the idea's max_pm; deleting it takes the marking back down """
+        
+        pm = {"classification" : "PERSONAL", "classification_short" : "PE", "classification_rank" : 2,
+              "national_caveats_primary_name" : '', "national_caveats_members" : [],
+              "codewords" : ['BANANA 1'], "codewords_short" : ['B1'], "descriptor" : 'PRIVATE'}
+        new_comment = {"title" : "Marked comment", "body" : "A comment body.", "protective_marking" : pm}
+        response = self.c.post(self.idea_uri + 'comments/', json.dumps(new_comment), content_type='application/json', **self.headers)
+        self.assertEquals(response.status_code, 201)
+        self.assertEquals(documents.Idea.objects.get(id=self.idea_id).max_pm.classification, 'PERSONAL')
+        
+        response = self.c.get(self.idea_uri + 'comments/', **self.headers)
+        meta, objects = self.get_meta_and_objects(response)
+        response = self.c.delete(self.fullURItoAbsoluteURI(objects[0]['resource_uri']), **self.headers)
+        self.assertEquals(response.status_code, 204)
+        self.assertEquals(documents.Idea.objects.get(id=self.idea_id).max_pm.classification, 'PUBLIC')
+
+    def test_vote_comment_stored(self):
+        """ A comment that comes with a like is stored with the others """
+        
+        new_comment = {"comment" : {"title" : "heres a new comment", "body" : "heres the body of a new comment"}}
+        response = self.c.post(self.idea_uri + 'likes/', json.dumps(new_comment), content_type='application/json', **self.headers)
+        
+        response = self.c.get(self.idea_uri + 'comments/', **self.headers)
+        meta, objects = self.get_meta_and_objects(response)
+        self.assertEquals(len(objects), 1)
+        self.assertEquals(objects[0]['type'], 'like')
+        self.assertEquals(documents.Idea.objects.get(id=self.idea_id).comment_count, 1)
+
+    def test_comment_body_snippet_stored(self):
+        """ A comment's snippet is stored as it is written """
+        
+        new_comment = {"title" : "Comment", "body" : "<p>A <i>comment</i> body.</p>"}
+        response = self.c.post(self.idea_uri + 'comments/', json.dumps(new_comment), content_type='application/json', **self.headers)
+        self.assertEquals(response.status_code, 201)
+        
+        raw = documents.StoredComment._get_collection().find_one({'parent_id' : ObjectId(self.idea_id)})
+        self.assertEquals(raw['body_snippet'], 'A comment body.')
+
+    def test_backfill_snippets(self):
+        """ Ideas and comments written before snippets were stored get them from the backfill """
+        
+        documents.Idea._get_collection().insert({'title'       : 'Old idea',
+                                                 'description' : '<p>An <b>old</b> idea.</p>',
+                                                 'status'      : 'published',
+                                                 'comments'    : [{'title' : 'Old comment', 'body' : '<p>An old comment.</p>'}]})
+        documents.StoredComment._get_collection().insert({'parent_id' : ObjectId(self.idea_id), 'title' : 'Old stored comment', 'body' : '<p>Stored.</p>'})
+        
+        call_command('backfill_snippets', stdout=StringIO())
+        
+        raw = documents.Idea._get_collection().find_one({'title' : 'Old idea'})
+        self.assertEquals(raw['description_snippet'], 'An old idea.')
+        self.assertEquals(raw['comments'][0]['body_snippet'], 'An old comment.')
+        raw = documents.StoredComment._get_collection().find_one({'title' : 'Old stored comment'})
+        self.assertEquals(raw['body_snippet'], 'Stored.')
+
+    def test_move_comments(self):
+        """ Comments embedded before the switch are moved into the collection """
+        
+        with self.settings(COMMENT_STORAGE='embedded'):
+            self.add_comments(3)
+        self.assertEquals(len(documents.Idea.objects.get(id=self.idea_id).comments), 3)
+        
+        call_command('move_comments', stdout=StringIO())
+        
+        self.assertEquals(len(documents.Idea.objects.get(id=self.idea_id).comments), 0)
+        response = self.c.get(self.idea_uri + 'comments/', **self.headers)
+        meta, objects = self.get_meta_and_objects(response)
+        self.assertEquals([obj['title'] for obj in objects], ['Comment #%s'%(i) for i in range(3)])
+
 #@utils.override_settings(DEBUG=True)
 class Test_Data_Level_Responses(Test_Authentication_Base):
 
@@ -1800,6 +2788,64 @@ class Test_Data_Level_Responses(Test_Authentication_Base):
         self.assertTrue(content.has_key('meta'))
         self.assertTrue(content['meta']['modified'])
 
+    def test_response_data_min_set(self):
+        """Check that data_level=min gives exactly its fields, and still has the meta"""
+        
+        response = self.c.get('/api/v1/idea/?data_level=min', **self.headers)
+        meta, data = self.get_meta_and_objects(response)
+        self.assertEquals(sorted(data[0].keys()), sorted(settings.RESPONSE_FIELDS['min']))
+        self.assertTrue(data[0]['contributor_name'])
+        self.assertTrue(meta['max_pm'])
+        self.assertTrue(meta['modified'])
+
+    def test_max_pm_of_ideas_written_before_it_was_stored(self):
+        """ Ideas without a stored max_pm have their comments' markings read for the meta
+            (even when the comments aren't loaded), until backfill_max_pm stores it """
+        
+        pm = {'classification' : 'PERSONAL', 'classification_short' : 'PE', 'classification_rank' : 2,
+              'national_caveats_primary_name' : '', 'national_caveats_members' : [], 'national_caveats_rank' : 0,
+              'codewords' : [], 'codewords_short' : [], 'descriptor' : ''}
+        for i in range(2):
+            documents.Idea._get_collection().insert({'title'         : 'Old idea #%s' % (i),
+                                                     'description'   : 'An old idea.',
+                                                     'status'        : 'published',
+                                                     'created'       : datetime.datetime.utcnow(),
+                                                     'modified'      : datetime.datetime.utcnow(),
+                                                     'comment_count' : 1,
+                                                     'comments'      : [{'title' : 'Old comment', 'body' : 'An old comment.', 'protective_marking' : pm}]})
+        
+        response = self.c.get('/api/v1/idea/?data_level=min', **self.headers)
+        meta, data = self.get_meta_and_objects(response)
+        self.assertEquals(meta['max_pm']['classification'], 'PERSONAL')
+        
+        call_command('backfill_max_pm', stdout=StringIO())
+        
+        self.assertEquals(documents.Idea._get_collection().find({'max_pm' : {'$exists' : False}}).count(), 0)
+        raw = documents.Idea._get_collection().find_one({'title' : 'Old idea #0'})
+        self.assertEquals(raw['max_pm']['classification'], 'PERSONAL')
+
+    def test_data_level_projection(self):
+        """Check that only the fields needed for a data_level get loaded"""
+        
+        request = client.RequestFactory().get('/api/v1/idea/?data_level=min')
+        projection = api_functions.get_data_level_projection(request, documents.Idea)
+        for fld in ['title', 'modified', 'user']:
+            self.assertTrue(fld in projection)
+        for fld in ['comments', 'likes', 'dislikes', 'description']:
+            self.assertFalse(fld in projection)
+        
+        request = client.RequestFactory().get('/api/v1/idea/?data_level=more')
+        projection = api_functions.get_data_level_projection(request, documents.Idea)
+        for fld in ['description', 'likes', 'dislikes', 'protective_marking']:
+            self.assertTrue(fld in projection)
+        self.assertFalse('comments' in projection)
+        
+        # Everything for no data_level or a sub-resource
+        request = client.RequestFactory().get('/api/v1/idea/')
+        self.assertEquals(api_functions.get_data_level_projection(request, documents.Idea), None)
+        request = client.RequestFactory().get('/api/v1/idea/%s/comments/?data_level=min' % ('a' * 24))
+        self.assertEquals(api_functions.get_data_level_projection(request, documents.Idea), None)
+
 #@utils.override_settings(DEBUG=True)
 class Test_Contributor_Naming(Test_Authentication_Base):
 
@@ -1817,6 +2863,7 @@ class Test_Contributor_Naming(Test_Authentication_Base):
         # We also need a 3rd user because of the unique constraint (applied in code logic) on like/dislike fields
         user_id3, api_key3 = self.add_user(email='john@cleese.com', first_name='john', last_name='cleese')
         self.headers3 = self.build_headers(user_id3, api_key3)
+        self.users = [user_id, user_id2, user_id3]
 
 
         # Insert 10 docs with different months
@@ -1869,6 +2916,31 @@ class Test_Contributor_Naming(Test_Authentication_Base):
         response = self.c.get(self.resourceListURI('idea'), **self.headers)
         meta, objects = self.get_meta_and_objects(response)
         self.assertEquals(objects[0]['dislikes'][0]['contributor_name'], 'Dave Davidson')
+
+    def test_contributor_names_resolved_in_one_query(self):
+        """ All the contributors needed for a page are looked up together """
+        
+        contributors.name_cache.clear()
+        resolver = contributors.ContributorNameResolver()
+        names = [resolver.name_for(user.username) for user in self.users]
+        
+        with self.assertNumQueries(1):
+            self.assertEquals([unicode(name) for name in names], ['Bob Roberts', 'Dave Davidson', 'John Cleese'])
+
+    def test_contributor_name_changes_after_user_update(self):
+        """ Cached names are invalidated when the user is saved """
+        
+        response = self.c.get(self.resourceListURI('idea'), **self.headers)
+        meta, objects = self.get_meta_and_objects(response)
+        self.assertEquals(objects[0]['contributor_name'], 'Bob Roberts')
+        
+        user = self.users[0]
+        user.last_name = 'robertson'
+        user.save()
+        
+        response = self.c.get(self.resourceListURI('idea'), **self.headers)
+        meta, objects = self.get_meta_and_objects(response)
+        self.assertEquals(objects[0]['contributor_name'], 'Bob Robertson')
         
 
 
@@ -2146,6 +3218,38 @@ class Test_Get_All_PMs(TestCase):
         
         max_pm = api.get_max_pm(pm_list)
         self.assertEquals(sorted(max_pm['codewords']), sorted(codewords))
+
+    def test_get_max_pm_of_merged_pms(self):
+        """Merging already merged pms gives the same result as merging them all at once"""
+        
+        descriptors=['LOCSEN','PRIVATE','PERSONAL']
+
+        pm_list = []
+        for i in range(3):
+            pm = copy.deepcopy(self.pm)
+            pm['descriptor']=descriptors[i]
+            pm_list.append(pm)
+        
+        merged = [api_functions.merge_pms(pm_list[:2]), api_functions.merge_pms(pm_list[1:])]
+        max_pm = api.get_max_pm(merged)
+        self.assertEquals(max_pm['descriptor'], 'LOCSEN,PRIVATE,PERSONAL')
+        self.assertEquals(max_pm['national_caveats_rank'], 2)
+
+    def test_derive_document_max_pm_includes_comments(self):
+        """The effective pm of a document covers its comments"""
+        
+        comment_pm = copy.deepcopy(self.pm)
+        comment_pm['classification'] = 'PERSONAL'
+        comment_pm['classification_short'] = 'PE'
+        comment_pm['classification_rank'] = 3
+        
+        doc = documents.Idea(title='new idea',
+                             protective_marking=self.pm,
+                             comments=[documents.Comment(title='new comment', body='great idea', protective_marking=comment_pm)])
+        
+        max_pm = api_functions.derive_document_max_pm(doc)
+        self.assertEquals(max_pm['classification'], 'PERSONAL')
+        self.assertEquals(max_pm['descriptor'], 'BUSINESS')
         
 #@utils.override_settings(DEBUG=True)
 class Test_Max_PM_in_Meta(Test_Authentication_Base):
@@ -2255,6 +3359,37 @@ class Test_Max_PM_in_Meta(Test_Authentication_Base):
         
         self.assertEquals(meta['max_pm']['classification'], 'PERSONAL')
 
+    def test_stored_max_pm_follows_comments(self):
+        """ The pm stored against an idea rises with a comment and drops when it is deleted """
+
+        doc = {"title": "Idea #1", "description": "First idea description in here.", 'protective_marking' : self.pm, "status": "published"}
+        response = self.c.post(self.resourceListURI('idea'), json.dumps(doc), content_type='application/json', **self.headers)
+        self.assertEquals(response.status_code, 201)
+        idea_uri = self.fullURItoAbsoluteURI(response['location'])
+        idea_id = self.resourcePK(idea_uri)
+        self.assertEquals(documents.Idea.objects.get(id=idea_id).max_pm.classification, 'PUBLIC')
+        
+        pm = copy.deepcopy(self.pm)
+        pm['classification'] = 'PERSONAL'
+        pm['classification_short'] = 'PE'
+        pm['classification_rank'] = 3
+        new_comment = {"body"   : "perhaps we could extend that idea by...",
+                       "title"  : "and what about adding to that idea with...",
+                       "protective_marking" : pm}
+        comments_uri = idea_uri + 'comments/'
+        response = self.c.post(comments_uri, json.dumps(new_comment), content_type='application/json', **self.headers2)
+        self.assertEquals(response.status_code, 201)
+        self.assertEquals(documents.Idea.objects.get(id=idea_id).max_pm.classification, 'PERSONAL')
+        
+        response = self.c.delete(comments_uri + '0/', content_type='application/json', **self.headers)
+        self.assertEquals(response.status_code, 204)
+        self.assertEquals(documents.Idea.objects.get(id=idea_id).max_pm.classification, 'PUBLIC')
+        
+        response = self.c.get(self.resourceListURI('idea'))
+        meta, objects = self.get_meta_and_objects(response)
+        self.assertEquals(meta['max_pm']['classification'], 'PUBLIC')
+        self.assertFalse(objects[0].has_key('max_pm'))
+
 
 #----------------------------------------------------------------------------------------
 
@@ -2473,6 +3608,13 @@ class Test_Basic_API_Functions(TestCase):
         text = api_functions.derive_snippet(text_html=text, chrs=18)
         self.assertEquals(text, 'the quick brown...')
 
+    def test_derive_search_snippet(self):
+        """ The snippet starts near the first term matched, with the terms highlighted """
+        
+        text = """<b><a href="http://www.helloworld.com">the quick brown fox jumped over the lazy dog.</a></b>"""
+        text = api_functions.derive_search_snippet(text, ['lazy'], chrs=18)
+        self.assertEquals(text, '...the <em>lazy</em> dog.')
+
     def test_vote_score_low_number_of_obs(self):
         """ Like / dislike score """
         
@@ -23,6 +23,7 @@ from tastypie_mongoengine import test_runner
 from ideasapp import documents
 from ideasapp import api
 from ideasapp import api_functions
+from ideaworks import response_cache
 
 class Test_Authentication_Base(test_runner.MongoEngineTestCase):
     """
@@ -434,6 +435,38 @@ class Test_Idea_RSS_Modifications(Test_Authentication_Base):
         self.assertGreater(published_2, published_1)
 
  
+    def test_feed_is_cached_until_the_collection_changes(self):
+        """ The feed is served from the cache until the watermark moves, and honours conditional GETs """
+        
+        caches = {'default'   : {'BACKEND' : 'django.core.cache.backends.locmem.LocMemCache'},
+                  'responses' : {'BACKEND' : 'django.core.cache.backends.locmem.LocMemCache',
+                                 'LOCATION' : 'test_feeds'}}
+        
+        with self.settings(RESPONSE_CACHE_ENABLED=True, CACHES=caches):
+            response_cache.get_response_cache().clear()
+            
+            response = self.c.get(self.resourceListURI('idea')+"?format=rss", **self.headers)
+            self.assertEquals(response.status_code, 200)
+            etag = response['ETag']
+            
+            # Changed underneath the api - the cached feed is still served
+            documents.Idea.objects.update(**{'set__title': 'changed behind the api'})
+            response = self.c.get(self.resourceListURI('idea')+"?format=rss", **self.headers)
+            self.assertNotIn('changed behind the api', response.content)
+            
+            response = self.c.get(self.resourceListURI('idea')+"?format=rss", HTTP_IF_NONE_MATCH=etag, **self.headers)
+            self.assertEquals(response.status_code, 304)
+            
+            # A comment moves the watermark on, so the feed gets rebuilt
+            uri = self.doc_locations[0] + 'comments/'
+            new_data = {'title':'heres a new comment', 'body':'Here is the body of a new comment', 'protective_marking':self.pm}
+            response = self.c.post(uri, json.dumps(new_data), content_type='application/json', **self.headers)
+            self.assertEquals(response.status_code, 201)
+            
+            response = self.c.get(self.resourceListURI('idea')+"?format=rss", HTTP_IF_NONE_MATCH=etag, **self.headers)
+            self.assertEquals(response.status_code, 200)
+            self.assertIn('changed behind the api', response.content)
+
 #@utils.override_settings(DEBUG=True)
 class Test_Idea_RSS_Filtering(Test_Authentication_Base):
     
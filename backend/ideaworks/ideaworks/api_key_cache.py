@@ -0,0 +1,112 @@
+
+# (c) Crown Copyright 2014 Defence Science and Technology Laboratory UK
+# Author: Rich Brantingham
+
+"""
+Caches API key authentication for the ideas, projects and content apps.
+
+The front end sends its credentials with every request, GETs included, and
+each one cost two queries on the user db - the User, then their ApiKey. A
+successful (username, api key) check is now kept in a small process-wide
+cache, along with the user fields that the apps use (id, names, email and
+the active/staff/superuser flags), so that most requests authenticate
+without any SQL at all.
+
+Entries expire after API_KEY_CACHE_TTL seconds. Each one also records the
+user's generation, kept in the shared django 'responses' cache (file based
+by default, so every apache process sees it), and is only used while that
+generation is current. Saving or deleting the User or their ApiKey moves the
+generation on, so a changed or revoked key or a deactivated user stops
+authenticating from the cache in every process, not just the one that made
+the change. Failed checks are never cached.
+
+The user handed back from the cache is built in memory from those fields: it
+is fine for request.user, but must not be saved.
+"""
+
+import hashlib
+import uuid
+
+from django.conf import settings
+from django.db.models import signals
+
+from tastypie.compat import User, username_field
+from tastypie.models import ApiKey
+
+from ideaworks.caching import BoundedCache
+from ideaworks.response_cache import get_response_cache
+
+# Process-wide cache of (username, hashed api key) -> (user generation, user fields)
+api_key_cache = BoundedCache(max_size=getattr(settings, 'API_KEY_CACHE_SIZE', 2000),
+                             ttl=getattr(settings, 'API_KEY_CACHE_TTL', 300))
+
+# The user fields kept in the cache (id first)
+CACHED_USER_FIELDS = ('id', 'username', 'email', 'first_name', 'last_name', 'is_active', 'is_staff', 'is_superuser')
+
+#------------------------------------------------------------------------
+
+def build_cache_key(username, api_key):
+    """ The raw key isn't held in the cache """
+
+    return (username, hashlib.sha1(api_key.encode('utf-8')).hexdigest())
+
+def get_user_generation(user_id):
+    """ The user's current generation, shared between processes - changed whenever
+        the user or their api key is. A generation that has aged out of the shared
+        cache is replaced, which only means re-checking against the db. """
+
+    cache = get_response_cache()
+    key = 'api_key_generation:%s' % (user_id)
+    generation = cache.get(key)
+    if generation is None:
+        # add() so that concurrent processes agree on the first generation
+        cache.add(key, uuid.uuid4().hex)
+        generation = cache.get(key)
+
+    return generation
+
+def get_api_key_user(username, api_key):
+    """ (user, key is valid) for a username and api key. user is None if there's no such user. """
+
+    key = build_cache_key(username, api_key)
+    cached = api_key_cache.get(key)
+    if cached is not None:
+        generation, fields = cached
+        if generation == get_user_generation(fields[0]):
+            return User(**dict(zip(CACHED_USER_FIELDS, fields))), True
+        # Changed in some other process since it was cached
+        api_key_cache.delete(key)
+
+    try:
+        user = User.objects.get(**{username_field : username})
+    except (User.DoesNotExist, User.MultipleObjectsReturned):
+        return None, False
+
+    if not ApiKey.objects.filter(user=user, key=api_key).exists():
+        return user, False
+
+    api_key_cache.set(key, (get_user_generation(user.pk), tuple([getattr(user, field) for field in CACHED_USER_FIELDS])))
+    return user, True
+
+#------------------------------------------------------------------------
+
+def invalidate_user_id(user_id):
+    """ Moves the user onto a new generation (for every process) and drops this process's entries """
+
+    get_response_cache().set('api_key_generation:%s' % (user_id), uuid.uuid4().hex)
+    api_key_cache.delete_where(lambda key, value: value[1][0] == user_id)
+
+def invalidate_user(sender, instance, **kwargs):
+    """ Drop any cached authentication for a user that has changed """
+
+    invalidate_user_id(instance.pk)
+
+def invalidate_api_key(sender, instance, **kwargs):
+    """ Drop any cached authentication for a user whose api key has changed """
+
+    invalidate_user_id(instance.user_id)
+
+signals.post_save.connect(invalidate_user, sender=User, dispatch_uid='api_key_cache_user_save')
+signals.post_delete.connect(invalidate_user, sender=User, dispatch_uid='api_key_cache_user_delete')
+signals.post_save.connect(invalidate_api_key, sender=ApiKey, dispatch_uid='api_key_cache_key_save')
+signals.post_delete.connect(invalidate_api_key, sender=ApiKey, dispatch_uid='api_key_cache_key_delete')
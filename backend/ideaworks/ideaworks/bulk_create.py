@@ -0,0 +1,133 @@
+
+# (c) Crown Copyright 2014 Defence Science and Technology Laboratory UK
+# Author: Rich Brantingham
+
+"""
+Bulk creation of ideas and projects, by PATCHing the list end point.
+
+Migrating ideas from workshops and other tools meant a POST per idea, each
+one saving its document, updating the tag counts tag by tag and moving the
+watermark on. A PATCH to /idea/ (or /project/) with an 'objects' array now
+creates the whole batch:
+
+ - every object is prepared, hydrated and validated just as a POST would be
+   (user, counts, tag cleanup, vote score, max_pm),
+ - those that pass are written with one insert,
+ - the tag counts get one update per distinct tag in the batch, and the
+   watermark is moved once.
+
+Objects that fail don't stop the rest. The response lists each object by its
+position in the request, with either its resource_uri or its errors. Bulk
+PATCHes only create - objects with a resource_uri, and deleted_objects, are
+turned away.
+"""
+
+import datetime
+
+from django.conf import settings
+
+from mongoengine import ValidationError
+from tastypie import http
+from tastypie.exceptions import BadRequest, ImmediateHttpResponse, ApiFieldError
+
+from ideaworks.watermarks import touch_watermark
+
+#------------------------------------------------------------------------
+
+def get_max_batch_size():
+    """ The most objects accepted in one bulk PATCH """
+
+    return getattr(settings, 'BULK_CREATE_MAX_OBJECTS', 1000)
+
+def describe_error(error):
+    """ A message for an object that couldn't be created """
+
+    if isinstance(error, ValidationError) and error.errors:
+        return dict([(field, unicode(message)) for field, message in error.to_dict().items()])
+    return unicode(getattr(error, 'message', None) or error)
+
+#------------------------------------------------------------------------
+
+class BulkCreate(object):
+    """ Mixed in ahead of an app's idea/project resource to create a batch of objects from a
+        PATCH to the list end point. The app sets source_name (its watermark and tag count
+        source), add_batch_tag_counts, and prepares each object in prepare_create(). """
+
+    source_name = None
+    add_batch_tag_counts = None
+
+    def prepare_create(self, bundle):
+        """ Fills in what the app derives on creation (user, counts...) """
+
+        return bundle
+
+    def build_bulk_object(self, data, request, modified):
+        """ Hydrates and validates one object of the batch. Raises if it can't be created. """
+
+        if not isinstance(data, dict):
+            raise BadRequest("Each object must be a dictionary of fields.")
+        if data.get('resource_uri') or data.get('id'):
+            raise BadRequest("Bulk PATCHes only create objects - update existing ones individually.")
+
+        bundle = self.build_bundle(data=data, request=request)
+        # Picked up by hydrate_modified instead of moving the watermark per object
+        bundle.batch_modified = modified
+        bundle = self.prepare_create(bundle)
+        bundle = self.full_hydrate(bundle)
+
+        if not self.is_valid(bundle):
+            raise BadRequest(bundle.errors.get(self._meta.resource_name) or bundle.errors)
+
+        # Field validation, and clean() - which sets max_pm
+        bundle.obj.validate()
+        return bundle
+
+    def patch_list(self, request, **kwargs):
+        """ Creates the 'objects' in the request body with one insert.
+            Responds 202 if any were created, 400 if none were. """
+
+        deserialized = self.deserialize(request, request.body, format=request.META.get('CONTENT_TYPE', 'application/json'))
+        collection_name = self._meta.collection_name
+
+        if not isinstance(deserialized, dict) or not isinstance(deserialized.get(collection_name), list):
+            raise BadRequest("Invalid data sent: missing '%s'" % (collection_name))
+        if deserialized.get('deleted_%s' % (collection_name)):
+            raise BadRequest("Bulk PATCHes only create objects - delete existing ones individually.")
+
+        items = deserialized[collection_name]
+        if len(items) > get_max_batch_size():
+            raise BadRequest("No more than %s objects can be created at once." % (get_max_batch_size()))
+
+        # The batch as a whole has to be allowed (e.g. staff only)
+        base_bundle = self.build_bundle(request=request)
+        self.authorized_create_list(self.get_object_list(request), base_bundle)
+
+        modified = datetime.datetime.utcnow()
+        results = []
+        bundles = []
+        for index, data in enumerate(items):
+            try:
+                bundles.append((index, self.build_bulk_object(data, request, modified)))
+            except (BadRequest, ApiFieldError, ValidationError, ValueError, TypeError, KeyError) as e:
+                results.append({'index' : index, 'errors' : describe_error(e)})
+            except ImmediateHttpResponse as e:
+                results.append({'index' : index, 'errors' : e.response.content})
+
+        if bundles:
+            docs = [bundle.obj.to_mongo() for index, bundle in bundles]
+            ids = self._meta.object_class._get_collection().insert(docs)
+
+            for (index, bundle), doc_id in zip(bundles, ids):
+                bundle.obj.id = doc_id
+                results.append({'index' : index, 'id' : str(doc_id), 'resource_uri' : self.get_resource_uri(bundle)})
+
+            self.add_batch_tag_counts(self.source_name, [bundle.obj for index, bundle in bundles])
+            touch_watermark(self.source_name, modified)
+
+        results.sort(key=lambda result: result['index'])
+        response_data = {'meta'          : {'created' : len(bundles), 'failed' : len(results) - len(bundles)},
+                         collection_name : results}
+
+        if bundles:
+            return self.create_response(request, response_data, response_class=http.HttpAccepted)
+        return self.create_response(request, response_data, response_class=http.HttpBadRequest)
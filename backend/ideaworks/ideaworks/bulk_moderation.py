@@ -0,0 +1,138 @@
+
+# (c) Crown Copyright 2014 Defence Science and Technology Laboratory UK
+# Author: Rich Brantingham
+
+"""
+Bulk moderation of ideas and projects - changing the status of many at once.
+
+Moderating spam or closing a campaign meant a PUT per object, each re-saving
+the whole document. Staff can now POST to /idea/moderate/ (or
+/project/moderate/) with the new status and either a list of ids:
+
+    {"status" : "hidden", "ids" : ["53c7...", "53c8..."]}
+
+or a filter on tags, user and/or created date:
+
+    {"status" : "hidden", "filter" : {"tags"         : ["campaign-2014"],
+                                      "user"         : "someone",
+                                      "created__gte" : "2014-01-01T00:00:00",
+                                      "created__lt"  : "2014-02-01T00:00:00"}}
+
+The change is made with one multi-document update, which also moves
+modified on. The tag counts (kept per status) are moved across with one
+aggregation over the matched documents and one update per distinct tag, and
+the watermark is moved once.
+"""
+
+import datetime
+
+from bson.objectid import ObjectId
+from bson.errors import InvalidId
+from dateutil.parser import parse as parse_date
+
+from django.conf.urls import url
+
+from tastypie import http
+from tastypie.exceptions import BadRequest, ImmediateHttpResponse
+from tastypie.utils import trailing_slash
+
+from ideaworks.watermarks import touch_watermark
+
+# The statuses that objects can be moderated to
+MODERATION_STATUSES = ('published', 'draft', 'hidden', 'deleted')
+
+# The created range filters and their operators
+DATE_OPERATORS = {'created__gt' : '$gt', 'created__gte' : '$gte', 'created__lt' : '$lt', 'created__lte' : '$lte'}
+
+#------------------------------------------------------------------------
+
+def build_moderation_query(data):
+    """ The raw query for the objects a moderation request covers - by ids or by filter """
+
+    ids = data.get('ids')
+    filters = data.get('filter')
+
+    if ids and filters:
+        raise BadRequest("Give either ids or a filter, not both.")
+
+    if ids:
+        if not isinstance(ids, list):
+            raise BadRequest("ids must be a list.")
+        try:
+            return {'_id' : {'$in' : [ObjectId(doc_id) for doc_id in ids]}}
+        except (InvalidId, TypeError):
+            raise BadRequest("ids must be a list of object ids.")
+
+    if not isinstance(filters, dict) or not filters:
+        raise BadRequest("Give the ids or a filter (tags, user, created range) of the objects to moderate.")
+
+    query = {}
+    for key, value in filters.items():
+        if key == 'tags':
+            if not isinstance(value, list):
+                value = [value]
+            query['tags'] = {'$in' : value}
+        elif key == 'user':
+            query['user'] = value
+        elif key in DATE_OPERATORS:
+            try:
+                query.setdefault('created', {})[DATE_OPERATORS[key]] = parse_date(value)
+            except (ValueError, TypeError, AttributeError):
+                raise BadRequest("%s must be a date and time." % (key))
+        else:
+            raise BadRequest("Objects can't be filtered on %s for moderation." % (key))
+
+    return query
+
+#------------------------------------------------------------------------
+
+class BulkModeration(object):
+    """ Mixed in ahead of an app's idea/project resource to add a staff-only
+        /<resource>/moderate/ end point. The app sets source_name (its watermark and
+        tag count source), derive_status_change and apply_tag_count_changes. """
+
+    source_name = None
+    derive_status_change = None
+    apply_tag_count_changes = None
+
+    def prepend_urls(self):
+        """ Ahead of the detail url, which would take 'moderate' for an id """
+
+        return [url(r"^(?P<resource_name>%s)/moderate%s$" % (self._meta.resource_name, trailing_slash()),
+                    self.wrap_view('moderate'), name='api_moderate')] + super(BulkModeration, self).prepend_urls()
+
+    def moderate(self, request, **kwargs):
+        """ Sets the status of the objects given by ids or filter, with one update """
+
+        self.method_check(request, allowed=['post'])
+        self.is_authenticated(request)
+        self.throttle_check(request)
+
+        if not (request.user.is_staff or request.user.is_superuser):
+            raise ImmediateHttpResponse(response=http.HttpUnauthorized())
+
+        data = self.deserialize(request, request.body, format=request.META.get('CONTENT_TYPE', 'application/json'))
+        if not isinstance(data, dict):
+            raise BadRequest("Send the status and the ids or filter of the objects to moderate.")
+
+        status = data.get('status')
+        if status not in MODERATION_STATUSES:
+            raise BadRequest("status must be one of %s." % (', '.join(MODERATION_STATUSES)))
+
+        query = build_moderation_query(data)
+        matched = self._meta.object_class._get_collection().find(query).count()
+
+        # Objects already at that status are left as they are
+        query['status'] = {'$ne' : status}
+        changes = self.derive_status_change(self._meta.object_class, query, status)
+
+        now = datetime.datetime.utcnow()
+        result = self._meta.object_class._get_collection().update(query, {'$set' : {'status' : status, 'modified' : now}}, multi=True)
+        updated = result.get('n', 0) if result else 0
+
+        if updated:
+            self.apply_tag_count_changes(self.source_name, changes)
+            touch_watermark(self.source_name, now)
+        self.log_throttled_access(request)
+
+        return self.create_response(request, {'meta' : {'status' : status, 'matched' : matched, 'updated' : updated}})
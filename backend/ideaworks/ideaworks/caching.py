@@ -0,0 +1,97 @@
+
+# (c) Crown Copyright 2014 Defence Science and Technology Laboratory UK
+# Author: Rich Brantingham
+
+"""
+Small in-process caches shared by the apps. Each apache process holds its
+own copy, so anything stored in here must be safe to serve slightly stale
+(hence the optional time-to-live) and must be invalidated by whatever writes
+the underlying data.
+"""
+
+import time
+import threading
+
+#------------------------------------------------------------------------
+
+class BoundedCache(object):
+    """ A thread-safe least-recently-used cache with an optional time-to-live.
+        Keeps simple hit/miss counters so that its usefulness can be checked. """
+
+    def __init__(self, max_size=1000, ttl=None):
+
+        self.max_size = max_size
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._data = {}
+        # Keys, least recently used first (no OrderedDict in python 2.6)
+        self._order = []
+        self._lock = threading.Lock()
+
+    def _remove(self, key):
+        """ Drop a key - the lock must be held """
+
+        if key in self._data:
+            del self._data[key]
+            self._order.remove(key)
+
+    def get(self, key, default=None):
+        """ Get a value, refreshing its position in the LRU order """
+
+        with self._lock:
+            try:
+                stored_at, value = self._data[key]
+            except KeyError:
+                self.misses += 1
+                return default
+
+            # Expired entries are dropped rather than refreshed
+            if self.ttl and time.time() - stored_at > self.ttl:
+                self._remove(key)
+                self.misses += 1
+                return default
+
+            self._order.remove(key)
+            self._order.append(key)
+            self.hits += 1
+            return value
+
+    def set(self, key, value):
+        """ Store a value, evicting the least recently used entry if full """
+
+        with self._lock:
+            self._remove(key)
+            self._data[key] = (time.time(), value)
+            self._order.append(key)
+            while len(self._order) > self.max_size:
+                del self._data[self._order.pop(0)]
+
+    def delete(self, key):
+        """ Remove a single key if present """
+
+        with self._lock:
+            self._remove(key)
+
+    def delete_where(self, test):
+        """ Remove every entry for which test(key, value) is True """
+
+        with self._lock:
+            for key, (stored_at, value) in self._data.items():
+                if test(key, value):
+                    del self._data[key]
+            self._order = [key for key in self._order if key in self._data]
+
+    def clear(self):
+
+        with self._lock:
+            self._data.clear()
+            self._order = []
+
+    def stats(self):
+        """ Counters for monitoring how useful the cache is """
+
+        return {'hits'     : self.hits,
+                'misses'   : self.misses,
+                'size'     : len(self._data),
+                'max_size' : self.max_size}
@@ -0,0 +1,221 @@
+
+# (c) Crown Copyright 2014 Defence Science and Technology Laboratory UK
+# Author: Rich Brantingham
+
+"""
+Optional storage of comments in a collection of their own.
+
+By default the comments on an idea, project or feedback are embedded in it.
+Popular items grow towards mongo's 16MB document limit, every new comment
+rewrites a bigger document, and every list GET reads every comment body.
+
+With COMMENT_STORAGE = 'collection' each app keeps its comments in its own
+collection instead (one document per comment, indexed on (parent_id, created))
+and /<resource>/<id>/comments/ pages through that collection directly, by
+offset or by cursor. The parent still keeps its comment_count, modified and
+max_pm up to date, but its embedded comments list stays empty - clients page
+/comments/ rather than reading them off the parent.
+
+Stored comments are addressed by their own id (/comments/<comment id>/)
+rather than their position in the embedded list. Existing embedded comments
+are moved across by the move_comments management command.
+"""
+
+import datetime
+
+from bson.objectid import ObjectId
+from bson.son import SON
+
+from django.conf import settings
+from django.core.urlresolvers import reverse
+
+from tastypie import http
+from tastypie_mongoengine import resources
+
+from ideaworks.watermarks import touch_watermark
+
+#------------------------------------------------------------------------
+
+def comments_in_collection():
+    """ Whether comments are stored in their own collection rather than embedded """
+
+    return getattr(settings, 'COMMENT_STORAGE', 'embedded') == 'collection'
+
+#------------------------------------------------------------------------
+
+def build_stored_comment(parent_id, comment):
+    """ The raw stored comment for an embedded one (a document or its raw son) """
+
+    if hasattr(comment, 'to_mongo'):
+        comment = comment.to_mongo()
+
+    stored = dict([(key, value) for key, value in comment.items() if key != '_cls'])
+    stored['parent_id'] = ObjectId(parent_id)
+    return stored
+
+def store_comment(stored_class, parent_id, comment):
+    """ Adds an embedded-style comment (e.g. one that came with a vote) to the comment collection """
+
+    return stored_class._get_collection().insert(build_stored_comment(parent_id, comment))
+
+def add_to_parent_max_pm(parent_class, parent_id, pm, merge_pms, update=None):
+    """ Applies update (e.g. pushing a comment, or its count) to the parent and merges the
+        comment's marking pm into the parent's stored max_pm in the same update, without
+        re-reading the parent's other comments. The update is guarded on the max_pm that was
+        read, so a racing change isn't lost. A parent with no stored max_pm yet (see
+        backfill_max_pm) is left to derive it in full. """
+
+    collection = parent_class._get_collection()
+    pm_class = parent_class._fields['max_pm'].document_type
+    update = update or {}
+
+    for attempt in range(5):
+        # Read in stored key order, so that max_pm can be matched on exactly
+        doc = collection.find_one({'_id' : ObjectId(parent_id)}, {'max_pm' : 1}, as_class=SON)
+        if not doc:
+            return
+
+        if not pm or not doc.get('max_pm'):
+            if update:
+                collection.update({'_id' : doc['_id']}, update)
+            return
+
+        max_pm = merge_pms([pm_class._from_son(doc['max_pm']), pm])
+        guarded_update = dict(update)
+        guarded_update['$set'] = dict(update.get('$set', {}), max_pm=max_pm.to_mongo())
+
+        result = collection.update({'_id' : doc['_id'], 'max_pm' : doc['max_pm']}, guarded_update)
+        if result and result.get('n'):
+            return
+
+    # Still racing - drop the stored marking, so that it is derived in full rather than under-reported
+    unset_update = dict(update)
+    unset_update['$unset'] = {'max_pm' : 1}
+    collection.update({'_id' : ObjectId(parent_id)}, unset_update)
+
+def move_embedded_comments(document_class, stored_class, dry_run=False):
+    """ Moves each document's embedded comments into the comment collection.
+        A document's comments are only cleared if they haven't changed since they
+        were read - otherwise its copies are removed again and it's left for the
+        next run. Returns (documents moved, comments moved, documents skipped). """
+
+    collection = document_class._get_collection()
+    stored_collection = stored_class._get_collection()
+
+    moved_docs, moved_comments, skipped = 0, 0, 0
+    for doc in collection.find({'comments.0' : {'$exists' : True}}, {'comments' : 1}):
+
+        comments = doc['comments']
+        if dry_run:
+            moved_docs += 1
+            moved_comments += len(comments)
+            continue
+
+        ids = stored_collection.insert([build_stored_comment(doc['_id'], comment) for comment in comments])
+
+        result = collection.update({'_id' : doc['_id'], 'comments' : comments}, {'$set' : {'comments' : []}})
+        if not result or not result.get('n'):
+            stored_collection.remove({'_id' : {'$in' : ids}})
+            skipped += 1
+            continue
+
+        moved_docs += 1
+        moved_comments += len(comments)
+
+    return moved_docs, moved_comments, skipped
+
+#------------------------------------------------------------------------
+
+def dispatch_stored_comments(parent_class, resource_class, api_name, request, pk=None, subresource_pk=None, **kwargs):
+    """ Serves /<resource>/<pk>/comments/[<subresource_pk>/] from the comment collection """
+
+    if not ObjectId.is_valid(pk) or not parent_class.objects(id=pk).only('id').first():
+        return http.HttpNotFound()
+
+    resource = resource_class(api_name=api_name)
+    resource.parent_id = pk
+
+    if subresource_pk:
+        if not ObjectId.is_valid(subresource_pk):
+            return http.HttpNotFound()
+        return resource.dispatch('detail', request, pk=subresource_pk)
+
+    return resource.dispatch('list', request)
+
+#------------------------------------------------------------------------
+
+class StoredComments(object):
+    """ Mixed in ahead of an app's (embedded) comment resource, so that the same
+        rules, counts and output apply to the comments in the comment collection.
+        The app sets parent_class, parent_name, derive_max_pm and merge_pms. """
+
+    parent_class = None
+    parent_name = None
+    derive_max_pm = None
+    merge_pms = None
+
+    # Set per request by dispatch_stored_comments()
+    parent_id = None
+
+    def get_object_list(self, request):
+        """ Only this parent's comments """
+
+        return super(StoredComments, self).get_object_list(request).filter(parent_id=ObjectId(self.parent_id))
+
+    def get_resource_uri(self, bundle_or_obj=None, url_name='api_dispatch_list'):
+        """ /<parent resource>/<parent id>/comments/[<comment id>/] """
+
+        uri = reverse('api_dispatch_detail', kwargs={'api_name'      : self._meta.api_name,
+                                                     'resource_name' : self.parent_name,
+                                                     'pk'            : self.parent_id}) + 'comments/'
+        if bundle_or_obj is not None:
+            obj = getattr(bundle_or_obj, 'obj', bundle_or_obj)
+            uri += '%s/' % (obj.pk)
+        return uri
+
+    def hydrate(self, bundle):
+        bundle = super(StoredComments, self).hydrate(bundle)
+        bundle.obj.parent_id = ObjectId(self.parent_id)
+        return bundle
+
+    def hydrate_modified(self, bundle):
+        """ Moves the comment's and the parent's modified forward on any write.
+            (The apps' versions find the parent in the path, where the comment's id now also is.) """
+
+        if bundle.request.method != 'GET':
+            now = datetime.datetime.utcnow()
+            bundle.data['modified'] = now
+            self.parent_class.objects(id=self.parent_id).update(**{'set__modified' : now})
+            touch_watermark(self.parent_name, now)
+        return bundle
+
+    def update_parent_max_pm(self):
+        """ Re-derives the parent's effective protective marking, now including this comment collection.
+            Only needed when a comment's marking may have gone down (edits and deletes). """
+
+        parent = self.parent_class.objects(id=self.parent_id).first()
+        if parent:
+            self.parent_class.objects(id=self.parent_id).update(**{'set__max_pm' : self.derive_max_pm(parent)})
+
+    def obj_create(self, bundle, **kwargs):
+        """ A new comment can only raise the parent's marking, so it is merged in """
+
+        bundle = super(StoredComments, self).obj_create(bundle, **kwargs)
+        add_to_parent_max_pm(self.parent_class, self.parent_id, bundle.obj.protective_marking, self.merge_pms)
+        return bundle
+
+    def obj_update(self, bundle, **kwargs):
+        bundle = super(StoredComments, self).obj_update(bundle, **kwargs)
+        self.update_parent_max_pm()
+        return bundle
+
+    def obj_delete(self, bundle, **kwargs):
+        """ Deletes the comment and decrements the parent's count.
+            Skips the app's obj_delete, which finds embedded comments by position. """
+
+        resources.MongoEngineResource.obj_delete(self, bundle, **kwargs)
+
+        now = datetime.datetime.utcnow()
+        self.parent_class.objects(id=self.parent_id).update(**{'inc__comment_count' : -1, 'set__modified' : now})
+        touch_watermark(self.parent_name, now)
+        self.update_parent_max_pm()
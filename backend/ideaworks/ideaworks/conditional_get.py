@@ -0,0 +1,130 @@
+
+# (c) Crown Copyright 2014 Defence Science and Technology Laboratory UK
+# Author: Rich Brantingham
+
+"""
+Conditional GET (ETag / Last-Modified -> 304) for the idea, project and
+feedback end points.
+
+The front end polls with data_level=meta just to find out whether anything
+has changed. The validators come from the same data as meta.modified - the
+collection watermark for lists, the document's own modified for details -
+so a matching If-None-Match or If-Modified-Since is answered with a 304
+before any objects are loaded, dehydrated or serialized.
+
+A detail's modified is only looked up through the resource's list
+authorization, so a 304 is never given for a document the requester can't
+read (a draft or hidden idea, someone else's private feedback). Those fall
+through to the normal path, and its 401/404.
+
+The ETag also covers the path, query string and requesting user, because
+each of those changes what the response holds (filtering, data_level,
+StatusAuthorization, user_voted). It is weak, as the informal ('2 hours
+ago') times can drift while the data itself stays the same.
+"""
+
+import calendar
+import hashlib
+
+from bson.objectid import ObjectId
+from bson.errors import InvalidId
+
+from django.utils.http import http_date, parse_http_date_safe
+from tastypie import http
+from tastypie.exceptions import Unauthorized
+
+#------------------------------------------------------------------------
+
+def get_document_modified(resource, request, pk):
+    """ Just the modified timestamp of one document, or None if there's no such
+        document or the requester can't read it (the resource's read_list rules,
+        applied in the same query) """
+
+    try:
+        ObjectId(pk)
+    except (InvalidId, TypeError):
+        return None
+
+    bundle = resource.build_bundle(request=request)
+    object_list = resource._meta.object_class.objects(pk=pk)
+    try:
+        object_list = resource._meta.authorization.read_list(object_list, bundle)
+    except Unauthorized:
+        return None
+
+    doc = object_list._collection.find_one(object_list._query, {'modified' : 1})
+    if not doc:
+        return None
+    return doc.get('modified')
+
+#------------------------------------------------------------------------
+
+def build_etag(request, modified):
+    """ A weak ETag for this modified time, as seen by this user through this url """
+
+    user = getattr(request, 'user', None)
+    if user and user.is_authenticated():
+        username = user.username
+    else:
+        username = ''
+
+    query = '&'.join(['%s=%s' % (key, value) for key, values in sorted(request.GET.lists()) for value in values])
+
+    parts = [modified.isoformat(), request.path, query, username]
+    digest = hashlib.md5('|'.join(parts).encode('utf-8')).hexdigest()
+
+    return 'W/"%s"' % (digest)
+
+#------------------------------------------------------------------------
+
+def get_last_modified(modified):
+    """ HTTP date version of a (utc) modified time """
+
+    return http_date(calendar.timegm(modified.utctimetuple()))
+
+#------------------------------------------------------------------------
+
+def is_not_modified(request, etag, modified):
+    """ Whether the request's validators still match.
+        If-Modified-Since is only used when there's no If-None-Match. """
+
+    if_none_match = request.META.get('HTTP_IF_NONE_MATCH')
+    if if_none_match:
+        tags = [tag.strip() for tag in if_none_match.split(',')]
+        # Weak comparison - ignore the W/ on either side
+        bare_tags = [tag[2:] if tag.startswith('W/') else tag for tag in tags]
+        return '*' in tags or etag[2:] in bare_tags
+
+    if_modified_since = parse_http_date_safe(request.META.get('HTTP_IF_MODIFIED_SINCE', ''))
+    if if_modified_since is not None:
+        return calendar.timegm(modified.utctimetuple()) <= if_modified_since
+
+    return False
+
+#------------------------------------------------------------------------
+
+def conditional_response(request, modified, build_response):
+    """ Returns a 304 if the requester already has the current version, otherwise
+        calls build_response() and adds the validators to what it returns.
+        With no modified time (no data or no such document) it just builds the response. """
+
+    if request.method != 'GET' or not modified:
+        return build_response()
+
+    etag = build_etag(request, modified)
+    last_modified = get_last_modified(modified)
+
+    if is_not_modified(request, etag, modified):
+        response = http.HttpNotModified()
+        response['Access-Control-Allow-Origin'] = '*'
+        response['Access-Control-Allow-Headers'] = 'Content-Type'
+    else:
+        response = build_response()
+        if response.status_code != 200:
+            return response
+
+    response['ETag'] = etag
+    response['Last-Modified'] = last_modified
+    response['Access-Control-Expose-Headers'] = 'ETag, Last-Modified'
+
+    return response
@@ -0,0 +1,143 @@
+
+# (c) Crown Copyright 2014 Defence Science and Technology Laboratory UK
+# Author: Rich Brantingham
+
+"""
+Resolves contributor ids (usernames, or emails for older content) into display
+names for the ideas, projects and content apps.
+
+Dehydrating a page of objects asks for a name for every object, comment and
+vote on that page. Rather than querying the user db for each of those, names
+are handed out as lazy values which all belong to one resolver per request.
+The first time any of them is rendered (i.e. at serialization, once every
+bundle has been dehydrated) the resolver fetches all of the outstanding
+contributors in a single __in query. Resolved names are also kept in a small
+process-wide LRU cache, which is invalidated when a User is saved or deleted.
+"""
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.db.models import signals
+
+from ideaworks.caching import BoundedCache
+
+# Process-wide cache of contributor id -> (user pk, display name)
+name_cache = BoundedCache(max_size=getattr(settings, 'CONTRIBUTOR_NAME_CACHE_SIZE', 2000),
+                          ttl=getattr(settings, 'CONTRIBUTOR_NAME_CACHE_TTL', 300))
+
+#------------------------------------------------------------------------
+
+def format_contributor_name(first_name, last_name):
+    """ How a contributor's name is displayed """
+
+    return first_name.title() + ' ' + last_name.title()
+
+#------------------------------------------------------------------------
+
+class ContributorNameResolver(object):
+    """ Collects the contributors needed for a request and looks them up in one go """
+
+    def __init__(self):
+        self.pending = set()
+        self.names = {}
+
+    def name_for(self, contributor):
+        """ Registers the contributor and returns a lazy name for it """
+
+        if contributor not in self.names:
+            cached = name_cache.get(contributor)
+            if cached:
+                self.names[contributor] = cached[1]
+            else:
+                self.pending.add(contributor)
+
+        return LazyContributorName(self, contributor)
+
+    def resolve(self):
+        """ Look up all of the outstanding contributors """
+
+        if not self.pending:
+            return
+
+        contributors = list(self.pending)
+        self.pending = set()
+
+        fields = ('id', 'username', 'email', 'first_name', 'last_name')
+
+        # Contributors are normally stored by username...
+        found = {}
+        for row in User.objects.filter(username__in=contributors).values_list(*fields):
+            found[row[1]] = row
+
+        # ...but some older content was stored against the user's email
+        missing = [c for c in contributors if c not in found]
+        if missing:
+            for row in User.objects.filter(email__in=missing).values_list(*fields):
+                found[row[2]] = row
+
+        for contributor in contributors:
+            if contributor in found:
+                user_id, username, email, first_name, last_name = found[contributor]
+                name = format_contributor_name(first_name, last_name)
+                name_cache.set(contributor, (user_id, name))
+            else:
+                name = ''
+            self.names[contributor] = name
+
+    def get_name(self, contributor):
+
+        if contributor not in self.names:
+            self.pending.add(contributor)
+            self.resolve()
+        return self.names[contributor]
+
+#------------------------------------------------------------------------
+
+class LazyContributorName(object):
+    """ Stands in for a contributor name until it is rendered by the serializer """
+
+    def __init__(self, resolver, contributor):
+        self.resolver = resolver
+        self.contributor = contributor
+
+    def __unicode__(self):
+        return self.resolver.get_name(self.contributor)
+
+    def __str__(self):
+        return unicode(self).encode('utf-8')
+
+    def __eq__(self, other):
+        return unicode(self) == other
+
+    def __ne__(self, other):
+        return not self.__eq__(other)
+
+    def __repr__(self):
+        return '<LazyContributorName: %s>' % (self.contributor)
+
+#------------------------------------------------------------------------
+
+def get_request_resolver(request):
+    """ Gets (or creates) the resolver attached to this request """
+
+    if request is None:
+        return ContributorNameResolver()
+
+    resolver = getattr(request, '_contributor_resolver', None)
+    if resolver is None:
+        resolver = ContributorNameResolver()
+        request._contributor_resolver = resolver
+
+    return resolver
+
+#------------------------------------------------------------------------
+
+def invalidate_contributor(sender, instance, **kwargs):
+    """ Drop any cached names belonging to a user that has changed """
+
+    name_cache.delete_where(lambda key, value: value[0] == instance.pk)
+    name_cache.delete(instance.username)
+    name_cache.delete(instance.email)
+
+signals.post_save.connect(invalidate_contributor, sender=User, dispatch_uid='contributor_name_cache_save')
+signals.post_delete.connect(invalidate_contributor, sender=User, dispatch_uid='contributor_name_cache_delete')
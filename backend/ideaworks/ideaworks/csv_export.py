@@ -0,0 +1,198 @@
+
+# (c) Crown Copyright 2014 Defence Science and Technology Laboratory UK
+# Author: Rich Brantingham
+
+"""
+Streams ?format=csv list responses straight from a mongo cursor.
+
+The serializers' to_csv needs the whole (dehydrated) bundle list in memory,
+and then runs to_simple() over it just to find the headers. For an export
+of a whole collection that takes a long time and a lot of memory. Instead,
+the filtered, authorized and sorted queryset's query is run as a raw cursor
+that only loads the columns needed, in batches. Rows are written out as the
+response is streamed, so memory use doesn't grow with the collection.
+
+The columns are fixed per resource and data_level: each app says which
+columns it exports by default and how to derive those that aren't stored
+(e.g. contributor_name), and anything the data_level asks for that can't
+sensibly go in a csv cell (embedded documents, per-user fields) is left out.
+
+?offset= and ?limit= page the export as they do a list GET. Without them
+(or with limit=0) the whole filtered set is exported.
+"""
+
+import csv
+import datetime
+
+from django.conf import settings
+from django.http import StreamingHttpResponse
+
+from mongoengine.fields import EmbeddedDocumentField, ListField
+from tastypie.exceptions import BadRequest
+
+from ideaworks.contributors import ContributorNameResolver
+from ideaworks.tag_ranking import TagRankedQuerySet
+from ideaworks.text_search import TextSearchQuerySet
+
+CSV_BATCH_SIZE = 500
+
+#------------------------------------------------------------------------
+
+class Echo(object):
+    """ A file-like object for csv.writer that hands back what it is given """
+
+    def write(self, value):
+        return value
+
+#------------------------------------------------------------------------
+
+def is_csv_field(document_class, field_name, derived_fields):
+    """ Whether a field can be a csv column - derived, or stored and not an embedded document """
+
+    if field_name in derived_fields:
+        return True
+
+    field = document_class._fields.get(field_name)
+    if field is None:
+        return False
+    if isinstance(field, EmbeddedDocumentField):
+        return False
+    if isinstance(field, ListField) and isinstance(field.field, EmbeddedDocumentField):
+        return False
+    return True
+
+def get_csv_fields(request, document_class, default_fields, derived_fields):
+    """ The fixed columns for this resource and data_level """
+
+    data_level = request.GET.get('data_level', None)
+    if data_level in settings.RESPONSE_FIELDS:
+        fields = settings.RESPONSE_FIELDS[data_level]
+    else:
+        fields = default_fields
+
+    return [field for field in fields if is_csv_field(document_class, field, derived_fields)]
+
+#------------------------------------------------------------------------
+
+def csv_value(value):
+    """ Flattens a value into something for a csv cell """
+
+    if value is None:
+        return ''
+    if isinstance(value, (list, tuple)):
+        return ';'.join([csv_value(item) for item in value])
+    if isinstance(value, datetime.datetime):
+        return value.isoformat()
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+    if isinstance(value, str):
+        return value
+    return unicode(value).encode('utf-8')
+
+#------------------------------------------------------------------------
+
+def get_projection(document_class, fields, derived_fields):
+    """ The db fields needed to build the columns """
+
+    projection = {'_id' : 1}
+    for field in fields:
+        if field in derived_fields:
+            for source in derived_fields[field][0]:
+                projection[source] = 1
+        else:
+            projection[document_class._fields[field].db_field] = 1
+
+    return projection
+
+def open_cursor(queryset, projection, batch_size=CSV_BATCH_SIZE):
+    """ Runs the queryset's query (filters, authorization and ordering) as a raw, projected cursor """
+
+    # The ranking across tags is for pages of results - an export is just the filtered set
+    if isinstance(queryset, TagRankedQuerySet):
+        queryset = queryset.queryset
+
+    # Likewise relevance - an export of a search is just the documents matched
+    if isinstance(queryset, TextSearchQuerySet):
+        return queryset.queryset._collection.find(queryset.build_query(), projection).batch_size(batch_size)
+
+    cursor = queryset._collection.find(queryset._query, projection)
+    ordering = getattr(queryset, '_ordering', None)
+    if ordering:
+        cursor = cursor.sort(ordering)
+
+    return cursor.batch_size(batch_size)
+
+def get_paging(request):
+    """ (offset, limit) from the request, as a list GET reads them - limit 0 for no limit """
+
+    paging = []
+    for name in ('offset', 'limit'):
+        value = request.GET.get(name, 0)
+        try:
+            value = int(value)
+        except (TypeError, ValueError):
+            raise BadRequest("Invalid %s '%s' provided. Please provide a positive integer." % (name, value))
+        if value < 0:
+            raise BadRequest("Invalid %s '%s' provided. Please provide a positive integer >= 0." % (name, value))
+        paging.append(value)
+
+    return tuple(paging)
+
+#------------------------------------------------------------------------
+
+def build_rows(document_class, cursor, fields, derived_fields, batch_size=CSV_BATCH_SIZE):
+    """ Yields the header row and then a row per document, a batch at a time.
+        The contributor names for each batch are looked up together. """
+
+    yield [csv_value(field) for field in fields]
+
+    batch = []
+    for doc in cursor:
+        batch.append(doc)
+        if len(batch) >= batch_size:
+            for row in build_batch_rows(document_class, batch, fields, derived_fields):
+                yield row
+            batch = []
+
+    for row in build_batch_rows(document_class, batch, fields, derived_fields):
+        yield row
+
+def build_batch_rows(document_class, batch, fields, derived_fields):
+
+    resolver = ContributorNameResolver()
+    rows = []
+    for doc in batch:
+        row = []
+        for field in fields:
+            if field in derived_fields:
+                value = derived_fields[field][1](doc, resolver)
+            else:
+                value = doc.get(document_class._fields[field].db_field)
+            row.append(value)
+        rows.append(row)
+
+    # Any contributor names are rendered here, all in one lookup
+    return [[csv_value(value) for value in row] for row in rows]
+
+#------------------------------------------------------------------------
+
+def csv_response(request, document_class, queryset, fields, derived_fields):
+    """ A streamed csv download of the queryset """
+
+    cursor = open_cursor(queryset, get_projection(document_class, fields, derived_fields))
+
+    offset, limit = get_paging(request)
+    if offset:
+        cursor = cursor.skip(offset)
+    if limit:
+        cursor = cursor.limit(limit)
+
+    writer = csv.writer(Echo())
+    rows = (writer.writerow(row) for row in build_rows(document_class, cursor, fields, derived_fields))
+
+    response = StreamingHttpResponse(rows, content_type='text/csv')
+    response['Content-Disposition'] = 'attachment; filename=%s.csv' % (settings.APPLICATION_NAME)
+    response['Access-Control-Allow-Origin'] = '*'
+    response['Access-Control-Allow-Headers'] = 'Content-Type'
+
+    return response
@@ -0,0 +1,106 @@
+
+# (c) Crown Copyright 2014 Defence Science and Technology Laboratory UK
+# Author: Rich Brantingham
+
+"""
+Caching for the Atom (?format=rss) feeds of ideas, projects and feedback.
+
+Feed readers poll constantly and every poll used to rebuild the whole feed:
+the full list pipeline, then every item's title and description formatted
+and its modified date re-parsed with strptime.
+
+Two levels of caching now sit in front of that:
+
+ - Whole feeds, in the shared 'responses' cache, keyed per end point and
+   filter (path, query string and, where ?status= lets users see their own
+   drafts, the user). The key includes the collection watermark and the
+   resource's response generation, so a feed is only rebuilt once the
+   collection has changed.
+ - Each item's feed fields, in a small in-process cache keyed on the
+   document's id and modified, so a rebuilt feed only formats the items that
+   have changed.
+
+Conditional GETs on the feeds are answered (with a 304) by the list
+end points before any of this, from the same watermark.
+"""
+
+import hashlib
+import datetime
+
+from django.conf import settings
+from django.http import HttpResponse
+
+from ideaworks.caching import BoundedCache
+from ideaworks.response_cache import get_response_cache, response_cache_enabled, get_generation, normalize_query
+
+# Process-wide cache of (feed, document id, modified) -> feed item fields
+feed_item_cache = BoundedCache(max_size=getattr(settings, 'FEED_ITEM_CACHE_SIZE', 2000),
+                               ttl=getattr(settings, 'FEED_ITEM_CACHE_TTL', 3600))
+
+#------------------------------------------------------------------------
+
+def get_item_data(item):
+    """ The data of a dehydrated bundle, or a plain dict """
+
+    return getattr(item, 'data', item)
+
+def get_item_version(item_data):
+    """ The modified time of an item, whether it's still a datetime or has been serialized """
+
+    modified = item_data.get('modified')
+    if isinstance(modified, datetime.datetime):
+        return modified.isoformat()
+    return unicode(modified)
+
+def get_feed_item(feed_name, item, build_item):
+    """ The keyword arguments for feed.add_item() for one item, built by build_item(item_data)
+        the first time this version of the document is seen """
+
+    item_data = get_item_data(item)
+    key = (feed_name, unicode(item_data['id']), get_item_version(item_data))
+
+    fields = feed_item_cache.get(key)
+    if fields is None:
+        fields = build_item(item_data)
+        feed_item_cache.set(key, fields)
+
+    return fields
+
+#------------------------------------------------------------------------
+
+def build_feed_key(cache, resource_name, request, watermark):
+
+    # With ?status= each user can see their own drafts, otherwise everyone sees the same feed
+    user = ''
+    if request.GET.get('status', None) or request.GET.get('status__in', None):
+        if request.user.is_authenticated():
+            user = request.user.username
+
+    parts = [request.path, normalize_query(request), user]
+    digest = hashlib.md5('|'.join(parts).encode('utf-8')).hexdigest()
+
+    return 'feed:%s:%s:%s:%s' % (resource_name, watermark.isoformat(), get_generation(cache, resource_name), digest)
+
+def cached_feed(request, resource_name, watermark, build_response):
+    """ Serves a feed from the cache while the collection hasn't changed,
+        otherwise calls build_response() and caches the feed it returns """
+
+    if not response_cache_enabled() or request.method != 'GET' or not watermark:
+        return build_response()
+
+    cache = get_response_cache()
+    key = build_feed_key(cache, resource_name, request, watermark)
+
+    cached = cache.get(key)
+    if cached is not None:
+        content, content_type = cached
+        response = HttpResponse(content, content_type=content_type)
+        response['Access-Control-Allow-Origin'] = '*'
+        response['Access-Control-Allow-Headers'] = 'Content-Type'
+        return response
+
+    response = build_response()
+    if response.status_code == 200:
+        cache.set(key, (response.content, response['Content-Type']))
+
+    return response
@@ -8,6 +8,9 @@ from tastypie_mongoengine import resources
 from tastypie.exceptions import ImmediateHttpResponse
 from tastypie import http
 
+from ideaworks.json_encoding import wants_pretty_json
+from ideaworks.request_timing import time_requests, timed
+
 class BaseCorsResource(resources.MongoEngineResource):
     """
     Class implementing CORS, @danigosa author and taken from this blog:
@@ -15,6 +18,57 @@ class BaseCorsResource(resources.MongoEngineResource):
     Inheriting this in our models allows requests to the API from any domain, which is useful for the front-end.
     """
     
+    def serialize(self, request, data, format, options=None):
+        """
+        Passes ?pretty=1 through to the serializer, which otherwise produces compact json.
+        """
+        options = options or {}
+        options['pretty'] = wants_pretty_json(request)
+        with timed(request, 'serialize'):
+            return super(BaseCorsResource, self).serialize(request, data, format, options)
+
+    def wrap_view(self, view):
+        """
+        Times the stages of each request - see ideaworks/request_timing.py
+        """
+        return time_requests(super(BaseCorsResource, self).wrap_view(view))
+
+    def is_authenticated(self, request):
+        with timed(request, 'auth'):
+            return super(BaseCorsResource, self).is_authenticated(request)
+
+    def authorized_read_list(self, object_list, bundle):
+        with timed(bundle.request, 'authz'):
+            return super(BaseCorsResource, self).authorized_read_list(object_list, bundle)
+
+    def get_list(self, request, **kwargs):
+        """
+        Tastypie's get_list, with the query (including the fetch of the page), the
+        dehydration of the bundles and alter_list_data_to_serialize each timed.
+        """
+        with timed(request, 'query'):
+            base_bundle = self.build_bundle(request=request)
+            objects = self.obj_get_list(bundle=base_bundle, **self.remove_api_resource_names(kwargs))
+            sorted_objects = self.apply_sorting(objects, options=request.GET)
+
+            paginator = self._meta.paginator_class(request.GET, sorted_objects, resource_uri=self.get_resource_uri(),
+                                                   limit=self._meta.limit, max_limit=self._meta.max_limit,
+                                                   collection_name=self._meta.collection_name)
+            to_be_serialized = paginator.page()
+            page = list(to_be_serialized[self._meta.collection_name])
+
+        # Dehydrate the bundles in preparation for serialization.
+        bundles = []
+        for obj in page:
+            with timed(request, 'dehydrate'):
+                bundle = self.build_bundle(obj=obj, request=request)
+                bundles.append(self.full_dehydrate(bundle, for_list=True))
+
+        to_be_serialized[self._meta.collection_name] = bundles
+        with timed(request, 'alter'):
+            to_be_serialized = self.alter_list_data_to_serialize(request, to_be_serialized)
+        return self.create_response(request, to_be_serialized)
+
     def create_response(self, *args, **kwargs):
         response = super(BaseCorsResource, self).create_response(*args, **kwargs)
         response['Access-Control-Allow-Origin'] = '*'
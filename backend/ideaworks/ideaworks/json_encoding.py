@@ -0,0 +1,68 @@
+
+# (c) Crown Copyright 2014 Defence Science and Technology Laboratory UK
+# Author: Rich Brantingham
+
+"""
+Compact json output for the CustomSerializers.
+
+The serializers used to run tastypie's to_simple() over the whole response
+(a full copy of every bundle, comment and vote) and then dump it with
+indent=2 and sort_keys=True, which roughly doubled both the size of the
+payload and the time to encode it. The compact path encodes the bundles as
+they are: the encoder's default() unpacks bundles and formats datetimes the
+same way to_simple() does, and with no indent or key sorting the json module
+can use its C encoder.
+
+The indented, sorted output is still there with ?pretty=1.
+"""
+
+import json
+import datetime
+import decimal
+
+from django.utils.encoding import force_text
+from tastypie.bundle import Bundle
+
+#------------------------------------------------------------------------
+
+def wants_pretty_json(request):
+    """ Whether the requester asked for indented json with ?pretty=1 """
+
+    if request is None:
+        return False
+    return request.GET.get('pretty', '').lower() in ('1', 'true', 'yes')
+
+#------------------------------------------------------------------------
+
+class CompactJSONEncoder(json.JSONEncoder):
+    """ Encodes the un-simplified data, matching what to_simple() would have produced """
+
+    def __init__(self, serializer=None, **kwargs):
+        super(CompactJSONEncoder, self).__init__(**kwargs)
+        self.serializer = serializer
+
+    def default(self, obj):
+
+        if isinstance(obj, Bundle):
+            return obj.data
+
+        # datetime before date - datetimes are also dates
+        if isinstance(obj, datetime.datetime):
+            return self.serializer.format_datetime(obj)
+        if isinstance(obj, datetime.date):
+            return self.serializer.format_date(obj)
+        if isinstance(obj, datetime.time):
+            return self.serializer.format_time(obj)
+        if isinstance(obj, decimal.Decimal):
+            return str(obj)
+
+        # Anything else (e.g. lazy contributor names) goes out as text, as with to_simple()
+        return force_text(obj)
+
+#------------------------------------------------------------------------
+
+def compact_json(serializer, data):
+    """ Dumps data (bundles and all) as compact json """
+
+    return json.dumps(data, cls=CompactJSONEncoder, serializer=serializer,
+                      ensure_ascii=False, separators=(',', ':'))
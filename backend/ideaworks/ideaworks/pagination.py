@@ -0,0 +1,197 @@
+
+# (c) Crown Copyright 2014 Defence Science and Technology Laboratory UK
+# Author: Rich Brantingham
+
+"""
+Keyset (cursor) pagination for the idea, project and feedback lists.
+
+Offset paging makes mongo skip over everything before the offset, so deep
+pages get steadily slower. When a list is ordered by a single field (or not
+ordered at all), the page ends on a known (order field value, _id) pair, and
+the next page can be fetched by asking for what sorts after that pair - which
+costs the same however deep the client is.
+
+Every keyset-able page carries an opaque meta.next_cursor. Passing it back as
+?cursor= gets the next page by keyset: no skip and no count, so
+meta.total_count is null. Without a cursor the usual offset paging is used
+(as a fallback, and for anything ordered by more than one field or ranked by
+tags__in), with _id added as a tie-breaker so that the two agree.
+
+Ties and missing values: _id follows the direction of the ordering within
+equal values (so one (field, _id) index serves both directions), and
+missing/null values sort first ascending and last descending, as mongo
+sorts them.
+"""
+
+import json
+import base64
+import urllib
+
+from bson import json_util
+
+from tastypie.paginator import Paginator
+from tastypie.exceptions import BadRequest
+
+from ideaworks.tag_ranking import TagRankedQuerySet
+
+#------------------------------------------------------------------------
+
+def encode_cursor(order_by, value, doc_id):
+    """ An opaque cursor for the position after (value, doc_id) in this ordering """
+
+    position = json.dumps({'o' : order_by, 'v' : value, 'id' : doc_id}, default=json_util.default)
+    return base64.urlsafe_b64encode(position)
+
+def decode_cursor(cursor):
+    """ The (order_by, value, doc_id) a cursor was made from """
+
+    try:
+        position = json.loads(base64.urlsafe_b64decode(str(cursor)), object_hook=json_util.object_hook)
+        return position['o'], position['v'], position['id']
+    except (TypeError, ValueError, KeyError):
+        raise BadRequest("Invalid cursor.")
+
+#------------------------------------------------------------------------
+
+def build_keyset_query(db_field, descending, value, doc_id):
+    """ The raw query for everything that sorts after (value, doc_id) - with _id in the same direction within ties """
+
+    after_id = {'$lt' : doc_id} if descending else {'$gt' : doc_id}
+    after_in_tie = {db_field : value, '_id' : after_id}
+
+    if db_field == '_id':
+        return {'_id' : after_id}
+
+    # Missing values sort lowest, i.e. first ascending and last descending
+    if value is None:
+        if descending:
+            return after_in_tie
+        return {'$or' : [after_in_tie, {db_field : {'$ne' : None}}]}
+
+    if descending:
+        return {'$or' : [{db_field : {'$lt' : value}}, after_in_tie, {db_field : None}]}
+    return {'$or' : [{db_field : {'$gt' : value}}, after_in_tie]}
+
+#------------------------------------------------------------------------
+
+class KeysetPaginator(Paginator):
+    """ Pages by keyset when given a ?cursor=, otherwise by offset, and gives a next_cursor either way """
+
+    def get_order_by(self):
+        """ The single order_by the list is sorted on ('' for none), or None if it can't be keyset paged """
+
+        if isinstance(self.objects, TagRankedQuerySet) or not hasattr(self.objects, '_document'):
+            return None
+
+        if hasattr(self.request_data, 'getlist'):
+            order_by = [field for field in self.request_data.getlist('order_by') if field]
+        else:
+            order_by = [field for field in [self.request_data.get('order_by')] if field]
+
+        if len(order_by) > 1:
+            return None
+        if not order_by:
+            return ''
+
+        # Only fields stored on the document itself (not e.g. comments__created)
+        if order_by[0].lstrip('-') not in self.objects._document._fields:
+            return None
+        return order_by[0]
+
+    def get_db_field(self, order_by):
+        if not order_by:
+            return '_id'
+        return self.objects._document._fields[order_by.lstrip('-')].db_field
+
+    def order_objects(self, order_by):
+        """ The ordering plus the _id tie-breaker, in the same direction """
+
+        if not order_by:
+            return self.objects.order_by('id')
+        if order_by.startswith('-'):
+            return self.objects.order_by(order_by, '-id')
+        return self.objects.order_by(order_by, 'id')
+
+    def get_next_cursor(self, order_by, last_obj):
+
+        if order_by:
+            value = getattr(last_obj, order_by.lstrip('-'), None)
+        else:
+            value = None
+        return encode_cursor(order_by, value, last_obj.pk)
+
+    def page(self):
+
+        order_by = self.get_order_by()
+        cursor = self.request_data.get('cursor', None)
+
+        if order_by is None:
+            if cursor:
+                raise BadRequest("Cursor paging needs the list ordered by a single field.")
+            return super(KeysetPaginator, self).page()
+
+        self.objects = self.order_objects(order_by)
+
+        if cursor:
+            return self.keyset_page(order_by, cursor)
+
+        output = super(KeysetPaginator, self).page()
+
+        # Where the next page would start, for the client to carry on by cursor.
+        # The page is a sliced queryset, which can't be indexed from the end.
+        objects = list(output[self.collection_name])
+        output[self.collection_name] = objects
+        output['meta']['next_cursor'] = None
+        if objects and output['meta'].get('next'):
+            output['meta']['next_cursor'] = self.get_next_cursor(order_by, objects[-1])
+
+        return output
+
+    def keyset_page(self, order_by, cursor):
+        """ The page after the cursor - fetches one extra object to see if there are more """
+
+        cursor_order_by, value, doc_id = decode_cursor(cursor)
+        if cursor_order_by != order_by:
+            raise BadRequest("The cursor was made for a different order_by.")
+
+        limit = self.get_limit()
+        if not limit:
+            limit = self.max_limit or 1000
+
+        query = build_keyset_query(self.get_db_field(order_by), order_by.startswith('-'), value, doc_id)
+        objects = list(self.objects.filter(__raw__=query)[:limit + 1])
+
+        next_cursor = None
+        next_uri = None
+        if len(objects) > limit:
+            objects = objects[:limit]
+            next_cursor = self.get_next_cursor(order_by, objects[-1])
+            next_uri = self.get_cursor_uri(limit, next_cursor)
+
+        meta = {'limit'       : limit,
+                'offset'      : None,
+                'total_count' : None,
+                'previous'    : None,
+                'next'        : next_uri,
+                'next_cursor' : next_cursor}
+
+        return {self.collection_name : objects, 'meta' : meta}
+
+    def get_cursor_uri(self, limit, cursor):
+
+        if self.resource_uri is None:
+            return None
+
+        request_params = self.request_data.copy() if hasattr(self.request_data, 'copy') else dict(self.request_data)
+        for key in ('offset', 'cursor', 'limit'):
+            if key in request_params:
+                del request_params[key]
+        request_params['limit'] = limit
+        request_params['cursor'] = cursor
+
+        if hasattr(request_params, 'urlencode'):
+            encoded = request_params.urlencode()
+        else:
+            encoded = urllib.urlencode(request_params)
+
+        return '%s?%s' % (self.resource_uri, encoded)
@@ -0,0 +1,150 @@
+
+# (c) Crown Copyright 2014 Defence Science and Technology Laboratory UK
+# Author: Rich Brantingham
+
+"""
+Per-stage timing of API requests.
+
+When a list end point is slow, the time could be going on authentication,
+authorization, the mongo query, dehydrating each bundle, the max_pm and
+other aggregations in alter_list_data_to_serialize, or serialization. Each
+request now carries a timer (one per request, shared by any sub-resources it
+dispatches to) and each of those stages adds its time to it - repeated
+stages, like dehydrating every bundle on a page, are summed and counted.
+
+When the request has been handled the stages are:
+
+ - written to the django.request log as one key=value line, e.g.
+   timing method=GET path=/api/v1/idea/ status=200 total_ms=41.2 auth_ms=0.3 query_ms=12.9 dehydrate_ms=21.0 dehydrate_n=20 ...
+ - returned in a Server-Timing header (which browser dev tools display),
+   to everyone or only to staff - see SERVER_TIMING_HEADER in settings.
+
+Stages can overlap - authorization happens as part of the query.
+"""
+
+import time
+import logging
+from functools import wraps
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.views.decorators.csrf import csrf_exempt
+
+logger = logging.getLogger('django.request')
+
+#------------------------------------------------------------------------
+
+def request_timing_enabled():
+    return getattr(settings, 'REQUEST_TIMING_ENABLED', True)
+
+#------------------------------------------------------------------------
+
+class RequestTimer(object):
+    """ The time spent in each stage of one request """
+
+    def __init__(self):
+        self.started = time.time()
+        self.stages = {}
+        # In the order they were first timed (no OrderedDict in python 2.6)
+        self.stage_names = []
+
+    def add(self, name, seconds):
+        """ Adds to a stage's total time and count """
+
+        if name not in self.stages:
+            self.stage_names.append(name)
+        total, count = self.stages.get(name, (0.0, 0))
+        self.stages[name] = (total + seconds, count + 1)
+
+    def total(self):
+        return time.time() - self.started
+
+    def build_header(self, total):
+        """ The Server-Timing header value - durations in milliseconds """
+
+        entries = []
+        for name in self.stage_names:
+            seconds, count = self.stages[name]
+            entry = '%s;dur=%.1f' % (name, seconds * 1000)
+            if count > 1:
+                entry += ';desc="%s x%s"' % (name, count)
+            entries.append(entry)
+        entries.append('total;dur=%.1f' % (total * 1000))
+        return ', '.join(entries)
+
+    def build_log_line(self, request, response, total):
+        """ One key=value line per request """
+
+        user = request.user.username if hasattr(request, 'user') and request.user.is_authenticated() else '-'
+        parts = ['timing',
+                 'method=%s' % (request.method),
+                 'path=%s' % (request.path),
+                 'status=%s' % (response.status_code),
+                 'user=%s' % (user),
+                 'total_ms=%.1f' % (total * 1000)]
+        for name in self.stage_names:
+            seconds, count = self.stages[name]
+            parts.append('%s_ms=%.1f' % (name, seconds * 1000))
+            if count > 1:
+                parts.append('%s_n=%s' % (name, count))
+        return ' '.join(parts)
+
+#------------------------------------------------------------------------
+
+def get_request_timer(request):
+    """ The timer attached to this request, or None if it isn't being timed """
+
+    return getattr(request, '_request_timer', None)
+
+@contextmanager
+def timed(request, name):
+    """ Times the block as a stage of the request (if the request is being timed) """
+
+    timer = get_request_timer(request)
+    if timer is None:
+        yield
+        return
+
+    started = time.time()
+    try:
+        yield
+    finally:
+        timer.add(name, time.time() - started)
+
+def wants_server_timing(request):
+    """ Whether this requester gets the Server-Timing header """
+
+    audience = getattr(settings, 'SERVER_TIMING_HEADER', 'staff')
+    if audience == 'all':
+        return True
+    if audience == 'staff':
+        user = getattr(request, 'user', None)
+        return bool(user is not None and user.is_authenticated() and (user.is_staff or user.is_superuser))
+    return False
+
+def time_requests(view):
+    """ Wraps a resource's view: times the request, then logs the stages and adds the header """
+
+    if not request_timing_enabled():
+        return view
+
+    @wraps(view)
+    def wrapper(request, *args, **kwargs):
+
+        # Only the outermost view (e.g. not a sub-resource's) reports
+        if get_request_timer(request) is not None:
+            return view(request, *args, **kwargs)
+
+        timer = RequestTimer()
+        request._request_timer = timer
+
+        response = view(request, *args, **kwargs)
+
+        total = timer.total()
+        logger.info(timer.build_log_line(request, response, total))
+        if wants_server_timing(request):
+            response['Server-Timing'] = timer.build_header(total)
+
+        return response
+
+    return csrf_exempt(wrapper)
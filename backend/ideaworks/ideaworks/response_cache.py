@@ -0,0 +1,142 @@
+
+# (c) Crown Copyright 2014 Defence Science and Technology Laboratory UK
+# Author: Rich Brantingham
+
+"""
+A shared cache of rendered responses for anonymous GETs to the idea, project,
+site content and feedback end points.
+
+Most traffic is anonymous GETs with a handful of common query strings, and
+each of those used to rebuild the response from scratch. Responses are now
+kept in the django 'responses' cache (file based by default, so that every
+apache process shares it), keyed on the resource, a generation for that
+resource and a hash of the path, normalized query string, format and the
+requester's visibility class.
+
+Only anonymous responses are stored: authenticated responses carry
+user_voted and, with ?status=, the user's own drafts, so they are never
+shared. The class is still part of the key so that it can never mix.
+
+Invalidation is write-driven. Every resource's views are wrapped so that
+once a non-GET request (including to its comments/likes/backs) has been
+handled, the resource's generation changes and its old entries are never
+read again - they simply age out. Because the generation moves after the
+write is complete, a read racing the write can only ever store its response
+under the old generation.
+"""
+
+import hashlib
+import uuid
+
+from django.conf import settings
+from django.core.cache import get_cache
+from django.http import HttpResponse
+from django.views.decorators.csrf import csrf_exempt
+
+# Query parameters that don't change the response (jquery's cache buster, credentials)
+IGNORED_PARAMETERS = ('_', 'username', 'api_key')
+
+#------------------------------------------------------------------------
+
+def get_response_cache():
+    return get_cache(getattr(settings, 'RESPONSE_CACHE_NAME', 'responses'))
+
+def response_cache_enabled():
+    return getattr(settings, 'RESPONSE_CACHE_ENABLED', False)
+
+#------------------------------------------------------------------------
+
+def get_visibility_class(request):
+    """ Which group of users a response can be shared between """
+
+    user = getattr(request, 'user', None)
+    if not user or not user.is_authenticated():
+        return 'anonymous'
+    if user.is_staff or user.is_superuser:
+        return 'staff'
+    return 'authenticated'
+
+#------------------------------------------------------------------------
+
+def normalize_query(request):
+    """ The query string in a stable order, without the parameters that don't matter """
+
+    params = []
+    for key, values in sorted(request.GET.lists()):
+        if key in IGNORED_PARAMETERS:
+            continue
+        for value in sorted(values):
+            params.append('%s=%s' % (key, value))
+
+    return '&'.join(params)
+
+#------------------------------------------------------------------------
+
+def get_generation(cache, resource_name):
+    """ The current generation for a resource - changed by every write to it """
+
+    key = 'generation:%s' % (resource_name)
+    generation = cache.get(key)
+    if generation is None:
+        # add() so that concurrent processes agree on the first generation
+        cache.add(key, uuid.uuid4().hex)
+        generation = cache.get(key)
+
+    return generation
+
+def invalidate_responses(resource_name):
+    """ Moves the resource onto a new generation, leaving its old entries unreachable """
+
+    if response_cache_enabled():
+        get_response_cache().set('generation:%s' % (resource_name), uuid.uuid4().hex)
+
+#------------------------------------------------------------------------
+
+def build_cache_key(cache, resource_name, request, format):
+
+    parts = [request.path, normalize_query(request), format, get_visibility_class(request)]
+    digest = hashlib.md5('|'.join(parts).encode('utf-8')).hexdigest()
+
+    return 'response:%s:%s:%s' % (resource_name, get_generation(cache, resource_name), digest)
+
+#------------------------------------------------------------------------
+
+def cached_response(request, resource_name, format, build_response):
+    """ Serves an anonymous GET from the cache, or calls build_response() and
+        stores what it returns if it was a success """
+
+    if not response_cache_enabled() or request.method != 'GET' or get_visibility_class(request) != 'anonymous':
+        return build_response()
+
+    cache = get_response_cache()
+    key = build_cache_key(cache, resource_name, request, format)
+
+    cached = cache.get(key)
+    if cached is not None:
+        content, content_type = cached
+        response = HttpResponse(content, content_type=content_type)
+        response['Access-Control-Allow-Origin'] = '*'
+        response['Access-Control-Allow-Headers'] = 'Content-Type'
+        return response
+
+    response = build_response()
+    if response.status_code == 200 and not getattr(response, 'streaming', False):
+        cache.set(key, (response.content, response['Content-Type']))
+
+    return response
+
+#------------------------------------------------------------------------
+
+def invalidate_after_writes(view, resource_name):
+    """ Wraps a resource view so that non-GET requests invalidate the resource's responses
+        once they have been handled (whatever the outcome) """
+
+    @csrf_exempt
+    def wrapper(request, *args, **kwargs):
+        try:
+            return view(request, *args, **kwargs)
+        finally:
+            if request.method not in ('GET', 'HEAD', 'OPTIONS'):
+                invalidate_responses(resource_name)
+
+    return wrapper
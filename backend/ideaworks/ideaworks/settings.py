@@ -223,6 +223,82 @@ except:
 LOG_FILE_PATH    = os.path.join(LOG_PATH, logFile)
 REQUEST_LOG_PATH = os.path.join(LOG_PATH, requestLogFile)
 
+#////////////////////////////////////////////////////////////////////////////////////
+#
+#    SHARED RESPONSE CACHE (anonymous GETs - see ideaworks/response_cache.py)
+#
+#////////////////////////////////////////////////////////////////////////////////////
+
+# File based so that all of the apache processes share (and invalidate) the same entries.
+# A local settings file can set RESPONSE_CACHE_PATH, or turn the cache off.
+try:
+    RESPONSE_CACHE_PATH = RESPONSE_CACHE_PATH
+except:
+    RESPONSE_CACHE_PATH = os.path.join(ROOT_PATH, 'response_cache')
+
+try:
+    RESPONSE_CACHE_ENABLED = RESPONSE_CACHE_ENABLED
+except:
+    # Off for the test runs, so that responses can't leak between test databases
+    RESPONSE_CACHE_ENABLED = 'test' not in sys.argv
+
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    },
+    'responses': {
+        'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+        'LOCATION': RESPONSE_CACHE_PATH,
+        'TIMEOUT': 300,
+        'OPTIONS': {'MAX_ENTRIES': 2000},
+    },
+}
+
+#////////////////////////////////////////////////////////////////////////////////////
+#
+#    COMMENT STORAGE (see ideaworks/comment_store.py)
+#
+#////////////////////////////////////////////////////////////////////////////////////
+
+# 'embedded' keeps comments inside the idea/project/feedback they're on. 'collection' keeps
+# them in a collection per app, paged at /<resource>/<id>/comments/. Existing comments are
+# moved across with the move_comments management command.
+try:
+    COMMENT_STORAGE = COMMENT_STORAGE
+except:
+    COMMENT_STORAGE = 'embedded'
+
+#////////////////////////////////////////////////////////////////////////////////////
+#
+#    REQUEST TIMING (see ideaworks/request_timing.py)
+#
+#////////////////////////////////////////////////////////////////////////////////////
+
+# Each API request's stages (auth, query, dehydrate, max_pm, serialize...) are logged to the
+# django.request log. SERVER_TIMING_HEADER also returns them in a Server-Timing header
+# to 'all' requesters, only to 'staff', or to no-one (None).
+try:
+    REQUEST_TIMING_ENABLED = REQUEST_TIMING_ENABLED
+except:
+    REQUEST_TIMING_ENABLED = True
+
+try:
+    SERVER_TIMING_HEADER = SERVER_TIMING_HEADER
+except:
+    SERVER_TIMING_HEADER = 'staff'
+
+#////////////////////////////////////////////////////////////////////////////////////
+#
+#    BULK CREATION (see ideaworks/bulk_create.py)
+#
+#////////////////////////////////////////////////////////////////////////////////////
+
+# The most ideas/projects that one PATCH to the list end point can create
+try:
+    BULK_CREATE_MAX_OBJECTS = BULK_CREATE_MAX_OBJECTS
+except:
+    BULK_CREATE_MAX_OBJECTS = 1000
+
 LOGGING = {
     'version': 1,
     'disable_existing_loggers': True,
@@ -0,0 +1,98 @@
+
+# (c) Crown Copyright 2014 Defence Science and Technology Laboratory UK
+# Author: Rich Brantingham
+
+"""
+Ranks ?tags__in=a,b,c queries by the number of requested tags each object
+matches, in the database.
+
+The ranking used to be a re-sort of the page tastypie had already fetched,
+so it didn't hold across pages. TagRankedQuerySet wraps the filtered (and
+authorised) queryset and looks just enough like one for tastypie's paginator:
+the count comes from the queryset and each slice runs an aggregation that
+ranks on match count, then the requested order_by, with the skip/limit
+applied after the ranking. The documents for the page are then fetched by id.
+"""
+
+from bson.son import SON
+
+#------------------------------------------------------------------------
+
+def parse_order_by(order_by):
+    """ Turns tastypie order_by values (e.g. ['-created', 'title']) into (field, direction) pairs """
+
+    fields = []
+    for field in order_by or []:
+        if not field:
+            continue
+        if field.startswith('-'):
+            fields.append((field[1:], -1))
+        else:
+            fields.append((field, 1))
+
+    return fields
+
+#------------------------------------------------------------------------
+
+class TagRankedQuerySet(object):
+    """ A filtered queryset ranked by the number of tags matched """
+
+    def __init__(self, queryset, tags, order_by=None):
+
+        self.queryset = queryset
+        self.tags = [tag for tag in tags if tag]
+        self.order_by = parse_order_by(order_by)
+
+    def build_aggregation(self, skip=0, limit=None):
+        """ Rank: match count, then the requested ordering, then insertion order """
+
+        group = {'_id' : '$_id', 'matched' : {'$sum' : 1}}
+        sort = SON([('matched', -1)])
+        for i, (field, direction) in enumerate(self.order_by):
+            group['sort_%s' % (i)] = {'$first' : '$' + field}
+            sort['sort_%s' % (i)] = direction
+        sort['_id'] = 1
+
+        # The first $match (which includes tags $in) is served by the multikey index on tags
+        aggregation = [{'$match'  : self.queryset._query},
+                       {'$unwind' : '$tags'},
+                       {'$match'  : {'tags' : {'$in' : self.tags}}},
+                       {'$group'  : group},
+                       {'$sort'   : sort}]
+
+        if skip:
+            aggregation.append({'$skip' : skip})
+        if limit is not None:
+            aggregation.append({'$limit' : limit})
+
+        return aggregation
+
+    def ranked_ids(self, skip=0, limit=None):
+
+        collection = self.queryset._document._get_collection()
+        return [res['_id'] for res in collection.aggregate(self.build_aggregation(skip, limit))['result']]
+
+    def count(self):
+        return self.queryset.count()
+
+    def __len__(self):
+        return self.count()
+
+    def __getitem__(self, key):
+
+        if not isinstance(key, slice):
+            return self[key:key + 1][0]
+
+        skip = key.start or 0
+        limit = None
+        if key.stop is not None:
+            limit = max(key.stop - skip, 0)
+            if limit == 0:
+                return []
+
+        ids = self.ranked_ids(skip, limit)
+        docs = dict((doc.pk, doc) for doc in self.queryset.clone().filter(pk__in=ids))
+        return [docs[doc_id] for doc_id in ids if doc_id in docs]
+
+    def __iter__(self):
+        return iter(self[0:None])
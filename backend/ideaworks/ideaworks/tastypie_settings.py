@@ -67,7 +67,9 @@ RESPONSE_FIELDS = {'min' : [ 'id',
                              'pretty_pm',
                              'status',
                              'user_voted',
-                             'vote_score'
+                             'vote_score',
+                             'search_score',   # Only on ?q= searches
+                             'search_snippet'  # Only on ?q= searches: the snippet around the terms, highlighted
                              ],
 
                    'proj_more' : ['contributor_name',
@@ -85,7 +87,9 @@ RESPONSE_FIELDS = {'min' : [ 'id',
                                   'pretty_pm',
                                   'status',
                                   'user_backed',
-                                  'related_ideas'
+                                  'related_ideas',
+                                  'search_score',   # Only on ?q= searches
+                                  'search_snippet'  # Only on ?q= searches: the snippet around the terms, highlighted
                                   ],
 
                    
@@ -141,4 +145,10 @@ RESPONSE_FIELDS = {'min' : [ 'id',
                                   'comment_count',
                                   'back_count',
                                   'protective_marking'
-                             ]}
\ No newline at end of file
+                             ]}
+
+# Contributor names are resolved in batches and cached in-process.
+# Entries are invalidated when a user is saved; the TTL (seconds) bounds how
+# stale another apache process's copy can get.
+CONTRIBUTOR_NAME_CACHE_SIZE = 2000
+CONTRIBUTOR_NAME_CACHE_TTL = 300
@@ -0,0 +1,147 @@
+
+# (c) Crown Copyright 2014 Defence Science and Technology Laboratory UK
+# Author: Rich Brantingham
+
+"""
+Full-text search (?q=) over ideas, projects and feedback.
+
+The only filters were exact tag, user and status matches, so finding
+something meant paging through whole lists. Each of those collections now
+has a text index over its title, description/body (and tags, where it has
+them), weighted towards the title, and ?q= on the list end points searches
+it (mongo 2.6+: the $text operator). The text indexes are created by the
+manage_indexes management command, never on the request path.
+
+TextSearchQuerySet wraps the filtered and authorised queryset in the same
+way as TagRankedQuerySet: the count is a $text find, and each slice runs an
+aggregation that orders on text score (then _id, so that pages don't shift)
+with the skip/limit applied in the database. The documents for the page are
+then fetched by id, each carrying its search_score. The apps add a
+search_snippet - derive_snippet's snippet, but from around the first term
+matched and with the terms highlighted.
+"""
+
+import re
+
+from bson.son import SON
+from django.utils.html import escape
+
+TEXT_INDEX_NAME = 'text_search'
+
+#------------------------------------------------------------------------
+
+def ensure_text_index(document_class, weights):
+    """ Creates the collection's text index on the weighted fields, if it isn't there.
+        Built in the background, so that a live collection stays usable meanwhile. """
+
+    keys = [(field, 'text') for field in sorted(weights.keys())]
+    document_class._get_collection().ensure_index(keys, name=TEXT_INDEX_NAME, weights=weights,
+                                                  default_language='english', background=True)
+
+#------------------------------------------------------------------------
+
+def get_search_terms(q):
+    """ The words of a search to highlight - not the excluded (-word) ones """
+
+    terms = []
+    for word in q.replace('"', ' ').split():
+        if word.startswith('-'):
+            continue
+        terms.extend([term.lower() for term in re.findall(r'\w+', word, re.UNICODE)])
+
+    return terms
+
+def build_terms_pattern(terms):
+    """ Matches the words starting with any of the terms (the index stems, so 'idea' finds 'ideas') """
+
+    return re.compile(r'\b(%s)\w*' % ('|'.join([re.escape(term) for term in terms])), re.IGNORECASE | re.UNICODE)
+
+def search_window(text, terms, chrs=240):
+    """ The text from a little before the first term matched, so that a match
+        beyond the first chrs characters still makes it into the snippet """
+
+    match = build_terms_pattern(terms).search(text) if terms else None
+    if not match or match.start() < chrs / 2:
+        return text
+
+    start = text.rfind(' ', 0, match.start() - chrs / 4) + 1
+    if start <= 0:
+        return text
+    return '...' + text[start:]
+
+def highlight_terms(snippet, terms):
+    """ Escapes a (tag stripped) snippet and wraps the words matching the terms in <em> """
+
+    if not snippet:
+        return snippet
+
+    snippet = escape(snippet)
+    if not terms:
+        return snippet
+    return build_terms_pattern(terms).sub(lambda match: '<em>%s</em>' % (match.group(0)), snippet)
+
+#------------------------------------------------------------------------
+
+class TextSearchQuerySet(object):
+    """ A filtered queryset searched with the text index and ordered by relevance """
+
+    def __init__(self, queryset, q):
+
+        self.queryset = queryset
+        self.q = q
+
+    def build_query(self):
+        """ The queryset's own (filter and authorisation) query, plus the search """
+
+        query = dict(self.queryset._query)
+        query['$text'] = {'$search' : self.q}
+        return query
+
+    def build_aggregation(self, skip=0, limit=None):
+
+        aggregation = [{'$match'   : self.build_query()},
+                       {'$project' : {'score' : {'$meta' : 'textScore'}}},
+                       {'$sort'    : SON([('score', -1), ('_id', 1)])}]
+
+        if skip:
+            aggregation.append({'$skip' : skip})
+        if limit is not None:
+            aggregation.append({'$limit' : limit})
+
+        return aggregation
+
+    def scored_ids(self, skip=0, limit=None):
+
+        collection = self.queryset._document._get_collection()
+        return [(res['_id'], res['score']) for res in collection.aggregate(self.build_aggregation(skip, limit))['result']]
+
+    def count(self):
+        return self.queryset._document._get_collection().find(self.build_query()).count()
+
+    def __len__(self):
+        return self.count()
+
+    def __getitem__(self, key):
+
+        if not isinstance(key, slice):
+            return self[key:key + 1][0]
+
+        skip = key.start or 0
+        limit = None
+        if key.stop is not None:
+            limit = max(key.stop - skip, 0)
+            if limit == 0:
+                return []
+
+        scored = self.scored_ids(skip, limit)
+        docs = dict((doc.pk, doc) for doc in self.queryset.clone().filter(pk__in=[doc_id for doc_id, score in scored]))
+
+        page = []
+        for doc_id, score in scored:
+            if doc_id in docs:
+                docs[doc_id].search_score = score
+                page.append(docs[doc_id])
+        return page
+
+    def __iter__(self):
+        return iter(self[0:None])
@@ -27,6 +27,9 @@ urlpatterns = patterns('',
     #TODO: Make this clearer and more coherent across ideas and projects
     (r'^api_docs/', include('tastytools.urls'), {'api_name': v1_api.api_name}),
     
+    # Hit/miss counters of the in-process caches (staff only)
+    url(r'^cache_stats/$', 'ideaworks.views.cache_stats', name='cache_stats'),
+    
     # Authentication, registration, etc.
     url(r'^',   include('auth_addin_app.urls')),
 
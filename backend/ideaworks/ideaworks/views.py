@@ -0,0 +1,24 @@
+
+# (c) Crown Copyright 2014 Defence Science and Technology Laboratory UK
+# Author: Rich Brantingham
+
+import json
+
+from django.http import HttpResponse
+from django.contrib.admin.views.decorators import staff_member_required
+
+from ideaworks.api_key_cache import api_key_cache
+from ideaworks.contributors import name_cache
+from ideaworks.feeds import feed_item_cache
+
+#------------------------------------------------------------------------
+
+@staff_member_required
+def cache_stats(request):
+    """ Hit/miss counters of this process's in-process caches (each apache process has its own) """
+
+    stats = {'api_keys'          : api_key_cache.stats(),
+             'contributor_names' : name_cache.stats(),
+             'feed_items'        : feed_item_cache.stats()}
+
+    return HttpResponse(json.dumps(stats), content_type='application/json')
@@ -0,0 +1,161 @@
+
+# (c) Crown Copyright 2014 Defence Science and Technology Laboratory UK
+# Author: Rich Brantingham
+
+"""
+A collection of who has voted on what - likes and dislikes on ideas, backs
+on projects - with a unique (target, user) index.
+
+The embedded likes, dislikes and backs lists are part of the API (the front
+end removes a back by its position in the list), so they are still written.
+But checking them for a duplicate meant loading and scanning the whole list,
+and user_voted/user_backed scanned them again for every object on every page.
+Now every vote is also a document here:
+
+ - a second vote by the same user is rejected by the unique index, and a
+   like switched to a dislike (or back) is one conditional update, and
+ - the requesting user's votes on a page of ideas or projects are looked up
+   with one $in query, once the page has been dehydrated.
+
+Votes from before this collection are loaded into it by the rebuild_votes
+management command. Until it has been run (i.e. while the collection is
+empty) user_voted/user_backed are read from the embedded lists instead.
+"""
+
+import datetime
+
+from bson.objectid import ObjectId
+from pymongo.errors import DuplicateKeyError
+
+from mongoengine import Document, ObjectIdField, StringField, DateTimeField
+
+#------------------------------------------------------------------------
+
+class UserVote(Document):
+    """ One user's vote on one idea or project """
+
+    target      = ObjectIdField(required=True, help_text="The idea or project voted on.")
+    user        = StringField(required=True, help_text="The user who voted. User id as a string.")
+    type        = StringField(help_text="like | dislike | back")
+    created     = DateTimeField(help_text="When the user voted.", default=datetime.datetime.utcnow)
+
+    meta = {'collection' : 'votes',
+            'db_alias'   : 'default',
+            'indexes'    : [{'fields' : ['target', 'user'], 'unique' : True}]}
+
+#------------------------------------------------------------------------
+
+def claim_vote(target_id, user, vote_type, opposite_type=None):
+    """ Records a user's vote. Returns 'new', 'switched' (from opposite_type) or 'duplicate' """
+
+    collection = UserVote._get_collection()
+    target_id = ObjectId(target_id)
+    now = datetime.datetime.utcnow()
+
+    try:
+        collection.insert({'target' : target_id, 'user' : user, 'type' : vote_type, 'created' : now})
+        return 'new'
+    except DuplicateKeyError:
+        pass
+
+    if opposite_type:
+        result = collection.update({'target' : target_id, 'user' : user, 'type' : opposite_type},
+                                   {'$set' : {'type' : vote_type, 'created' : now}})
+        if result and result.get('n'):
+            return 'switched'
+
+    return 'duplicate'
+
+def release_vote(target_id, user, vote_type, claimed='new', opposite_type=None):
+    """ Undoes claim_vote() - when the vote couldn't be applied, or is withdrawn """
+
+    collection = UserVote._get_collection()
+    query = {'target' : ObjectId(target_id), 'user' : user, 'type' : vote_type}
+
+    if claimed == 'switched':
+        collection.update(query, {'$set' : {'type' : opposite_type}})
+    elif claimed == 'new':
+        collection.remove(query)
+
+def remove_target_votes(target_id):
+    """ Drops the votes on an idea or project that has been deleted """
+
+    UserVote._get_collection().remove({'target' : ObjectId(target_id)})
+
+def remove_targets_votes(target_ids):
+    """ Drops the votes on a batch of deleted ideas or projects, with one remove """
+
+    if target_ids:
+        UserVote._get_collection().remove({'target' : {'$in' : [ObjectId(target_id) for target_id in target_ids]}})
+
+#------------------------------------------------------------------------
+
+def get_user_votes(user, target_ids):
+    """ {target id: vote type} for a user's votes on the targets, in one $in query """
+
+    if not user or not target_ids:
+        return {}
+
+    cursor = UserVote._get_collection().find({'user' : user, 'target' : {'$in' : list(target_ids)}},
+                                             {'target' : 1, 'type' : 1, '_id' : 0})
+    return dict([(vote['target'], vote['type']) for vote in cursor])
+
+def get_embedded_user_votes(document_class, user, target_ids, vote_fields):
+    """ {target id: vote type} for a user's votes on the targets, read from the embedded vote
+        lists ({list field: vote type}) with one $elemMatch projection over the targets """
+
+    if not user or not target_ids:
+        return {}
+
+    projection = dict([(field, {'$elemMatch' : {'user' : user}}) for field in vote_fields])
+    votes = {}
+    for doc in document_class._get_collection().find({'_id' : {'$in' : list(target_ids)}}, projection):
+        for field, vote_type in vote_fields.items():
+            if doc.get(field):
+                votes[doc['_id']] = vote_type
+    return votes
+
+def set_user_votes(request, bundles, field, values, vote_fields=None):
+    """ Sets bundle.data[field] on each of the (dehydrated) bundles that has it, to
+        values[type] of the requesting user's vote on the object - or 0 if they haven't voted.
+        vote_fields ({list field: vote type}) are read instead while the vote collection is empty. """
+
+    bundles = [bundle for bundle in bundles if field in getattr(bundle, 'data', {})]
+    if not bundles:
+        return
+
+    user = getattr(request, 'user', None)
+    votes = {}
+    if user is not None and user.is_authenticated():
+        target_ids = [bundle.obj.pk for bundle in bundles if bundle.obj.pk]
+        votes = get_user_votes(user.username, target_ids)
+
+        # Not loaded by rebuild_votes yet
+        if not votes and vote_fields and UserVote._get_collection().find_one({}, {'_id' : 1}) is None:
+            votes = get_embedded_user_votes(type(bundles[0].obj), user.username, target_ids, vote_fields)
+
+    for bundle in bundles:
+        bundle.data[field] = values.get(votes.get(bundle.obj.pk), 0)
+
+#------------------------------------------------------------------------
+
+def rebuild_votes(sources):
+    """ Loads the votes in the embedded lists into the vote collection.
+        sources is [(document class, {vote list field: vote type})]. Returns the number of votes loaded. """
+
+    collection = UserVote._get_collection()
+
+    loaded = 0
+    for document_class, fields in sources:
+        projection = dict([(field, 1) for field in fields])
+        for doc in document_class._get_collection().find({}, projection):
+            for field, vote_type in fields.items():
+                for vote in doc.get(field) or []:
+                    if not vote.get('user'):
+                        continue
+                    collection.update({'target' : doc['_id'], 'user' : vote['user']},
+                                      {'$set' : {'type' : vote_type, 'created' : vote.get('created')}},
+                                      upsert=True)
+                    loaded += 1
+
+    return loaded
@@ -0,0 +1,62 @@
+
+# (c) Crown Copyright 2014 Defence Science and Technology Laboratory UK
+# Author: Rich Brantingham
+
+"""
+Per-collection 'last modified' watermarks.
+
+The list end points report the most recent change to a collection in
+meta.modified, which the front end polls to decide whether to refresh.
+Rather than sorting the collection (and unwinding every comment) on each
+request, every write path moves a small watermark document forward and the
+list end points read it back with a single _id lookup.
+"""
+
+import datetime
+
+from mongoengine import Document, StringField, DateTimeField
+
+#------------------------------------------------------------------------
+
+class Watermark(Document):
+    """ The last time anything in a collection (or its sub-documents) changed """
+
+    name        = StringField(primary_key=True, help_text="The collection/end point this watermark covers, e.g. 'idea'.")
+    modified    = DateTimeField(help_text="When the collection was last written to.")
+
+    meta = {'collection' : 'watermarks',
+            'db_alias'   : 'default'}
+
+#------------------------------------------------------------------------
+
+def touch_watermark(name, modified=None):
+    """ Move the watermark for a collection forward.
+        $max keeps concurrent writers from moving it backwards. """
+
+    if not modified:
+        modified = datetime.datetime.utcnow()
+
+    Watermark._get_collection().update({'_id' : name},
+                                       {'$max' : {'modified' : modified}},
+                                       upsert=True)
+    return modified
+
+#------------------------------------------------------------------------
+
+def get_watermark(name, rebuild=None):
+    """ Get the watermark for a collection.
+        If there isn't one yet (e.g. existing data, first run) then rebuild()
+        is called to derive it the slow way, and the result stored. """
+
+    doc = Watermark._get_collection().find_one({'_id' : name})
+    if doc and doc.get('modified'):
+        return doc['modified']
+
+    if not rebuild:
+        return None
+
+    modified = rebuild()
+    if modified:
+        touch_watermark(name, modified)
+
+    return modified
@@ -5,6 +5,7 @@
 import re
 import datetime
 import json
+from bson.objectid import ObjectId
 
 from django.conf import settings
 from django.contrib.sites.models import get_current_site
@@ -17,16 +18,31 @@ from tastypie_mongoengine import resources
 from tastypie_mongoengine import fields as mongo_fields
 
 from ideaworks.generic_resources import BaseCorsResource
+from ideaworks.request_timing import timed
+from ideaworks.watermarks import touch_watermark, get_watermark
+from ideaworks.conditional_get import conditional_response, get_document_modified
+from ideaworks.response_cache import cached_response, invalidate_after_writes
+from ideaworks.csv_export import csv_response, get_csv_fields
+from ideaworks.feeds import cached_feed
+from ideaworks.tag_ranking import TagRankedQuerySet
+from ideaworks.text_search import TextSearchQuerySet, get_search_terms
+from ideaworks.pagination import KeysetPaginator
+from ideaworks.comment_store import StoredComments, comments_in_collection, dispatch_stored_comments, store_comment, add_to_parent_max_pm
+from ideaworks.bulk_create import BulkCreate
+from ideaworks.bulk_moderation import BulkModeration
+from ideaworks.votes import claim_vote, release_vote, set_user_votes, remove_targets_votes
 
 import projectsapp.documents as documents
-import ideasapp.documents as idea_documents # This used in tags aggregation
+import ideasapp.documents as idea_documents # This holds the tag counts shared with ideas
 
 from projectsapp.authentication import CustomApiKeyAuthentication
 from projectsapp.authorization import PrivAndStatusAuthorization
 from projectsapp.serializers import CustomSerializer
-from api_functions import cleanup_tags, get_all_pms, get_max_pm, filter_by_data_level, tag_based_filtering
-from api_functions import calculate_informal_time, derive_snippet, get_contributors_info, count_builder
-from api_functions import get_user_vote_status, get_top_level_pm_elements, merge_tag_results
+from api_functions import cleanup_tags, get_all_pms, get_max_pm, get_precomputed_pms, filter_by_data_level, tag_based_filtering
+from api_functions import calculate_informal_time, derive_snippet, derive_search_snippet, get_contributors_info, count_builder
+from api_functions import get_top_level_pm_elements, derive_last_modified
+from api_functions import get_data_level_projection, wants_field, derive_document_max_pm, merge_pms
+from api_functions import CSV_FIELDS, CSV_DERIVED_FIELDS, USER_BACKED_VALUES, EMBEDDED_VOTE_LISTS
 
 
 #-----------------------------------------------------------------------------
@@ -51,15 +67,18 @@ class CommentResource(BaseCorsResource, resources.MongoEngineResource):
         ''' Updates the comment modified timestamp field if the comment
             is edited.'''
 
+        now = datetime.datetime.utcnow()
+
         # Also change the parent if there is one for this call
         regExp = re.compile('.*/(?P<doc_id>[a-zA-Z0-9]{24})/.*')
         m = re.match(regExp, bundle.request.path).groupdict()
         if m:
-            documents.Project.objects.get(id=m['doc_id']).update(**{'set__modified': datetime.datetime.utcnow()})
+            documents.Project.objects.get(id=m['doc_id']).update(**{'set__modified': now})
+            touch_watermark('project', now)
         
         # Change the modified date for all calls
         if bundle.request.method != 'GET':
-            bundle.data['modified'] = datetime.datetime.utcnow()
+            bundle.data['modified'] = now
 
         return bundle
 
@@ -106,7 +125,9 @@ class CommentResource(BaseCorsResource, resources.MongoEngineResource):
         m = re.match(regExp, bundle.request.path).groupdict()
         
         # Decrement the comment count of the host document
-        documents.Project.objects.get(id=m['doc_id']).update(**{'inc__comment_count': -1})
+        now = datetime.datetime.utcnow()
+        documents.Project.objects.get(id=m['doc_id']).update(**{'inc__comment_count': -1, 'set__modified': now})
+        touch_watermark('project', now)
         
         return super(CommentResource, self).obj_delete(bundle, **{'pk':m['comment_id']})
         
@@ -182,6 +203,14 @@ class CommentResource(BaseCorsResource, resources.MongoEngineResource):
         else:
             return content_types[format]
         
+# ------------------------------------------------------------------------------------------------------------        
+     
+    def hydrate_body_snippet(self, bundle):
+        ''' The snippet is derived as the comment is written, rather than on every read '''
+        
+        bundle.data['body_snippet'] = derive_snippet(bundle.data.get('body'))
+        return bundle
+
 # ------------------------------------------------------------------------------------------------------------        
      
     def dehydrate(self, bundle):
@@ -191,9 +220,6 @@ class CommentResource(BaseCorsResource, resources.MongoEngineResource):
         bundle.data['informal_created'] = calculate_informal_time(bundle.data['created'])
         bundle.data['informal_modified'] = calculate_informal_time(bundle.data['modified'])
         
-        if bundle.data.has_key('body'):
-            bundle.data['body_snippet'] = derive_snippet(bundle.data['body'])
-        
         # Lookup the user's info
         bundle = get_contributors_info(bundle)
         
@@ -201,7 +227,33 @@ class CommentResource(BaseCorsResource, resources.MongoEngineResource):
 
 #-----------------------------------------------------------------------------
 
-class ProjectResource(BaseCorsResource, resources.MongoEngineResource):
+class StoredCommentResource(StoredComments, CommentResource):
+    ''' Project comments kept in their own collection (COMMENT_STORAGE = 'collection'),
+        paged through at /project/<id>/comments/. Otherwise as CommentResource. '''
+    
+    parent_class = documents.Project
+    parent_name = 'project'
+    derive_max_pm = staticmethod(derive_document_max_pm)
+    merge_pms = staticmethod(merge_pms)
+    
+    class Meta(CommentResource.Meta):
+        queryset = documents.StoredComment.objects.all()
+        object_class = documents.StoredComment
+        excludes = ['parent_id']
+        ordering = ['created', 'modified']
+        # Offset paging, or keyset paging with ?cursor=
+        paginator_class = KeysetPaginator
+
+#-----------------------------------------------------------------------------
+
+class ProjectResource(BulkCreate, BulkModeration, BaseCorsResource, resources.MongoEngineResource):
+    
+    # A PATCH to the list creates a batch of projects, and staff can change the status of many
+    # at /project/moderate/ - see ideaworks/bulk_create.py and ideaworks/bulk_moderation.py
+    source_name = 'project'
+    add_batch_tag_counts = staticmethod(idea_documents.add_batch_tag_counts)
+    derive_status_change = staticmethod(idea_documents.derive_status_change)
+    apply_tag_count_changes = staticmethod(idea_documents.apply_tag_count_changes)
     
     protective_marking  = mongo_fields.EmbeddedDocumentField(embedded='projectsapp.api.ProtectiveMarkingResource', attribute='protective_marking', help_text='protective marking of this object, comprising classification, descriptor, codewords and national caveats.', null=True)
     comments            = mongo_fields.EmbeddedListField(of='projectsapp.api.CommentResource', attribute='comments', full=True, null=True)
@@ -210,8 +262,10 @@ class ProjectResource(BaseCorsResource, resources.MongoEngineResource):
     class Meta:
         queryset = documents.Project.objects.all()
         resource_name = 'project'
+        # Only used to build meta.max_pm
+        excludes = ['max_pm']
         # What is permitted at the list level and at the single instance level
-        list_allowed_methods = ['get', 'post', 'delete', 'put']
+        list_allowed_methods = ['get', 'post', 'delete', 'put', 'patch']
         detailed_allowed_methods = ['get', 'post', 'put', 'delete', 'patch']
         
         # Setup to default print pretty - mainly for debuggin
@@ -221,6 +275,8 @@ class ProjectResource(BaseCorsResource, resources.MongoEngineResource):
         authorization = PrivAndStatusAuthorization()
         
         max_limit = None
+        # Offset paging, or keyset paging with ?cursor=
+        paginator_class = KeysetPaginator
 
         filtering = {'created'        : ['gt', 'gte', 'lt', 'lte'],
                      'modified'       : ['gt', 'gte', 'lt', 'lte'],
@@ -277,8 +333,8 @@ class ProjectResource(BaseCorsResource, resources.MongoEngineResource):
 
 # ------------------------------------------------------------------------------------------------------------        
 
-    def obj_create(self, bundle, **kwargs):
-        ''' Modifies the content before submission '''
+    def prepare_create(self, bundle):
+        ''' Modifies the content of a new project before submission (singly or in a batch) '''
         
         # Add in the user
         bundle.data['user'] = bundle.request.user.username
@@ -291,7 +347,13 @@ class ProjectResource(BaseCorsResource, resources.MongoEngineResource):
         bundle = count_builder(bundle, 'comments',  'comment_count')
         bundle = count_builder(bundle, 'backs',     'back_count')
         bundle = count_builder(bundle, 'tags',      'tag_count')
-         
+        
+        return bundle
+
+    def obj_create(self, bundle, **kwargs):
+        ''' Modifies the content before submission '''
+        
+        bundle = self.prepare_create(bundle)
         return super(ProjectResource, self).obj_create(bundle)
 
 # ------------------------------------------------------------------------------------------------------------        
@@ -314,12 +376,13 @@ class ProjectResource(BaseCorsResource, resources.MongoEngineResource):
         
         # Don't apply the meta object if it's anything but GET
         if request.method == 'GET':
+            set_user_votes(request, [data], 'user_backed', USER_BACKED_VALUES, EMBEDDED_VOTE_LISTS)
             
             # Add a meta element for the single item response
             response_data = {'meta':{},'objects':[data]}
     
             # Add max PM into a newly created meta object
-            pms = get_all_pms(response_data['objects'],subdocs_to_check=['comments'],pm_name='protective_marking')
+            pms = get_precomputed_pms(response_data['objects'], subdocs_to_check=['comments'])
             response_data['meta']['max_pm'] = get_max_pm(pms)    
     
             # Get the modified time for this 1 object
@@ -339,37 +402,21 @@ class ProjectResource(BaseCorsResource, resources.MongoEngineResource):
         
         ''' Modify content just before serialized to output '''             
 
-        # Try to get the modified timestamp. Except catches instance where no data
-        try:
-            proj_mod = documents.Project.objects.order_by('-modified')[0]['modified']
-        except:
+        # The requesting user's backs on this page, in one query
+        with timed(request, 'user_votes'):
+            set_user_votes(request, data['objects'], 'user_backed', USER_BACKED_VALUES, EMBEDDED_VOTE_LISTS)
+
+        # The most recent change to any project/comment/back, kept up to date by the write paths.
+        # No watermark (and nothing to rebuild one from) means there's no data.
+        modified = get_watermark('project', rebuild=lambda: derive_last_modified(documents.Project))
+        if not modified:
             return data
+        data['meta']['modified'] = modified
         
-        # Retrieve all comment modified timestamps (idea, comments)
-        res = documents.Project._get_collection().aggregate([
-            { "$project" : {"_id" : 0, "comments" : 1}},
-            { "$unwind" : "$comments" },
-            { "$project" : {"modified" : "$comments.modified"}},
-            { "$sort" : {"modified" : -1}},
-            { "$limit" : 1}
-        ])['result']
-        
-        # In the event that there are no comments, chuck in an old date to guarantee the Project mod date wins
-        if res:
-            comments_mod = res[0]['modified']
-        else:
-            comments_mod = datetime.datetime(1970,1,1)
-            
-        # Assign the meta-level modified datetime to the most recent comment/Project modified datetime
-        data['meta']['modified'] = max([proj_mod, comments_mod])
-        
-        # Tag-based filtering
-        if request.method == 'GET' and request.GET.get('tags__in'):
-            data = tag_based_filtering(request, data)
-        
-        # Find the highest protective marking in the dataset
-        pms = get_all_pms(data['objects'], subdocs_to_check=['comments'], pm_name='protective_marking')
-        data['meta']['max_pm'] = get_max_pm(pms)    
+        # Find the highest protective marking in the dataset (one precomputed marking per project)
+        with timed(request, 'max_pm'):
+            pms = get_precomputed_pms(data['objects'], subdocs_to_check=['comments'])
+            data['meta']['max_pm'] = get_max_pm(pms)    
 
         # Filter out the meta and objects content based on the data_level
         if request.method == 'GET':
@@ -379,6 +426,99 @@ class ProjectResource(BaseCorsResource, resources.MongoEngineResource):
 
     # ------------------------------------------------------------------------------------------------------------        
 
+    def get_list(self, request, **kwargs):
+        ''' Answers conditional GETs from the collection watermark (meta.modified) before anything is loaded,
+            then serves anonymous requests from the shared response cache '''
+        
+        modified = get_watermark('project', rebuild=lambda: derive_last_modified(documents.Project))
+        
+        def build_response():
+            return cached_response(request, 'project', self.determine_format(request),
+                                   lambda: self.get_list_by_format(request, modified, **kwargs))
+        
+        return conditional_response(request, modified, build_response)
+
+    def get_detail(self, request, **kwargs):
+        ''' Answers conditional GETs (for projects the requester can read) from the project's own modified before it is loaded,
+            then serves anonymous requests from the shared response cache '''
+        
+        def build_response():
+            return cached_response(request, 'project', self.determine_format(request),
+                                   lambda: super(ProjectResource, self).get_detail(request, **kwargs))
+        
+        modified = get_document_modified(self, request, kwargs.get('pk'))
+        return conditional_response(request, modified, build_response)
+
+    def get_list_by_format(self, request, modified, **kwargs):
+        ''' Feeds are cached until the collection changes (its watermark, modified, moves on) and
+            csv exports are streamed from the db, rather than going through the usual list pipeline '''
+        
+        format = self.determine_format(request)
+        if format == 'application/rss+xml':
+            return cached_feed(request, 'project', modified, lambda: super(ProjectResource, self).get_list(request, **kwargs))
+        if format != 'text/csv':
+            return super(ProjectResource, self).get_list(request, **kwargs)
+        
+        # The same filtering, authorization and sorting as a list GET
+        base_bundle = self.build_bundle(request=request)
+        objects = self.obj_get_list(bundle=base_bundle, **self.remove_api_resource_names(kwargs))
+        objects = self.apply_sorting(objects, options=request.GET)
+        
+        fields = get_csv_fields(request, documents.Project, CSV_FIELDS, CSV_DERIVED_FIELDS)
+        return csv_response(request, documents.Project, objects, fields, CSV_DERIVED_FIELDS)
+
+    def wrap_view(self, view):
+        ''' Writes (including to sub-resources) invalidate the cached responses once handled '''
+        
+        return invalidate_after_writes(super(ProjectResource, self).wrap_view(view), 'project')
+
+    # ------------------------------------------------------------------------------------------------------------        
+
+    def dispatch_subresource(self, request, subresource_name, **kwargs):
+        ''' Comments kept in their own collection are served (and paged) from there '''
+        
+        if subresource_name == 'comments' and comments_in_collection():
+            return dispatch_stored_comments(documents.Project, StoredCommentResource, self._meta.api_name, request, **kwargs)
+        return super(ProjectResource, self).dispatch_subresource(request, subresource_name, **kwargs)
+
+    # ------------------------------------------------------------------------------------------------------------        
+
+    def get_object_list(self, request):
+        ''' Only loads the fields needed for the requested data_level,
+            so that e.g. data_level=min never reads the comments or votes '''
+        
+        object_list = super(ProjectResource, self).get_object_list(request)
+        
+        projection = get_data_level_projection(request, documents.Project)
+        if projection:
+            object_list = object_list.only(*projection)
+        
+        return object_list
+
+    # ------------------------------------------------------------------------------------------------------------        
+
+    def apply_sorting(self, obj_list, options=None):
+        ''' Orders ?q= searches by relevance, and ranks ?tags__in= queries by the number
+            of matching tags, in the db - so that the ordering holds across pages '''
+        
+        obj_list = super(ProjectResource, self).apply_sorting(obj_list, options)
+        
+        if options and options.get('q'):
+            obj_list = TextSearchQuerySet(obj_list, options.get('q'))
+        
+        elif options and options.get('tags__in'):
+            if hasattr(options, 'getlist'):
+                order_by = options.getlist('order_by')
+            else:
+                order_by = options.get('order_by')
+                if not isinstance(order_by, (list, tuple)):
+                    order_by = [order_by]
+            obj_list = TagRankedQuerySet(obj_list, options.get('tags__in').split(','), order_by)
+        
+        return obj_list
+
+    # ------------------------------------------------------------------------------------------------------------        
+
     def determine_format(self, request):
         ''' Override the default format, so that format=json is not required '''
     
@@ -407,30 +547,71 @@ class ProjectResource(BaseCorsResource, resources.MongoEngineResource):
             an embedded resource'''
         
         if bundle.request.method != 'GET':
-            bundle.data['modified'] = datetime.datetime.utcnow()
+            # A batch moves the watermark once, after it has been written
+            bundle.data['modified'] = getattr(bundle, 'batch_modified', None) or touch_watermark('project')
         return bundle
 
     # ------------------------------------------------------------------------------------------------------------        
 
+    def obj_delete(self, bundle, **kwargs):
+        ''' Removing a project changes the collection too '''
+        
+        response = super(ProjectResource, self).obj_delete(bundle, **kwargs)
+        touch_watermark('project')
+        return response
+
+    def obj_delete_list(self, bundle, **kwargs):
+        ''' Removing projects changes the collection too. A queryset delete doesn't go through
+            Project.delete(), so the projects' tag counts, stored comments and votes are updated here in bulk. '''
+        
+        objects_to_delete = self.obj_get_list(bundle=bundle, **kwargs)
+        deletable_objects = self.authorized_delete_list(objects_to_delete, bundle)
+        
+        if hasattr(deletable_objects, 'delete'):
+            ids = list(deletable_objects.scalar('id'))
+            # Count the tags being removed before they go
+            changes = idea_documents.derive_tag_removal(documents.Project, {'_id' : {'$in' : ids}})
+            documents.Project.objects(pk__in=ids).delete()
+            idea_documents.apply_tag_count_changes('project', changes)
+            documents.StoredComment.objects(parent_id__in=ids).delete()
+            remove_targets_votes(ids)
+        else:
+            for authed_obj in deletable_objects:
+                authed_obj.delete()
+        
+        touch_watermark('project')
+
+    # ------------------------------------------------------------------------------------------------------------        
+
     def dehydrate(self, bundle):
-        ''' Dehydrate - data on its way back to requester '''
+        ''' Dehydrate - data on its way back to requester.
+            Only derives the fields that the data_level will let through. '''
         
-        # User gets passed through because CustomAuth now passes it even for GET requests
-        bundle.data['user_backed'] = get_user_vote_status(bundle)
+        # User gets passed through because CustomAuth now passes it even for GET requests.
+        # Filled in for the whole page at once from the vote collection (see alter_*_data_to_serialize)
+        if wants_field(bundle, 'user_backed'):
+            bundle.data['user_backed'] = 0
         
         # Class will always have a time_stamp due to default.
-        bundle.data['informal_created'] = calculate_informal_time(bundle.data['created'])
-        bundle.data['informal_modified'] = calculate_informal_time(bundle.data['modified'])
+        if wants_field(bundle, 'informal_created'):
+            bundle.data['informal_created'] = calculate_informal_time(bundle.data['created'])
+        if wants_field(bundle, 'informal_modified'):
+            bundle.data['informal_modified'] = calculate_informal_time(bundle.data['modified'])
         
         # Get the useful protective marking elements
-        bundle = get_top_level_pm_elements(bundle)
+        if wants_field(bundle, 'pretty_pm', 'classification_short'):
+            bundle = get_top_level_pm_elements(bundle)
                
         # Lookup the user's info
-        bundle = get_contributors_info(bundle)
+        if wants_field(bundle, 'contributor_name'):
+            bundle = get_contributors_info(bundle)
 
-        # Produce a truncated (by word), html-tag cleaned version
-        if bundle.data.has_key('description'):
-            bundle.data['description_snippet'] = derive_snippet(bundle.data['description'])
+        # For ?q= searches, how well it matched and where
+        if bundle.request.GET.get('q') and hasattr(bundle.obj, 'search_score'):
+            if wants_field(bundle, 'search_score'):
+                bundle.data['search_score'] = bundle.obj.search_score
+            if bundle.data.has_key('description') and wants_field(bundle, 'search_snippet'):
+                bundle.data['search_snippet'] = derive_search_snippet(bundle.data['description'], get_search_terms(bundle.request.GET['q']))
         
         return bundle
 
@@ -465,7 +646,7 @@ class BackResource(resources.MongoEngineResource):
         else:
             return super(BackResource, self).post_list(request)
 
-        doc = documents.Project.objects.get(id=doc_id)
+        doc = documents.Project.objects.only('status').get(id=doc_id)
         
         # Backs are only allowed on published content
         if doc.status != 'published':
@@ -473,23 +654,13 @@ class BackResource(resources.MongoEngineResource):
             return self.create_response(request, bundle, response_class = http.HttpBadRequest)
         
         else:
-            # Get a list of who has backed
-            users_already_backed = [vote['user'] for vote in doc['backs']]
-            
             # Check this user actually exists in the db
             check_user = User.objects.get_by_natural_key(request.user.username)
             if not check_user:
                 return
                 #TODO: Return an error - Back not incremented
             
-            # Check whether the user has voted
-            user_id = request.user.username
-                            
-            # USER HAS ALREADY BACKED THE PROJECT - BLOCK ATTEMPTED DUPLICATE
-            if user_id not in users_already_backed:
-                documents.Project.objects(id=doc_id).update(**{'inc__back_count': 1})
-
-            # USER HASN'T DONE ANYTHING - LET HIM VOTE        
+            # Duplicates are blocked (and the back count incremented) in obj_create
             return super(BackResource, self).post_list(request)        
     
     #-----------------------------------------------------------------------------
@@ -497,18 +668,22 @@ class BackResource(resources.MongoEngineResource):
     def obj_create(self, bundle, **kwargs):
         ''' Determines how new objects will get created  '''
         
-        # Get the current document ID and those who have already Backed it
+        # Get the current document ID
         doc_id = bundle.request.path.replace('/backs/', '').split('/')[-1]
-        doc = documents.Project.objects.get(id=doc_id)
-        
-        # Get a list of who has backed it
-        users_already_backed = [back['user'] for back in doc['backs']]
         
         # Get the current user
         user_id = bundle.request.user.username
         
+        # USER HAS ALREADY BACKED THE PROJECT - BLOCK ATTEMPTED DUPLICATE.
+        # The unique (project, user) index on the vote collection turns it away, so the
+        # backs list isn't read. (Backs from before the collection are still checked for,
+        # without loading the list, until rebuild_votes has been run.)
+        claimed = claim_vote(doc_id, user_id, 'back')
+        if claimed == 'new' and documents.Project.objects(id=doc_id, backs__user=user_id).only('id').first():
+            claimed = 'duplicate'
+        
         # Assumes we already have a user otherwise they wouldn't have authenticated
-        if user_id not in users_already_backed:
+        if claimed == 'new':
             bundle.data['user'] = user_id
 
             # Decided to merge vote comments with standard comments,
@@ -529,24 +704,41 @@ class BackResource(resources.MongoEngineResource):
                     new_comment['body'] = vote_comment['body']
                 except:
                     new_comment['body'] = None
+                new_comment['body_snippet'] = derive_snippet(new_comment['body'])
 
                 try:
                     new_comment['protective_marking'] = vote_comment['protective_marking']
                 except:
                     new_comment['protective_marking'] = None
 
-                # Add in the new comment
+                pm = new_comment['protective_marking']
+                if pm:
+                    new_comment['protective_marking'] = documents.ProtectiveMarking(**dict([(key, value) for key, value in pm.items() if key in documents.ProtectiveMarking._fields]))
+                comment = documents.Comment(**new_comment)
+
+                # Add in the new comment, incrementing the comment count and merging its marking
+                # into the project's max_pm in the same update
+                update = {'$inc' : {'comment_count' : 1}}
                 try:
-                    documents.Project.objects(id=doc_id).update(**{'push__comments' : new_comment})
+                    if comments_in_collection():
+                        store_comment(documents.StoredComment, doc_id, comment)
+                    else:
+                        update['$push'] = {'comments' : comment.to_mongo()}
                     
                 except:
                     print 'Failed to push comment to project'
                     #TODO: Add in proper logging.
 
-                # Increment the comment count at the same time
-                documents.Project.objects(id=doc_id).update(**{'inc__comment_count': 1})
+                add_to_parent_max_pm(documents.Project, doc_id, comment.protective_marking, merge_pms, update)
             
-            return super(BackResource, self).obj_create(bundle)
+            try:
+                bundle = super(BackResource, self).obj_create(bundle)
+            except:
+                release_vote(doc_id, user_id, 'back')
+                raise
+            
+            documents.Project.objects(id=doc_id).update(**{'inc__back_count': 1})
+            return bundle
 
 # ------------------------------------------------------------------------------------------------------------        
     
@@ -557,10 +749,21 @@ class BackResource(resources.MongoEngineResource):
         regExp = re.compile('.*/(?P<doc_id>[a-zA-Z0-9]{24})/backs/(?P<back_id>\d+)/')
         m = re.match(regExp, bundle.request.path).groupdict()
         
+        # Just the back being deleted, for whose vote to give back
+        doc = documents.Project._get_collection().find_one({'_id' : ObjectId(m['doc_id'])},
+                                                           {'backs' : {'$slice' : [int(m['back_id']), 1]}, '_id' : 1})
+        
         # Decrement the comment count of the host document
         documents.Project.objects.get(id=m['doc_id']).update(**{'inc__back_count': -1})
+        touch_watermark('project')
+        
+        result = super(BackResource, self).obj_delete(bundle, **{'pk':m['back_id']})
         
-        return super(BackResource, self).obj_delete(bundle, **{'pk':m['back_id']})
+        # The user can back the project again
+        for back in (doc or {}).get('backs') or []:
+            release_vote(m['doc_id'], back.get('user'), 'back')
+        
+        return result
         
         
 # ------------------------------------------------------------------------------------------------------------        
@@ -572,7 +775,9 @@ class BackResource(resources.MongoEngineResource):
         regExp = re.compile('.*/(?P<doc_id>[a-zA-Z0-9]{24})/.*')
         m = re.match(regExp, bundle.request.path).groupdict()
         if m:
-            documents.Project.objects.get(id=m['doc_id']).update(**{'set__modified': datetime.datetime.utcnow()})
+            now = datetime.datetime.utcnow()
+            documents.Project.objects.get(id=m['doc_id']).update(**{'set__modified': now})
+            touch_watermark('project', now)
         
         bundle = super(BackResource, self).hydrate(bundle) 
         return bundle
@@ -721,31 +926,22 @@ class TagResource(BaseCorsResource, resources.MongoEngineResource):
         
     def get_object_list(self, request):
         
-        # Build a basic aggregation
-        aggregation = [
-                        { "$unwind" : "$tags" },
-                        { "$group" : { 
-                            "_id" : "$tags",
-                            "count" : { "$sum" : 1 }
-                            }
-                         },
-                         { "$sort" : {"count" : -1}
-                        }
-                       ]
-        
+        # Tag counts across projects and ideas are maintained as they are written
+        # (see ideasapp.documents.update_tag_counts)
+        statuses = None
         status = request.GET.get('status', None)  
         # So that status can be a list of comma separated statuses: ?status=hidden,published,draft
         if status:
             statuses = [s.strip() for s in status.split(',')]
-            aggregation.insert(0, {"$match" : {"status" : { "$in" : statuses }}})
         
-        # Get results from Projects and from Ideas
-        proj_res = documents.Project._get_collection().aggregate(aggregation)['result']
-        idea_res = idea_documents.Idea._get_collection().aggregate(aggregation)['result']
+        # Source collections can be picked in the same way: ?source=project,idea
+        sources = idea_documents.TAG_SOURCES
+        source = request.GET.get('source', None)
+        if source:
+            sources = [s.strip() for s in source.split(',') if s.strip() in idea_documents.TAG_SOURCES]
         
-        # Merge them into 1 list
-        res = merge_tag_results(proj_res, idea_res)
-        return [documents.Tag(text=tag['_id'],count=tag['count']) for tag in res]
+        res = idea_documents.read_tag_counts(sources, statuses)
+        return [documents.Tag(text=text, count=count) for text, count in res]
 
     def obj_get_list(self, bundle, **kwargs):
         # Filtering disabled for brevity...
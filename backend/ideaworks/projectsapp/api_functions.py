@@ -2,6 +2,7 @@
 # (c) Crown Copyright 2014 Defence Science and Technology Laboratory UK 
 # Author: Rich Brantingham
 
+import re
 import json
 import datetime
 from HTMLParser import HTMLParser
@@ -10,6 +11,9 @@ from django.contrib.auth.models import User
 from django.utils.html import strip_tags, escape
 
 from ideaworks.generic_resources import BaseCorsResource
+from ideaworks.contributors import get_request_resolver
+from ideaworks.comment_store import comments_in_collection
+from ideaworks.text_search import search_window, highlight_terms
 from ideaworks.settings import *
 import projectsapp.documents as documents
 from projectsapp.authentication import CustomApiKeyAuthentication
@@ -63,23 +67,16 @@ def get_top_level_pm_elements(bundle):
 #--------------------------------------------------------------------------------
 
 def get_contributors_info(bundle, contributor=None):
-    """ Get the user info for a specific contributor"""
-    
+    """ Get the user info for a specific contributor.
+        The name is resolved lazily, together with every other contributor
+        on the page, by the request's ContributorNameResolver. """
     
     # Get the id of the user
     if not contributor:
         contributor = bundle.data['user']
     
-    # Get the user object
-    user_obj = None
-    
-    try:
-        user_obj = User.objects.get(username=contributor)
-    except:
-        user_obj = User.objects.get(email=contributor)
-    
-    if user_obj:
-        bundle.data['contributor_name'] = user_obj.first_name.title() + ' ' + user_obj.last_name.title()
+    resolver = get_request_resolver(getattr(bundle, 'request', None))
+    bundle.data['contributor_name'] = resolver.name_for(contributor)
     
     return bundle
 
@@ -133,8 +130,8 @@ def get_sub_field(object, field_name):
             
 #--------------------------------------------------------------------------------
 
-def get_max_pm(pm_docs):
-    """ Get the maximum protective marking elements """
+def merge_pms(pm_docs):
+    """ Merge protective markings into a single marking covering all of them """
 
     max_class_rank = -1
     max_class_full = 'PUBLIC'
@@ -179,8 +176,10 @@ def get_max_pm(pm_docs):
         codewords_short += get_sub_field(doc, 'codewords_short')
         
         # Concatenate the descriptors - assumed not mutually exclusive
-        if get_sub_field(doc, 'descriptor') and get_sub_field(doc, 'descriptor').upper() not in descriptors:
-            descriptors.append(get_sub_field(doc, 'descriptor'))
+        # (a merged marking holds them comma separated, so split those back out)
+        for descriptor in (get_sub_field(doc, 'descriptor') or '').split(','):
+            if descriptor and descriptor.upper() not in descriptors:
+                descriptors.append(descriptor)
     
     #TODO: Just joining the descriptors together rather than handling them properly as a list
     descriptors_out = ','.join(descriptors)
@@ -195,7 +194,76 @@ def get_max_pm(pm_docs):
                                          codewords_short               = list(set(codewords_short)),
                                          descriptor                    = descriptors_out)
     
-    return json.loads(max_pm.to_json())
+    return max_pm
+
+#--------------------------------------------------------------------------------
+
+def get_max_pm(pm_docs):
+    """ Get the maximum protective marking elements """
+    
+    return json.loads(merge_pms(pm_docs).to_json())
+
+#--------------------------------------------------------------------------------
+
+def derive_document_max_pm(doc, subdocs_to_check=['comments']):
+    """ The effective protective marking of a document: its own marking plus
+        those of any listed sub-documents (i.e. comments). Stored against the
+        document at write time so reads don't need to walk the sub-documents. """
+    
+    pm_docs = []
+    if doc.protective_marking:
+        pm_docs.append(doc.protective_marking)
+    
+    for fld in subdocs_to_check:
+        for sub_object in getattr(doc, fld, None) or []:
+            if sub_object.protective_marking:
+                pm_docs.append(sub_object.protective_marking)
+    
+    # Comments kept in their own collection rather than embedded
+    if 'comments' in subdocs_to_check and doc.pk and comments_in_collection():
+        for comment in documents.StoredComment.objects(parent_id=doc.pk).only('protective_marking'):
+            if comment.protective_marking:
+                pm_docs.append(comment.protective_marking)
+    
+    return merge_pms(pm_docs)
+
+#--------------------------------------------------------------------------------
+
+def get_precomputed_pms(bundles, subdocs_to_check=[], pm_name='protective_marking'):
+    """ Gets the stored effective protective marking of each object.
+        Falls back to walking the object (and its sub-documents) for anything
+        saved before the effective marking was stored (until backfill_max_pm has been run). """
+    
+    pm_docs = []
+    missing = {}
+    for bundle in bundles:
+        obj = getattr(bundle, 'obj', None)
+        max_pm = getattr(obj, 'max_pm', None)
+        if max_pm:
+            pm_docs.append(max_pm)
+        elif getattr(obj, 'pk', None):
+            missing.setdefault(type(obj), []).append(obj.pk)
+        else:
+            pm_docs += get_all_pms([bundle], subdocs_to_check=subdocs_to_check, pm_name=pm_name)
+    
+    # The objects may have been loaded without their comments (see get_data_level_projection),
+    # so re-read the markings of all those without a stored max_pm in one query
+    for document_class, pks in missing.items():
+        for doc in document_class.objects(pk__in=pks).only(pm_name, *subdocs_to_check):
+            if getattr(doc, pm_name, None):
+                pm_docs.append(getattr(doc, pm_name))
+            for fld in subdocs_to_check:
+                for sub_object in getattr(doc, fld, None) or []:
+                    if sub_object.protective_marking:
+                        pm_docs.append(sub_object.protective_marking)
+        
+        # Comments kept in their own collection rather than embedded
+        if 'comments' in subdocs_to_check and comments_in_collection():
+            for comment in documents.StoredComment.objects(parent_id__in=pks).only('protective_marking'):
+                if comment.protective_marking:
+                    pm_docs.append(comment.protective_marking)
+    
+    return pm_docs
 
 #--------------------------------------------------------------------------------
 
@@ -241,6 +309,33 @@ def calculate_informal_time(time_stamp):
 
 #-----------------------------------------------------------------------------
 
+def derive_last_modified(document_class):
+    """ Derives the most recent project/comment modified timestamp the slow way.
+        Only used to seed the collection watermark when there isn't one yet. """
+    
+    # Except catches instance where no data
+    try:
+        doc_mod = document_class.objects.order_by('-modified')[0]['modified']
+    except IndexError:
+        return None
+    
+    # Retrieve the most recent comment modified timestamp
+    res = document_class._get_collection().aggregate([
+        { "$project" : {"_id" : 0, "comments" : 1}},
+        { "$unwind" : "$comments" },
+        { "$project" : {"modified" : "$comments.modified"}},
+        { "$sort" : {"modified" : -1}},
+        { "$limit" : 1}
+    ])['result']
+    
+    # In the event that there are no comments, the project mod date wins
+    if res:
+        return max([doc_mod, res[0]['modified']])
+    else:
+        return doc_mod
+
+#-----------------------------------------------------------------------------
+
 def tag_based_filtering(request, data):
     """ Filters the results by multiple tags """
     
@@ -267,17 +362,104 @@ def tag_based_filtering(request, data):
 
 #-----------------------------------------------------------------------------
 
-def get_user_vote_status(bundle):
-    """ Reports back whether and how the user has previously voted """
+# Whether the user has backed the project, as reported in user_backed
+USER_BACKED_VALUES = {'back' : 1}
+
+# The embedded vote list, for user_backed before the vote collection has been loaded
+EMBEDDED_VOTE_LISTS = {'backs' : 'back'}
+
+#-----------------------------------------------------------------------------
+
+# The stored fields that each derived response field is built from
+DERIVED_FIELD_SOURCES = {'informal_created'     : ['created'],
+                         'informal_modified'    : ['modified'],
+                         'contributor_name'     : ['user'],
+                         'pretty_pm'            : ['protective_marking'],
+                         'classification_short' : ['protective_marking'],
+                         'search_snippet'       : ['description'],
+                         'user_backed'          : []}
+
+# Always loaded: needed for the meta, authorization and resource uris
+REQUIRED_FIELDS = ['id', 'user', 'status', 'modified', 'max_pm']
+
+def get_data_level_fields(request):
+    """ The response fields asked for through data_level on a GET,
+        or None if everything is wanted. Cached on the request. """
+    
+    if request is None or request.method != 'GET':
+        return None
+    
+    if not hasattr(request, '_data_level_fields'):
+        data_level = request.GET.get('data_level', None)
+        if data_level == 'meta':
+            request._data_level_fields = set()
+        elif data_level in RESPONSE_FIELDS:
+            request._data_level_fields = set(RESPONSE_FIELDS[data_level])
+        else:
+            request._data_level_fields = None
+    
+    return request._data_level_fields
+
+def get_data_level_projection(request, document_class):
+    """ The document fields needed to build the requested data_level (for .only()),
+        or None if the whole document is needed. """
+    
+    fields = get_data_level_fields(request)
+    if fields is None:
+        return None
+    
+    # Sub-resources (e.g. /<id>/comments/) need their parent document in full
+    if re.match('.*/[a-zA-Z0-9]{24}/.+', request.path):
+        return None
+    
+    projection = set(REQUIRED_FIELDS)
+    for field in fields:
+        if field in document_class._fields:
+            projection.add(field)
+        projection.update(DERIVED_FIELD_SOURCES.get(field, []))
+    
+    # The sort fields too, for the cursor to the next page
+    for field in request.GET.getlist('order_by'):
+        if field.lstrip('-') in document_class._fields:
+            projection.add(field.lstrip('-'))
+    
+    return list(projection)
+
+def wants_field(bundle, *field_names):
+    """ Whether any of these fields will make it into the response - i.e. whether they're worth deriving """
+    
+    fields = get_data_level_fields(getattr(bundle, 'request', None))
+    if fields is None:
+        return True
+    
+    for field_name in field_names:
+        if field_name in fields:
+            return True
+    return False
+
+#-----------------------------------------------------------------------------
+
+# The columns of a ?format=csv export when no data_level is given
+CSV_FIELDS = ['id', 'title', 'description', 'status', 'user', 'contributor_name', 'created', 'modified',
+              'tags', 'tag_count', 'comment_count', 'back_count', 'related_ideas', 'classification_short']
+
+def get_pm_element(doc, element):
+    ''' An element of a raw project document's protective marking '''
     
-    # Has the current user voted on this project?
-    pos_votes = [vote.data['user'] for vote in bundle.data['backs']]
+    pm = doc.get('protective_marking') or {}
+    return pm.get(element) or 'NO PROTECTIVE MARKING FOUND'
+
+def get_informal_time(doc, field):
     
-    if unicode(bundle.request.user) in pos_votes:
-        user_vote = 1
-    else:
-        user_vote = 0
-    return user_vote
+    if not doc.get(field):
+        return ''
+    return calculate_informal_time(doc[field])
+
+# The csv columns that aren't stored: (db fields needed, function(raw document, contributor name resolver))
+CSV_DERIVED_FIELDS = {'contributor_name'     : (['user'],               lambda doc, resolver: resolver.name_for(doc['user']) if doc.get('user') else ''),
+                      'informal_created'     : (['created'],            lambda doc, resolver: get_informal_time(doc, 'created')),
+                      'informal_modified'    : (['modified'],           lambda doc, resolver: get_informal_time(doc, 'modified')),
+                      'classification_short' : (['protective_marking'], lambda doc, resolver: get_pm_element(doc, 'classification_short'))}
 
 #-----------------------------------------------------------------------------
 
@@ -341,6 +523,16 @@ def derive_snippet(text_html, chrs=240):
         
     return text
 
+def derive_search_snippet(text_html, terms, chrs=240):
+    """ A snippet as derive_snippet, but from around the first search term matched
+        and with the terms highlighted (so escaped, as it holds markup) """
+    
+    if not text_html or text_html == '':
+        return text_html
+    
+    stripped_text = strip_tags(text_html.replace('\n', ''))
+    return highlight_terms(derive_snippet(search_window(stripped_text, terms, chrs), chrs), terms)
+
 # ----------------------------------------------------------------------------------
 
 def merge_tag_results(proj_res, idea_res):
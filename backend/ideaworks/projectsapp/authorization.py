@@ -2,6 +2,7 @@
 # (c) Crown Copyright 2014 Defence Science and Technology Laboratory UK 
 # Author: Rich Brantingham
 
+from mongoengine.queryset import Q
 from tastypie.authorization import Authorization
 from tastypie.exceptions import Unauthorized
 
@@ -27,32 +28,25 @@ class PrivAndStatusAuthorization(Authorization):
 
 
     def read_list(self, object_list, bundle):
-        """ Public - all read, otherwise just creator and staff """
+        """ Public - all read, otherwise just creator and staff.
+            The rules are applied as a query predicate so that counting and
+            pagination of the remaining objects happens in the database. """
 
-        allowed = []
+        user = bundle.request.user
         
-        # No type of status provided
+        # No type of status provided - just return the published results
         if not bundle.request.GET.get('status', None) and not bundle.request.GET.get('status__in', None):
-            
-            # Just return the published results
-            for obj in object_list:
-                if obj.status == 'published': 
-                    allowed.append(obj.id)
+            return object_list.filter(status='published')
 
-        # Status is provided so make sure that the objects are either 'published' or 'draft' and belong
-        else:
-            if bundle.request.user.is_superuser == True or bundle.request.user.is_staff == True:
-                allowed = [obj.id for obj in object_list]
-            else:
-                for obj in object_list:
-                    # The object is published so add it
-                    if obj.status == 'published':
-                        allowed.append(obj.id)
-                    # The object is authored by this user so add it
-                    elif str(obj.user) == str(bundle.request.user):
-                        allowed.append(obj.id)
+        # Status is provided - staff and superusers see everything requested
+        if user.is_superuser == True or user.is_staff == True:
+            return object_list
 
-        return object_list.filter(id__in=allowed)
+        # Otherwise, objects must be either 'published' or belong to this user
+        if user.is_authenticated():
+            return object_list.filter(Q(status='published') | Q(user=str(user)))
+        else:
+            return object_list.filter(status='published')
 
         
     def read_detail(self, object_list, bundle):
@@ -3,7 +3,11 @@
 # Author: Rich Brantingham
 
 import datetime
-from mongoengine import Document, IntField, EmbeddedDocument, DateTimeField, ListField, StringField, EmbeddedDocumentField
+from mongoengine import Document, IntField, EmbeddedDocument, DateTimeField, ListField, StringField, EmbeddedDocumentField, ObjectIdField
+
+# The tag counts are shared with ideas
+from ideasapp.documents import update_tag_counts
+from ideaworks.votes import remove_target_votes
 
 class InheritableDocument(Document):
     meta = {'abstract'          : True,
@@ -50,10 +54,32 @@ class Comment(InheritableEmbeddedDocument):
     created                    = DateTimeField(help_text="The date and time of when the object was created.", default=datetime.datetime.utcnow)
     modified                   = DateTimeField(help_text="When the comment or dependent data was last modified.", default=datetime.datetime.utcnow)
     body                       = StringField(max_length=5000, help_text="Main body of the text, limited to 1000 chrs.")
+    body_snippet               = StringField(help_text="The body without markup, truncated by word. Set as the comment is written.")
     protective_marking         = EmbeddedDocumentField(ProtectiveMarking)
     
 #------------------------------------------------------------------------
 
+class StoredComment(Document):
+    """ A comment on a project, kept in a collection of its own rather than embedded
+        in the project (COMMENT_STORAGE = 'collection' - see ideaworks.comment_store) """
+    
+    parent_id                  = ObjectIdField(required=True, help_text="The project this comment is on.")
+    type                       = StringField(help_text='The type of comment to allow for filtering.', required=False)
+    user                       = StringField(help_text="ID of the user submitting the comment")
+    title                      = StringField(max_length=200, help_text="The title of the comment, limited to 100 chrs.")
+    created                    = DateTimeField(help_text="The date and time of when the object was created.", default=datetime.datetime.utcnow)
+    modified                   = DateTimeField(help_text="When the comment or dependent data was last modified.", default=datetime.datetime.utcnow)
+    body                       = StringField(max_length=5000, help_text="Main body of the text, limited to 1000 chrs.")
+    body_snippet               = StringField(help_text="The body without markup, truncated by word. Set as the comment is written.")
+    protective_marking         = EmbeddedDocumentField(ProtectiveMarking)
+    
+    # A page of one project's comments, oldest first, with _id to break ties for keyset paging
+    meta = {'collection' : 'project_comments',
+            'db_alias'   : 'default',
+            'indexes'    : [{'fields' : ['parent_id', 'created', 'id']}]}
+    
+#------------------------------------------------------------------------
+
 class Tag(InheritableDocument):
     text = StringField(max_length=30)
     count = IntField(default=0)
@@ -68,12 +94,17 @@ class Vote(InheritableEmbeddedDocument):
 
 #------------------------------------------------------------------------
 
+# The fields that ?q= searches, and how much a match in each counts. Mongoengine can't
+# declare text indexes, so this one is created by the manage_indexes management command.
+TEXT_INDEX_WEIGHTS = {'title' : 10, 'tags' : 5, 'description' : 1}
+
 class Project(InheritableDocument):
     """ The project object """
     
     user                = StringField(max_length=200, help_text="The project creator. User id as a string.")
     title               = StringField(max_length=200,  help_text="The title for this project. <br/>E.g. 'Quantum processing'")
     description         = StringField(max_length=5000, help_text="A description of the project.")
+    description_snippet = StringField(help_text="The description without markup, truncated by word. Maintained on save.")
     protective_marking  = EmbeddedDocumentField(ProtectiveMarking, help_text='Protective marking of this project.<br/>Comprising classification, descriptor, codewords and national caveats.<br/>See protective marking end point for fields.')
     created             = DateTimeField(help_text="The date and time of when the object was created.", default=datetime.datetime.utcnow)
     modified            = DateTimeField(help_text="When any component of the project or dependent data was last modified.", default=datetime.datetime.utcnow)
@@ -82,6 +113,7 @@ class Project(InheritableDocument):
     # Easier not to treat these as actual object ids
     backs               = ListField(EmbeddedDocumentField(Vote), help_text="Users who have backed this project.")
     comments            = ListField(EmbeddedDocumentField(Comment))
+    max_pm              = EmbeddedDocumentField(ProtectiveMarking, help_text="The highest protective marking across the project and its comments. Maintained on save.")
     related_ideas       = ListField(StringField(), help_text="Ideas associated with this project")
     
     # These included so that they get populated to the docs
@@ -91,5 +123,51 @@ class Project(InheritableDocument):
     
     status              = StringField(help_text="The current status of the object: published | draft | deleted | hidden ")
 
+    # Multikey index to serve tag filtering/ranking, then the published (and own) lists
+    # in the orders the API serves them. _id breaks ties for keyset paging and each
+    # index serves its order in either direction. Kept in step with the database by
+    # the manage_indexes management command.
+    meta = {'indexes' : ['tags',
+                         {'fields' : ['status', 'created', 'id']},
+                         {'fields' : ['status', 'modified', 'id']},
+                         {'fields' : ['status', 'back_count', 'id']},
+                         {'fields' : ['status', 'comment_count', 'id']},
+                         {'fields' : ['user', 'created', 'id']}]}
+
+    def clean(self):
+        """ Keeps the effective protective marking (this project plus its comments)
+            up to date whenever the project is saved - including when comments are
+            added, edited or removed, which save the whole document. And the
+            description snippet, so that reads don't have to strip the html. """
+        
+        # Imported here because api_functions depends on these documents
+        from api_functions import derive_document_max_pm, derive_snippet
+        self.max_pm = derive_document_max_pm(self)
+        self.description_snippet = derive_snippet(self.description)
+
+    def save(self, *args, **kwargs):
+        """ Keeps the tag counts in step with any change to the tags or status """
+        
+        old = None
+        if self.pk:
+            old = Project.objects(pk=self.pk).only('tags', 'status').first()
+        
+        response = super(Project, self).save(*args, **kwargs)
+        
+        if old:
+            update_tag_counts('project', old.tags, old.status, self.tags, self.status)
+        else:
+            update_tag_counts('project', None, None, self.tags, self.status)
+        
+        return response
+
+    def delete(self, *args, **kwargs):
+        """ Removes the project's tags from the tag counts, and any comments and votes stored apart from it """
+        
+        super(Project, self).delete(*args, **kwargs)
+        update_tag_counts('project', self.tags, self.status, None, None)
+        StoredComment.objects(parent_id=self.pk).delete()
+        remove_target_votes(self.pk)
+
 #------------------------------------------------------------------------
     
\ No newline at end of file
@@ -21,6 +21,7 @@ from registration.models import RegistrationProfile
 from tastypie_mongoengine import test_runner
 
 import projectsapp.documents as documents
+import ideasapp.documents as idea_documents
 from projectsapp import api
 from projectsapp import api_functions
 
@@ -275,7 +276,8 @@ class Test_Simple_GET_Project_API(Test_Authentication_Base):
         
         response = self.c.get('/api/%s/project/?format=csv'%(self.api_name), **self.headers)
         self.assertEquals(response.status_code, 200)
-        lines = response.content.split('\n')
+        # Streamed from the db
+        lines = ''.join(response.streaming_content).split('\n')
         self.assertEquals(len(lines), 4)
         
         # Split up each line
@@ -790,6 +792,32 @@ class Test_POST_Project_API(Test_Authentication_Base):
         self.assertTrue(datetime.datetime.strptime(objects[0]['created'], '%Y-%m-%dT%H:%M:%S.%f') < datetime.datetime.utcnow())
         self.assertEquals(objects[0]['user'], self.user.username)
 
+    def test_PATCH_bulk_create(self):
+        """ Staff can create a batch of projects with a PATCH to the list """
+        
+        docs = {"objects" : [{"title": "Project #%s"%(i),
+                              "description": "Project description in here.",
+                              "tags" : ["campaign"],
+                              "status":"published",
+                              "protective_marking" : self.pm,
+                              "related_ideas":[]} for i in range(3)]}
+        
+        # Other users can't
+        response = self.c.patch(self.resourceListURI('project'), json.dumps(docs), content_type='application/json', **self.headers2)
+        self.assertEquals(response.status_code, 401)
+        self.assertEquals(documents.Project.objects.count(), 0)
+        
+        response = self.c.patch(self.resourceListURI('project'), json.dumps(docs), content_type='application/json', **self.headers)
+        self.assertEquals(response.status_code, 202)
+        meta, objects = self.get_meta_and_objects(response)
+        self.assertEquals(meta['created'], 3)
+        
+        response = self.c.get(self.resourceListURI('project'), **self.headers)
+        meta, objects = self.get_meta_and_objects(response)
+        self.assertEquals(meta['total_count'], 3)
+        self.assertEquals(objects[0]['user'], self.user.username)
+        self.assertEquals(dict(idea_documents.read_tag_counts(['project']))['campaign'], 3)
+
         
     def test_PUT_simple(self):
 
@@ -986,6 +1014,34 @@ class Test_GET_tags(Test_Authentication_Base):
         tags = json.loads(response.content)['objects']
         self.assertEquals(len(tags), 3)
         
+    def get_tag_counts(self, params=''):
+        """ Gets the tag cloud as a dict of {text : count} """
+        
+        response = self.c.get(self.resourceListURI('tag')+params, **self.headers)
+        return dict([(tag['text'], tag['count']) for tag in json.loads(response.content)['objects']])
+
+    def test_get_tag_list_includes_ideas(self):
+        """ The tag cloud combines projects and ideas, and can be filtered by source and status."""
+        
+        docs = [{"title": "First project.",  "status" : "published", "tags" : ["project", "physics"]},
+                {"title": "Second project.", "status" : "draft",     "tags" : ["project"]}]
+        for doc in docs:
+            response = self.c.post(self.resourceListURI('project'), json.dumps(doc), content_type='application/json', **self.headers)
+            self.assertEqual(response.status_code, 201)
+        
+        idea_documents.Idea(title="An idea.", status="published", tags=["physics", "idea"]).save()
+        
+        self.assertEquals(self.get_tag_counts(), {'project' : 2, 'physics' : 2, 'idea' : 1})
+        self.assertEquals(self.get_tag_counts('?source=project'), {'project' : 2, 'physics' : 1})
+        self.assertEquals(self.get_tag_counts('?source=idea'), {'physics' : 1, 'idea' : 1})
+        self.assertEquals(self.get_tag_counts('?status=published'), {'project' : 1, 'physics' : 2, 'idea' : 1})
+        self.assertEquals(self.get_tag_counts('?source=project&status=draft'), {'project' : 1})
+        
+        # Ordered by the combined count
+        response = self.c.get(self.resourceListURI('tag'), **self.headers)
+        tags = json.loads(response.content)['objects']
+        self.assertEquals(tags[2]['text'], 'idea')
+
 #@utils.override_settings(DEBUG=True)
 class Test_Back_Actions(Test_Authentication_Base):
     
@@ -1101,6 +1157,26 @@ class Test_Back_Actions(Test_Authentication_Base):
         content = json.loads(response.content)['objects']
         self.assertEquals(len(content), 0)
 
+    def test_back_again_after_revoking(self):
+        """ Deleting a back frees the user's vote, so they can back the project again """
+        
+        back_uri = self.fullURItoAbsoluteURI(self.resource_uri) + 'backs/'
+        self.c.post(back_uri, json.dumps({}), content_type='application/json', **self.headers)
+        
+        response = self.c.get(back_uri, **self.headers)
+        back_exact_uri = json.loads(response.content)['objects'][0]['resource_uri']
+        response = self.c.delete(back_exact_uri, **self.headers)
+        self.assertEquals(response.status_code, 204)
+        
+        self.c.post(back_uri, json.dumps({}), content_type='application/json', **self.headers)
+        self.c.post(back_uri, json.dumps({}), content_type='application/json', **self.headers)
+        
+        response = self.c.get(self.resource_uri, **self.headers)
+        doc = json.loads(response.content)['objects'][0]
+        self.assertEquals(len(doc['backs']), 1)
+        self.assertEquals(doc['back_count'], 1)
+        self.assertEquals(doc['user_backed'], 1)
+
     def test_back_comment_stored_in_comments_model(self):
         """ Check that a Back comment gets stored in the comments model, not as a vote subdoc """
                 
@@ -1140,6 +1216,52 @@ class Test_Back_Actions(Test_Authentication_Base):
         self.assertEquals(len(doc['backs']), 1)
         self.assertEquals(doc['back_count'], 1)
 
+    def back_with_personal_comment(self):
+        """ Backs the project with a comment marked above the project, returning the project's max_pm """
+
+        backs_uri = self.fullURItoAbsoluteURI(self.resource_uri) + 'backs/'
+        new_comment = {"comment" : {"title"              : "heres a new comment",
+                                    "body"               : "heres the body of a new comment",
+                                    "protective_marking" : {"classification" : "PERSONAL",
+                                                            "classification_short" : "PE",
+                                                            "classification_rank" : 2,
+                                                            "national_caveats_primary_name" : '',
+                                                            "national_caveats_members" : [],
+                                                            "codewords" : ['BANANA 1'],
+                                                            "codewords_short" : ['B1'],
+                                                            "descriptor" : 'PRIVATE'}
+                                    }
+                       }
+        response = self.c.post(backs_uri, json.dumps(new_comment), content_type='application/json', **self.headers2)
+        self.assertEquals(response.status_code, 201)
+
+        doc_id = self.resource_uri.strip('/').split('/')[-1]
+        project = documents.Project.objects.get(id=doc_id)
+        self.assertEquals(project.comment_count, 1)
+        return project.max_pm
+
+    def test_back_comment_raises_project_max_pm(self):
+        """ The marking of a back's comment is merged into the project's max_pm """
+
+        max_pm = self.back_with_personal_comment()
+        self.assertEquals(max_pm.classification, 'PERSONAL')
+        self.assertEquals(max_pm.codewords, ['BANANA 1'])
+
+        response = self.c.get(self.resourceListURI('project'), **self.headers)
+        meta, objects = self.get_meta_and_objects(response)
+        self.assertEquals(meta['max_pm']['classification'], 'PERSONAL')
+
+    def test_back_comment_raises_project_max_pm_stored_comments(self):
+        """ The marking of a back's comment is merged into the project's max_pm
+            when comments are stored in their own collection """
+
+        with self.settings(COMMENT_STORAGE='collection'):
+            max_pm = self.back_with_personal_comment()
+            self.assertEquals(documents.StoredComment.objects.count(), 1)
+
+        self.assertEquals(max_pm.classification, 'PERSONAL')
+        self.assertEquals(max_pm.codewords, ['BANANA 1'])
+
     def test_attempted_back_spoof_fake_user(self):
         """ Mimics someone attemtpting to increment back by submitting a fake user """
         